@@ -0,0 +1,1025 @@
+__author__ = 'aclapes'
+
+'''Micro-benchmarks of the performance-critical parts of the framework.
+
+They run on synthetic data, so that no dataset (nor DenseTrackStab) is needed.
+Example: "python benchmark.py parser --sizes 10000 100000 2000000"
+
+'''
+
+import argparse
+import sys
+import time
+from os import remove, chmod
+from os.path import join
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# ==============================================================================
+# Benchmarks
+# ==============================================================================
+
+def bench_parser(args):
+    """
+    Compare the parsing of DenseTrackStab's output line-by-line (former implementation)
+    against the block-wise vectorized parser.
+    """
+    import tracklet_extraction
+
+    num_cols = _get_tracklet_num_cols()
+    for num_rows in args.sizes:
+        filepath = join(tempfile.gettempdir(), 'bench_tracklets_%d.dat' % num_rows)
+        _write_synthetic_tracklets_file(filepath, num_rows, num_cols)
+
+        st_time = time.time()
+        D_ref = _read_tracklets_file_per_line(filepath) if num_rows <= args.max_per_line else None
+        t_ref = time.time() - st_time
+
+        st_time = time.time()
+        D = tracklet_extraction.read_tracklets_file(filepath)
+        t_new = time.time() - st_time
+
+        if D_ref is not None:
+            assert np.array_equal(D_ref, D), 'BUG: parsers do not agree'
+            print('[bench_parser] rows=%d: per-line %.2f secs, block-wise %.2f secs (x%.1f)'
+                  % (num_rows, t_ref, t_new, t_ref / t_new))
+        else:
+            print('[bench_parser] rows=%d: block-wise %.2f secs (per-line skipped)' % (num_rows, t_new))
+
+        remove(filepath)
+
+
+def bench_stream(args):
+    """
+    Compare writing DenseTrackStab's output to a temporary file and parsing it afterwards (former implementation)
+    against parsing the output as it is streamed through a pipe. A stand-in executable that prints a synthetic
+    output plays the role of DenseTrackStab.
+    """
+    import tracklet_extraction
+
+    feats_beginend = tracklet_extraction.get_features_beginend(tracklet_extraction.INTERNAL_PARAMETERS['feats_dict'],
+                                                               tracklet_extraction.INTERNAL_PARAMETERS['L'])
+    num_cols = _get_tracklet_num_cols()
+
+    release_path = tempfile.mkdtemp()
+    with open(join(release_path, 'DenseTrackStab'), 'wb') as f:
+        f.write('#!/bin/sh\ncat "$1"\n')  # "video" is a text file with the tracklets
+    chmod(join(release_path, 'DenseTrackStab'), 0755)
+    tracklet_extraction.FEATURE_EXTRACTOR_RELPATH = release_path
+
+    for num_rows in args.sizes:
+        videofile_path = join(release_path, 'video_%d.dat' % num_rows)
+        _write_synthetic_tracklets_file(videofile_path, num_rows, num_cols)
+
+        st_time = time.time()
+        tmp_filepath = join(release_path, 'tmp.dat')
+        tracklet_extraction.extract_wang_features(videofile_path, tracklet_extraction.INTERNAL_PARAMETERS['L'],
+                                                  tmp_filepath)
+        D = tracklet_extraction.read_tracklets_file(tmp_filepath)
+        feats_ref = dict((feat_t, D[:,b:e]) for feat_t, (b, e) in feats_beginend.iteritems())
+        t_ref = time.time() - st_time
+
+        st_time = time.time()
+        feats = tracklet_extraction.stream_wang_features(videofile_path, tracklet_extraction.INTERNAL_PARAMETERS['L'],
+                                                         feats_beginend)
+        t_new = time.time() - st_time
+
+        for feat_t in feats_beginend.keys():
+            assert np.array_equal(feats_ref[feat_t], feats[feat_t]), 'BUG: outputs do not agree'
+        print('[bench_stream] rows=%d: temporary file %.2f secs, stream %.2f secs (x%.1f)'
+              % (num_rows, t_ref, t_new, t_ref / t_new))
+
+    shutil.rmtree(release_path)
+
+
+def bench_density(args):
+    """
+    Compare the per-tracklet low density filtering (former implementation) against the one querying all
+    the tracklets of a frame at once.
+    """
+    import tracklet_extraction
+
+    for num_rows in args.sizes:
+        obj = _generate_synthetic_obj(num_rows, args.num_frames)
+
+        st_time = time.time()
+        inliers = tracklet_extraction.filter_low_density(obj)
+        t_new = time.time() - st_time
+
+        if num_rows <= args.max_per_tracklet:
+            st_time = time.time()
+            inliers_ref = _filter_low_density_per_tracklet(obj)
+            t_ref = time.time() - st_time
+            # (distances are computed by different KD-tree implementations, tolerate borderline tracklets)
+            num_diff = len(np.setxor1d(inliers_ref, inliers))
+            assert num_diff <= 1e-4 * num_rows, 'BUG: filters do not agree (%d different)' % num_diff
+            print('[bench_density] rows=%d: per-tracklet %.2f secs, per-frame %.2f secs (x%.1f), %d/%d inliers'
+                  % (num_rows, t_ref, t_new, t_ref / t_new, len(inliers), num_rows))
+        else:
+            print('[bench_density] rows=%d: per-frame %.2f secs (per-tracklet skipped), %d/%d inliers'
+                  % (num_rows, t_new, len(inliers), num_rows))
+
+
+def bench_scaling(args):
+    """
+    Throughput (videos/sec) of the parallelization backends vs. the number of workers, on synthetic "videos" whose
+    processing mixes GIL-bound python code (parsing their tracklets line by line) and BLAS calls.
+    """
+    from joblib import delayed
+    import parallelism
+
+    num_cols = _get_tracklet_num_cols()
+    filepath = join(tempfile.gettempdir(), 'bench_scaling_%d.dat' % args.num_rows)
+    _write_synthetic_tracklets_file(filepath, args.num_rows, num_cols)
+
+    for backend in args.backends:
+        for nt in args.workers:
+            st_time = time.time()
+            parallelism.run_parallel([delayed(_synthetic_video_job)(filepath) for _ in xrange(args.num_videos)],
+                                     nt=nt, backend=backend)
+            elapsed_time = time.time() - st_time
+            print('[bench_scaling] backend=%s workers=%d: %.2f videos/sec (in %.2f secs)'
+                  % (backend, nt, args.num_videos / elapsed_time, elapsed_time))
+
+    remove(filepath)
+
+
+def bench_schedule(args):
+    """
+    Makespan and idle time of a stage when dispatching the videos in index order vs. longest-first. The jobs
+    just sleep for their cost (a heavy-tailed distribution, with the biggest videos last).
+    """
+    from joblib import delayed
+    import parallelism
+
+    costs = np.sort(args.unit * np.random.pareto(1.5, size=args.num_videos) + args.unit)  # (biggest last)
+    print('[bench_schedule] %d videos, %.2f secs of work in total (the biggest %.2f secs)'
+          % (args.num_videos, costs.sum(), costs.max()))
+    for nt in args.workers:
+        for name, job_costs in [('index order', None), ('longest-first', costs)]:
+            stats = dict()
+            parallelism.run_parallel([delayed(time.sleep)(c) for c in costs], nt=nt, backend='threading',
+                                     costs=job_costs, stats=stats)
+            print('[bench_schedule] workers=%d, %s: makespan %.2f secs, idle %.2f core-secs'
+                  % (nt, name, stats['makespan'], stats['idle']))
+
+
+def bench_channels(args):
+    """
+    Compare the construction of the tracklets' channels in tracklet_clustering._cluster tracklet-by-tracklet
+    (former implementation) against the whole-array one.
+    """
+    import tracklet_clustering
+    import tracklet_extraction
+
+    L = tracklet_extraction.INTERNAL_PARAMETERS['L']
+    for num_rows in args.sizes:
+        obj = _generate_synthetic_obj(num_rows, 1000)
+        trj = (obj[:,1:3,np.newaxis] + np.cumsum(np.random.randn(num_rows, 2, L), axis=2)).transpose((0,2,1))
+        trj = trj.reshape((num_rows, 2*L)).astype(np.float32)  # (x and y interleaved)
+
+        st_time = time.time()
+        D_ref = _get_tracklet_channels_per_tracklet(obj, trj)
+        t_ref = time.time() - st_time
+
+        st_time = time.time()
+        D = tracklet_clustering.get_tracklet_channels(obj, trj)
+        t_new = time.time() - st_time
+
+        for channel_t in D_ref.keys():
+            assert np.array_equal(np.array(D_ref[channel_t], dtype=np.float32), D[channel_t]), \
+                'BUG: %s channels do not agree' % channel_t
+        print('[bench_channels] rows=%d: per-tracklet %.2f secs, whole-array %.3f secs (x%.1f)'
+              % (num_rows, t_ref, t_new, t_ref / t_new))
+
+
+def bench_kernel(args):
+    """
+    Compare the multimodal product kernel computed with one dense distance matrix per channel (former
+    implementation) against the fused blocked one, on the channels of synthetic tracklets.
+    """
+    import tracklet_clustering
+    import tracklet_extraction
+
+    L = tracklet_extraction.INTERNAL_PARAMETERS['L']
+    for num_rows in args.sizes:
+        obj = _generate_synthetic_obj(num_rows, 1000)
+        trj = (obj[:,1:3,np.newaxis] + np.cumsum(np.random.randn(num_rows, 2, L), axis=2)).transpose((0,2,1))
+        D = tracklet_clustering.get_tracklet_channels(obj, trj.reshape((num_rows, 2*L)).astype(np.float32))
+
+        insample = np.random.permutation(num_rows)[:int(args.sample_ratio * num_rows)]
+        for name, secondary in [('A', insample), ('B', np.arange(num_rows))]:
+            n, m = len(insample), len(secondary)
+            st_time = time.time()
+            K_ref, medians_ref = _multimodal_product_kernel_per_channel(D, insample, secondary)
+            t_ref = time.time() - st_time
+
+            st_time = time.time()
+            K, medians = tracklet_clustering.multimodal_product_kernel(D, insample, secondary)
+            t_new = time.time() - st_time
+
+            # (peak memory of the distances and kernels, besides the output)
+            mem_ref = 2 * n * m * 8  # one float64 distance matrix and its rbf kernel at a time
+            mem_new = 2 * min(n * m * 8, tracklet_clustering.INTERNAL_PARAMETERS['kernel_block_bytes'])
+            print('[bench_kernel] rows=%d %s (%dx%d): per-channel %.2f secs, fused %.2f secs (x%.1f); '
+                  'max abs. diff %.2e, max rel. diff of the medians %.2e; temporaries %.1f MB -> %.1f MB'
+                  % (num_rows, name, n, m, t_ref, t_new, t_ref / t_new, np.abs(K_ref - K).max(),
+                     np.max(np.abs(np.array(medians_ref) - medians) / np.array(medians_ref)),
+                     mem_ref / 2.**20, mem_new / 2.**20))
+
+
+def bench_eigen(args):
+    """
+    Speed and accuracy of the eigen-solvers and stability checks of the Nystrom spectral embedding, w.r.t.
+    the full decompositions with full stability checks (the former behaviour).
+    """
+    import spectral_division
+    from sklearn.metrics.pairwise import rbf_kernel
+
+    configs = [('full', True), ('full', 'probe'), ('full', False), ('eigsh', 'probe'), ('randomized', 'probe')]
+    for n in args.sizes:
+        X = np.random.randn(n * (1 + args.ratio), 3)
+        AB = rbf_kernel(X[:n], X, gamma=0.5)
+
+        E_ref, t_ref = None, None
+        for i, (solver, check_stability) in enumerate(configs):
+            st_time = time.time()
+            try:
+                E = spectral_division.spectral_embedding_nystrom(AB, solver=solver, check_stability=check_stability)
+            except (spectral_division.IndefiniteError, spectral_division.NumericalError) as e:
+                # (a failed check, reported as the embedding would be recomputed with another ridge)
+                print('[bench_eigen] n=%d, solver=%s, check_stability=%s: FAILED (%s: %s)'
+                      % (n, solver, check_stability, type(e).__name__, e))
+                continue
+            elapsed_time = time.time() - st_time
+            if i == 0:
+                E_ref, t_ref = E, elapsed_time
+            if E_ref is None:  # (the reference failed)
+                print('[bench_eigen] n=%d, solver=%s, check_stability=%s: %.2f secs'
+                      % (n, solver, check_stability, elapsed_time))
+                continue
+            err = np.minimum(np.abs(E - E_ref), np.abs(E + E_ref)).max() / np.abs(E_ref).max()  # (up to sign)
+            print('[bench_eigen] n=%d, solver=%s, check_stability=%s: %.2f secs (x%.1f), max rel. error %.1e'
+                  % (n, solver, check_stability, elapsed_time, t_ref / elapsed_time, err))
+
+
+def bench_split(args):
+    """
+    Compare the thresholding split of the root of a spectral tree scored threshold by threshold (former
+    implementation) against the single sweep per eigen-vector, on a synthetic embedding.
+    """
+    import spectral_division
+
+    for n in args.sizes:
+        geoms = np.vstack([np.random.randn(n // 4, 3) + 4 * np.random.randn(3) for _ in xrange(4)])
+        E = np.hstack([geoms, np.random.randn(len(geoms), args.num_vecs - 3)])
+        E += 0.3 * np.random.randn(*E.shape)
+        tree = spectral_division.SpectralTree(E, geoms, 20, len(geoms), 1, 20, 1e-10, 'threshold', args.num_threshs)
+        tree.n_clusters = 1
+
+        results = []
+        for split_func in [_split_threshold_per_threshold, spectral_division.SpectralTree._split_threshold]:
+            root = spectral_division.SpectralNode(np.arange(len(geoms)), 0, name='1')
+            st_time = time.time()
+            left, right = split_func(tree, root)
+            results.append((time.time() - st_time, left, right))
+
+        (t_ref, left_ref, right_ref), (t_new, left, right) = results
+        same = (left is None and left_ref is None) or \
+               (left is not None and left_ref is not None and left.vec == left_ref.vec
+                and np.array_equal(left.ids, left_ref.ids) and (left.score, right.score) == (left_ref.score, right_ref.score))
+        print('[bench_split] n=%d: per-threshold %.2f secs, sweep %.2f secs (x%.1f); same split: %s'
+              % (len(geoms), t_ref, t_new, t_ref / t_new, same))
+
+
+def bench_neighbors(args):
+    """
+    Compare the search of the sparsest connected geometrical adjacency rebuilding and querying an index for every
+    number of neighbors (former implementation) against the single index with doubling and binary search.
+    """
+    import spectral_division
+
+    for n in args.sizes:
+        # some blobs, more or less apart, so that a few tens of neighbors are needed to connect them
+        centers = args.spread * np.random.randn(args.num_blobs, 3)
+        geoms = centers[np.random.randint(0, args.num_blobs, size=n)] + np.random.randn(n, 3)
+
+        st_time = time.time()
+        n_comp_ref, C_ref, _ = _build_sym_geom_adjacency_loop(geoms)
+        t_ref = time.time() - st_time
+
+        st_time = time.time()
+        n_comp, C, neighbs = spectral_division.build_sym_geom_adjacency(geoms)
+        t_new = time.time() - st_time
+
+        print('[bench_neighbors] n=%d (%s): loop %.2f secs, search %.2f secs (x%.1f); n_neighbors=%d, '
+              'same adjacency: %s'
+              % (n, 'pyflann' if spectral_division.pyflann is not None else 'cKDTree', t_ref, t_new, t_ref / t_new,
+                 neighbs.shape[1], n_comp == n_comp_ref and (C != C_ref).nnz == 0))
+
+
+def bench_membership(args):
+    """
+    Compare gathering the tracklets of every node of a clustering tree by comparing their int_paths against every
+    descendant (former implementation) against sorting them by leaf once (contiguous ranges), on random trees.
+    """
+    from cluster_tree import ClusterTree
+
+    for num_rows in args.sizes:
+        for num_leafs in args.num_leafs:
+            int_paths = _generate_synthetic_int_paths(num_rows, num_leafs)
+            X = np.random.rand(num_rows, 64)
+
+            st_time = time.time()
+            sums_ref = dict()
+            for node_id, descendants in _reconstruct_tree_from_leafs(np.unique(int_paths)).iteritems():
+                node_inds = np.where(np.any([int_paths == idx for idx in descendants], axis=0))[0]
+                sums_ref[node_id] = X[node_inds,:].sum(axis=0)
+            t_ref = time.time() - st_time
+
+            st_time = time.time()
+            T = ClusterTree(np.unique(int_paths))
+            order, ranges = T.get_node_ranges(int_paths)
+            X_sorted = X[order]
+            sums = dict((node_id, X_sorted[st:en,:].sum(axis=0)) for node_id, (st, en) in zip(T.keys(), ranges))
+            t_new = time.time() - st_time
+
+            err = max([np.abs(sums[k] - sums_ref[k]).max() / max(1., np.abs(sums_ref[k]).max()) for k in sums_ref])
+            print('[bench_membership] rows=%d, leafs=%d (depth %d): per-descendant %.2f secs, ranges %.3f secs (x%.1f); '
+                  'max rel. diff %.1e'
+                  % (num_rows, num_leafs, max([int(p).bit_length() - 1 for p in T.leafs]), t_ref, t_new,
+                     t_ref / t_new, err))
+
+
+def bench_bovw_tree(args):
+    """
+    Compare the bovws of the nodes of a clustering tree assigning the codewords of every node's tracklets (former
+    implementation) against assigning them once and summing the leafs' bovws up the tree, on trees of several
+    depths. The codewords are assigned by brute force with numpy (as yael's knn does), so that yael is not needed.
+    """
+    from cluster_tree import ClusterTree
+
+    codebook = np.random.rand(args.num_words, args.num_dims).astype(np.float32)
+    X = np.random.rand(args.num_rows, args.num_dims).astype(np.float32)
+    for depth in args.depths:
+        int_paths = _generate_synthetic_int_paths(args.num_rows, depth=depth)
+        T = ClusterTree(np.unique(int_paths))
+
+        st_time = time.time()
+        H_ref = dict()
+        for node_id, descendants in _reconstruct_tree_from_leafs(np.unique(int_paths)).iteritems():
+            node_inds = np.where(np.any([int_paths == idx for idx in descendants], axis=0))[0]
+            H_ref[node_id] = np.bincount(_get_codewords_brute_force(codebook, X[node_inds]), minlength=args.num_words)
+        t_ref = time.time() - st_time
+
+        st_time = time.time()
+        words = _get_codewords_brute_force(codebook, X)
+        leaf_pos = T.get_leaf_positions(int_paths)
+        H_leafs = np.bincount(leaf_pos * args.num_words + words, minlength=len(T.leafs) * args.num_words)
+        H = dict(zip(T.keys(), T.sum_over_subtrees(H_leafs.reshape((len(T.leafs), args.num_words)))))
+        t_new = time.time() - st_time
+
+        print('[bench_bovw_tree] rows=%d, depth=%d (%d nodes): per-node %.2f secs, bottom-up %.2f secs (x%.1f); same bovws: %s'
+              % (args.num_rows, depth, len(T), t_ref, t_new, t_ref / t_new,
+                 np.all([np.array_equal(H[k], H_ref[k]) for k in H])))
+
+
+def bench_fv_tree(args):
+    """
+    Compare the FVs of the nodes of a clustering tree computing them from every node's tracklets (calling
+    ynumpy.fisher per node, or an independent implementation of its formulas if yael is not installed) against
+    summing the leafs' sufficient statistics up the tree (fisher_stats), on trees of several depths.
+    """
+    from cluster_tree import ClusterTree
+    import fisher_stats
+
+    include = ['mu', 'sigma']
+    w = np.random.rand(args.num_components) + 0.1
+    gmm = (w / np.sum(w), np.random.rand(args.num_components, args.num_dims),
+           np.random.rand(args.num_components, args.num_dims) * 0.1 + 0.05)
+    X = np.random.rand(args.num_rows, args.num_dims).astype(np.float32)
+    ref_name, fisher = _get_fisher_reference()
+    for depth in args.depths:
+        int_paths = _generate_synthetic_int_paths(args.num_rows, depth=depth)
+        T = ClusterTree(np.unique(int_paths))
+
+        st_time = time.time()
+        order, ranges = T.get_node_ranges(int_paths)
+        Xo = X[order]
+        V_ref = {node_id : fisher(gmm, Xo[st:en], include) for node_id, (st, en) in zip(T.keys(), ranges)}
+        t_ref = time.time() - st_time
+
+        st_time = time.time()
+        S = fisher_stats.get_stats_per_leaf(gmm, X, T.get_leaf_positions(int_paths), len(T.leafs))
+        S = {s : T.sum_over_subtrees(v) for s, v in S.iteritems()}
+        V = {node_id : fisher_stats.fisher_from_stats(gmm, {s : v[node_idx] for s, v in S.iteritems()}, include)
+             for node_idx, node_id in enumerate(T.keys())}
+        t_new = time.time() - st_time
+
+        err = max([np.max(np.abs(V[k] - V_ref[k])) / max(np.max(np.abs(V_ref[k])), 1e-12) for k in V])
+        print('[bench_fv_tree] rows=%d, depth=%d (%d nodes): per-node (%s) %.2f secs, bottom-up %.2f secs (x%.1f); max rel. diff %.2e'
+              % (args.num_rows, depth, len(T), ref_name, t_ref, t_new, t_ref / t_new, err))
+
+
+def bench_vd_tree(args):
+    """
+    Compare the per-frame FVs of the nodes of a clustering tree (the input of VideoDarwin) computing them per node
+    and frame (calling ynumpy.fisher, or an independent implementation of its formulas if yael is not installed, as
+    the former code did) against summing the per-frame statistics of the children of every node (fisher_stats).
+    """
+    from cluster_tree import ClusterTree
+    import fisher_stats
+
+    include = ['mu', 'sigma']
+    w = np.random.rand(args.num_components) + 0.1
+    gmm = (w / np.sum(w), np.random.rand(args.num_components, args.num_dims),
+           np.random.rand(args.num_components, args.num_dims) * 0.1 + 0.05)
+    X = np.random.rand(args.num_rows, args.num_dims).astype(np.float32)
+    frames = np.random.randint(0, args.num_frames, size=args.num_rows)
+    ref_name, fisher = _get_fisher_reference()
+    for depth in args.depths:
+        int_paths = _generate_synthetic_int_paths(args.num_rows, depth=depth)
+        T = ClusterTree(np.unique(int_paths))
+
+        st_time = time.time()
+        order, ranges = T.get_node_ranges(int_paths)
+        Xo, fo = X[order], frames[order]
+        V_ref = dict()
+        for node_id, (st, en) in zip(T.keys(), ranges):
+            V_ref[node_id] = np.array([fisher(gmm, Xo[st + np.where(fo[st:en] == f)[0],:], include)
+                                       for f in np.unique(fo[st:en])])
+        t_ref = time.time() - st_time
+
+        st_time = time.time()
+        V_new = {node_id : V for node_id, _, V in fisher_stats.iter_node_frame_fishers(gmm, X, frames, T, int_paths, include)}
+        t_new = time.time() - st_time
+
+        err = max([np.max(np.abs(V_new[k] - V_ref[k])) / max(np.max(np.abs(V_ref[k])), 1e-12) for k in V_new])
+        print('[bench_vd_tree] rows=%d, frames=%d, depth=%d (%d nodes): per-node (%s) %.2f secs, bottom-up %.2f secs (x%.1f); max rel. diff %.2e'
+              % (args.num_rows, args.num_frames, depth, len(T), ref_name, t_ref, t_new, t_ref / t_new, err))
+
+
+def bench_darwin(args):
+    """
+    Compare the VideoDarwin of many sequences fitting two LinearSVR per sequence (videodarwin.darwin) against
+    solving all the regressions at once (videodarwin.darwin_batch), in chunks of sequences. The batched solver finds
+    the exact optimum, while liblinear stops at tol=0.001: the first sequences are also checked against LinearSVR
+    with a tight tolerance.
+    """
+    import videodarwin
+    from sklearn.svm import LinearSVR
+
+    for dim in args.dims:
+        t_ref = t_new = 0.
+        diff_default = diff_exact = 0.
+        n_checked = 0
+        for st in xrange(0, args.num_seqs, args.chunk_size):
+            Xs = [np.random.rand(np.random.randint(args.min_length, args.max_length + 1), dim).astype(np.float32)
+                  for _ in xrange(min(args.chunk_size, args.num_seqs - st))]
+
+            st_time = time.time()
+            W_ref = [videodarwin.darwin(X) for X in Xs]
+            t_ref += time.time() - st_time
+
+            st_time = time.time()
+            W_new = videodarwin.darwin_batch(Xs)
+            t_new += time.time() - st_time
+
+            diff_default = max([diff_default] + [np.linalg.norm(np.ravel(w_ref) - w) / np.linalg.norm(w_ref)
+                                                 for w_ref, w in zip(W_ref, W_new)])
+            for X, w in zip(Xs, W_new)[:max(args.num_checks - n_checked, 0)]:
+                T = X.shape[0]
+                V = np.cumsum(X, axis=0) / np.linspace(1,T,T)[:,np.newaxis]  # (the forward one)
+                clf = LinearSVR(C=1, dual=False, loss='squared_epsilon_insensitive', epsilon=0.1, tol=1e-10, max_iter=100000)
+                clf.fit(videodarwin.normalizeL2(videodarwin.rootSIFT(V)), np.linspace(1,T,T))
+                diff_exact = max(diff_exact, np.linalg.norm(w[:dim] - clf.coef_) / np.linalg.norm(clf.coef_))
+                n_checked += 1
+
+        print('[bench_darwin] seqs=%d, lengths=%d-%d, dim=%d: LinearSVR %.2f secs, batched %.2f secs (x%.1f); '
+              'max rel. diff to LinearSVR %.2e (tol=0.001), %.2e (tol=1e-10)'
+              % (args.num_seqs, args.min_length, args.max_length, dim, t_ref, t_new, t_ref / t_new,
+                 diff_default, diff_exact))
+
+
+def bench_ridge(args):
+    """
+    Compare the VideoDarwin of LinearSVR (videodarwin.darwin, solver='liblinear') against the closed-form ridge
+    regression in the dual (solver='ridge_gram'): time and accuracy (the cosine similarities and relative
+    differences of the representations). On synthetic sequences, or on the stored per-frame features of the
+    videos (the pickles darwintree reads, with 'X' and 'tree_perframe').
+    """
+    import cPickle
+    from glob import glob
+    import videodarwin
+
+    if args.feats_path is not None:
+        def get_sequences():
+            for filepath in sorted(glob(join(args.feats_path, '*.pkl')))[:args.num_videos]:
+                with open(filepath, 'rb') as f:
+                    data = cPickle.load(f)
+                yield data['X']
+                for X in data['tree_perframe'].itervalues():
+                    yield X
+    else:
+        def get_sequences():
+            for _ in xrange(args.num_seqs):
+                yield np.random.rand(np.random.randint(args.min_length, args.max_length + 1), args.dim).astype(np.float32)
+
+    t_ref = t_new = 0.
+    cosines, diffs = [], []
+    for X in get_sequences():
+        st_time = time.time()
+        w_ref = videodarwin.darwin(X, solver='liblinear')
+        t_ref += time.time() - st_time
+
+        st_time = time.time()
+        w = videodarwin.darwin(X, solver='ridge_gram')
+        t_new += time.time() - st_time
+
+        w_ref = np.ravel(w_ref)
+        cosines.append(np.dot(w_ref, w) / (np.linalg.norm(w_ref) * np.linalg.norm(w)))
+        diffs.append(np.linalg.norm(w_ref - w) / np.linalg.norm(w_ref))
+
+    print('[bench_ridge] %d seqs (%s): liblinear %.2f secs, ridge_gram %.2f secs (x%.1f); cosine similarity '
+          'mean %.4f, min %.4f; rel. diff mean %.2e, max %.2e'
+          % (len(cosines), args.feats_path if args.feats_path is not None else 'synthetic, dim=%d' % args.dim,
+             t_ref, t_new, t_ref / t_new, np.mean(cosines), np.min(cosines), np.mean(diffs), np.max(diffs)))
+
+
+def bench_pooling(args):
+    """
+    Compare the pooling of the videodarwin (the running means, rootSIFT'd and L2-normalized, of both directions) as
+    _darwin formerly did it against videodarwin.get_pooled_sequences, on long float32 sequences: time, the peak of
+    memory of a call (measured in a forked child), and the largest difference of the pooled sequences.
+    """
+    import videodarwin
+
+    for length in args.lengths:
+        X = np.random.rand(length, args.num_dims).astype(np.float32)
+
+        t_ref, mem_ref = _measure_peak_memory(lambda: _get_pooled_sequences_reference(X))
+        t_new, mem_new = _measure_peak_memory(lambda: videodarwin.get_pooled_sequences(X))
+        err = max([np.max(np.abs(V - V_ref)) for V, V_ref in zip(videodarwin.get_pooled_sequences(X),
+                                                                 _get_pooled_sequences_reference(X))])
+
+        print('[bench_pooling] T=%d, dim=%d (%.1f MB): former %.2f secs, %.1f MB; single-allocation %.2f secs, '
+              '%.1f MB (x%.1f less memory); max abs. diff %.2e'
+              % (length, args.num_dims, X.nbytes / 2.**20, t_ref, mem_ref / 2.**20, t_new, mem_new / 2.**20,
+                 float(mem_ref) / mem_new, err))
+
+
+def bench_branches(args):
+    """
+    Compare the VideoDarwin of the branches of a tree (the paths from every node up to the root) running
+    videodarwin._darwin per branch (the former kernels._construct_branch_evolutions) against videodarwin.darwin_tree,
+    which shares the computations of the ancestors and warm-starts from the parents' solutions, on random trees.
+    darwin_tree solves the problem exactly: it is checked against darwin_batch of every branch as well.
+    """
+    import videodarwin
+
+    for num_leafs in args.num_leafs:
+        int_paths = np.unique(_generate_synthetic_int_paths(10 * num_leafs, num_leafs=num_leafs))
+        ids = set()
+        for p in int_paths:
+            while p >= 1 and p not in ids:
+                ids.add(int(p))
+                p >>= 1
+        tree = {id : np.random.rand(args.num_dims).astype(np.float32) for id in ids}
+        branches = dict()
+        for id in tree:
+            X, id_j = [], id
+            while id_j > 0:
+                X.append(tree[id_j])
+                id_j /= 2
+            branches[id] = np.array(X)
+
+        st_time = time.time()
+        W_ref = {id : videodarwin._darwin(X) for id, X in branches.iteritems() if id > 1}
+        t_ref = time.time() - st_time
+
+        st_time = time.time()
+        W_new = videodarwin.darwin_tree(tree)
+        t_new = time.time() - st_time
+
+        W_exact = dict(zip([id for id in branches if id > 1],
+                           videodarwin._darwin_batch([X for id, X in branches.iteritems() if id > 1])))
+        diff = lambda W, W_ref: max([np.linalg.norm(np.ravel(w_ref) - w) / np.linalg.norm(w_ref)
+                                     for id in W_ref for w, w_ref in zip(W[id], W_ref[id])])
+
+        print('[bench_branches] %d nodes (depth %d), dim=%d: per-branch %.2f secs, tree %.2f secs (x%.1f); '
+              'max rel. diff %.2e to per-branch LinearSVR (tol=0.001), %.2e to per-branch exact'
+              % (len(tree), max(ids).bit_length() - 1, args.num_dims, t_ref, t_new, t_ref / t_new,
+                 diff(W_new, W_ref), diff(W_new, W_exact)))
+
+
+# ==============================================================================
+# Helper functions
+# ==============================================================================
+
+def _get_tracklet_num_cols():
+    import tracklet_extraction
+    feats_beginend = tracklet_extraction.get_features_beginend(tracklet_extraction.INTERNAL_PARAMETERS['feats_dict'],
+                                                               tracklet_extraction.INTERNAL_PARAMETERS['L'])
+    return max([end for (_, end) in feats_beginend.values()])
+
+
+def _write_synthetic_tracklets_file(filepath, num_rows, num_cols, block_rows=10000):
+    # mimic DenseTrackStab's output: frame number ("%d"), trajectory info ("%f") and descriptors ("%.7f"),
+    # every value followed by a tab, one tracklet per line
+    import tracklet_extraction
+    feats_beginend = tracklet_extraction.get_features_beginend(tracklet_extraction.INTERNAL_PARAMETERS['feats_dict'],
+                                                               tracklet_extraction.INTERNAL_PARAMETERS['L'])
+    desc_st = feats_beginend['hog'][0]
+
+    n = min(block_rows, num_rows)
+    frames = np.sort(np.random.randint(0, 1000, size=n))
+    info = 100 * np.random.randn(n, desc_st - 1).astype(np.float32)
+    descs = np.random.rand(n, num_cols - desc_st).astype(np.float32)
+    lines = ''.join(['%d\t' % fr + ''.join(['%f\t' % v for v in x]) + ''.join(['%.7f\t' % v for v in d]) + '\n'
+                     for fr, x, d in zip(frames, info, descs)])
+    with open(filepath, 'wb') as f:
+        for i in xrange(num_rows // n):
+            f.write(lines)
+        rest = num_rows % n
+        if rest > 0:
+            f.write(''.join(lines.splitlines(True)[:rest]))
+
+
+def _generate_synthetic_obj(num_rows, num_frames):
+    # tracklets' ending frame and mean position (some dense blobs over a uniform background clutter)
+    import tracklet_extraction
+    obj = np.zeros((num_rows, tracklet_extraction.INTERNAL_PARAMETERS['feats_dict']['obj']), dtype=np.float32)
+    obj[:,0] = np.sort(np.random.randint(0, num_frames, size=num_rows))
+    centers = np.random.rand(10, 2) * [320, 240]
+    blob_rows = np.random.rand(num_rows) < 0.8
+    obj[blob_rows,1:3] = centers[np.random.randint(0, len(centers), size=np.count_nonzero(blob_rows))] \
+                         + 10 * np.random.randn(np.count_nonzero(blob_rows), 2)
+    obj[~blob_rows,1:3] = np.random.rand(np.count_nonzero(~blob_rows), 2) * [320, 240]
+    return obj
+
+
+def _filter_low_density_per_tracklet(data, k=30, r=5):
+    # the former implementation of tracklet_extraction.filter_low_density
+    from sklearn.neighbors import KDTree
+    P = data[:,[1,2]]
+
+    all_sparsities = np.zeros((P.shape[0],k), dtype=np.float32)
+    subset_indices = []
+    for i in range(0, P.shape[0]):
+        new_subset_indices = np.where((data[:,0] >= data[i,0] - r) & (data[:,0] <= data[i,0] + r))[0]
+        if len(new_subset_indices) == 1:
+            all_sparsities[i,:] = np.nan
+        else:
+            if not np.array_equal(new_subset_indices, subset_indices):
+                subset_indices = new_subset_indices
+                tree = KDTree(P[subset_indices,:], leaf_size=1e3)
+
+            p = P[i,:].reshape(1,-1)
+            if k+1 <= len(subset_indices):
+                dists, inds = tree.query(p, k=k+1)
+                dists = dists[0,1:]
+            else:
+                dists, inds = tree.query(p, k=len(subset_indices))
+                dists = np.concatenate([dists[0,1:], [np.nan]*(k-len(dists[0,1:]))])
+            all_sparsities[i,:] = dists
+
+    local_sparsities = np.nanmean(all_sparsities, axis=1)
+    mean_sparsity = np.nanmean(all_sparsities)
+    stddev_sparsity = np.nanstd(all_sparsities)
+    return np.where(local_sparsities <= (mean_sparsity + stddev_sparsity))[0]
+
+
+def _synthetic_video_job(filepath):
+    D = _read_tracklets_file_per_line(filepath)
+    return np.linalg.norm(np.dot(D.T, D))
+
+
+def _get_tracklet_channels_per_tracklet(data_obj, data_trj):
+    # the former implementation in tracklet_clustering._cluster
+    D = dict()
+    for k in xrange(data_obj.shape[0]):
+        T = np.reshape(data_trj[k], (data_trj.shape[1]/2,2))
+        D.setdefault('x',[]).append( T[1:,0] )
+        D.setdefault('y',[]).append( T[1:,1] )
+        D.setdefault('t',[]).append( data_obj[k,0] - np.linspace(T.shape[0]-1, 0, T.shape[0]) )
+        D.setdefault('v_x',[]).append( T[1:,0] - T[:-1,0] )
+        D.setdefault('v_y',[]).append( T[1:,1] - T[:-1,1] )
+    return D
+
+
+def _multimodal_product_kernel_per_channel(D, primary_inds, secondary_inds):
+    # the former implementation of tracklet_clustering.multimodal_product_kernel (without given medians)
+    from sklearn.metrics import pairwise
+    K = np.ones((len(primary_inds), len(secondary_inds)), dtype=np.float32)
+    medians = []
+    for channel_t in ['x','y','t','v_x','v_y']:
+        S = pairwise.pairwise_distances(X=D[channel_t][primary_inds], Y=D[channel_t][secondary_inds], metric='euclidean')
+        median = np.nanmedian(S[S!=0])
+        medians.append(median)
+        gamma = 1.0/(2*median) if not np.isnan(median) and median != 0.0 else 0.0
+        K = np.multiply(K, np.exp(-gamma * np.power(S,2)))
+    return K, medians
+
+
+def _read_tracklets_file_per_line(filepath):
+    # the former implementation in tracklet_extraction._extract
+    data = []
+    with open(filepath, 'rb') as f:
+        for line in f:
+            data.append(np.array(line.strip().split('\t'), dtype=np.float32))
+    return np.vstack(data)
+
+
+def _build_sym_geom_adjacency_loop(geoms, max_gnn=100):
+    # the former implementation of spectral_division.build_sym_geom_adjacency
+    import spectral_division
+    from scipy.sparse.csgraph import connected_components
+    min_gnn = spectral_division.INTERNAL_PARAMETERS['min_geom_neighbors']
+    for n_neighbors in range(min_gnn, max_gnn + 1):
+        C = spectral_division.build_geom_neighbor_graph(geoms, n_neighbors)  # (a new index every time)
+        neighbs = C.indices.reshape((geoms.shape[0], n_neighbors))
+        C = C + C.T
+        C.data[:] = 1
+        n_comp, _ = connected_components(C, directed=False)
+        if n_comp == 1:
+            break
+    return n_comp, C, neighbs
+
+
+def _generate_synthetic_int_paths(num_rows, num_leafs=None, depth=None):
+    # the leaf paths of the tracklets of a random (unbalanced) clustering tree, with (at least) a number of leafs or
+    # up to a depth (splitting a deepest leaf a third of the times)
+    leafs = [1]
+    while (num_leafs is not None and len(leafs) < num_leafs) or \
+            (depth is not None and max(leafs).bit_length() - 1 < depth):
+        if depth is not None and np.random.rand() < 1./3:
+            deepest = [i for i, p in enumerate(leafs) if p.bit_length() == max(leafs).bit_length()]
+            p = leafs.pop(deepest[np.random.randint(len(deepest))])
+        else:
+            p = leafs.pop(np.random.randint(len(leafs)))
+        leafs += [2 * p, 2 * p + 1]
+    return np.array(leafs, dtype=np.int64)[np.random.randint(0, len(leafs), size=num_rows)]
+
+
+def _get_codewords_brute_force(codebook, X, block_rows=10000):
+    # nearest codeword (squared euclidean distance) of every row of X
+    words = np.empty((len(X),), dtype=np.int64)
+    sqnorms = np.sum(codebook.astype(np.float64)**2, axis=1)
+    for st in xrange(0, len(X), block_rows):
+        words[st:st+block_rows] = np.argmin(sqnorms[np.newaxis,:] - 2 * np.dot(X[st:st+block_rows], codebook.T), axis=1)
+    return words
+
+
+def _get_fisher_reference():
+    # ynumpy.fisher if yael is installed, otherwise an independent implementation of the formulas of its gmm_fisher
+    try:
+        from yael import ynumpy
+    except ImportError:
+        return 'naive gmm_fisher', _gmm_fisher_naive
+    return 'ynumpy.fisher', lambda gmm, X, include: \
+        ynumpy.fisher(tuple(np.asarray(a, dtype=np.float32) for a in gmm), np.ascontiguousarray(X, dtype=np.float32),
+                      include)
+
+
+def _gmm_fisher_naive(gmm, X, include):
+    # yael's gmm_fisher as it is written: component by component, on the residuals of the tracklets (not on sums)
+    w, mu, sigma = [np.asarray(a, dtype=np.float64) for a in gmm]
+    X = np.asarray(X, dtype=np.float64)
+    n, K = len(X), len(w)
+
+    logp = np.empty((n, K), dtype=np.float64)
+    for j in xrange(K):
+        logp[:,j] = np.log(w[j]) - 0.5 * np.sum(np.log(2 * np.pi * sigma[j])) \
+                    - 0.5 * np.sum((X - mu[j])**2 / sigma[j], axis=1)
+    P = np.exp(logp - np.max(logp, axis=1)[:,np.newaxis])
+    P /= np.sum(P, axis=1)[:,np.newaxis]
+
+    fv = []
+    if 'w' in include:
+        for j in xrange(1, K):
+            fv.append([np.sum(P[:,j] / w[j] - P[:,0] / w[0]) / np.sqrt(n * (1. / w[j] + 1. / w[0]))])
+    if 'mu' in include:
+        for j in xrange(K):
+            accu = np.sum(P[:,j,np.newaxis] * (X - mu[j]) / sigma[j], axis=0)
+            fv.append(accu / np.sqrt(n * w[j] / sigma[j]))
+    if 'sigma' in include:
+        for j in xrange(K):
+            accu = np.sum(P[:,j,np.newaxis] * ((X - mu[j])**2 / sigma[j] - 1) / np.sqrt(sigma[j]), axis=0)
+            fv.append(accu / np.sqrt(2 * n * w[j] / sigma[j]))
+
+    return np.concatenate(fv)  # (in float64, unlike yael's, so that the differences are not hidden by rounding)
+
+
+def _get_pooled_sequences_reference(X):
+    # the former pooling of videodarwin._darwin (and its rootSIFT and normalizeL2, through np.matrix)
+    T = X.shape[0]
+    one_to_T = np.linspace(1,T,T)[:,np.newaxis]
+    pooled = []
+    for V in (np.cumsum(X,axis=0) / one_to_T, np.cumsum(np.flipud(X),axis=0) / one_to_T):
+        V = np.matrix(np.multiply(np.sign(V), np.sqrt(np.abs(V))))
+        pooled.append(V / np.sqrt(np.sum(np.multiply(V,V), axis=1)))
+    return pooled
+
+
+def _measure_peak_memory(func):
+    # run func in a forked child: the time it takes and its peak of resident memory (above the one at the fork)
+    import os
+    import resource
+    import cPickle
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        st_time = time.time()
+        func()
+        elapsed_time = time.time() - st_time
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(w, cPickle.dumps((elapsed_time, (rss_after - rss_before) * 1024)))  # (ru_maxrss in KB)
+        os._exit(0)
+
+    os.close(w)
+    with os.fdopen(r, 'rb') as f:
+        elapsed_time, peak = cPickle.loads(f.read())
+    os.waitpid(pid, 0)
+    return elapsed_time, peak
+
+
+def _reconstruct_tree_from_leafs(leafs):
+    # the former implementation of spectral_division.reconstruct_tree_from_leafs (a dict of descendants)
+    from Queue import PriorityQueue
+    h = dict()
+    q = PriorityQueue()
+    for path in leafs:
+        parent_path = int(path/2)
+        if not parent_path in h and parent_path > 1:
+            q.put(-parent_path)
+        h.setdefault(parent_path, []).append(path)
+    while not q.empty():
+        path = -q.get()
+        parent_path = int(path/2)
+        if not parent_path in h and parent_path > 1:
+            q.put(-parent_path)
+        h.setdefault(parent_path, [])
+        h[parent_path] += ([path] + h[path])
+    h.update(dict((i,[i]) for i in leafs))
+    return h
+
+
+def _split_threshold_per_threshold(tree, node):
+    # the former implementation of spectral_division.SpectralTree._split_threshold
+    import spectral_division
+    if tree.n_clusters >= tree.min_leaves and node.size <= tree.max_leaf_size:
+        force_split, best_score = False, node.score
+    else:
+        force_split, best_score = True, None
+
+    left, right = None, None
+    for _vec in range(tree.n_vec):
+        for _t in tree._get_candidate_thresholds(node, _vec):
+            below_thresh = tree.E[node.ids, _vec] < _t
+            _lids = node.ids[below_thresh]
+            _rids = node.ids[np.logical_not(below_thresh)]
+            if len(_lids) >= tree.min_leaf_size and len(_rids) >= tree.min_leaf_size:
+                _sl = tree.get_tube_score(_lids)
+                _sr = tree.get_tube_score(_rids)
+                split_score = min(_sl, _sr)
+                if best_score is None or split_score > best_score:
+                    best_score = split_score
+                    node.has_children = True
+                    node.thresh = _t
+                    left = spectral_division.SpectralNode(_lids, _vec, score=_sl, name=node.name + '0')
+                    right = spectral_division.SpectralNode(_rids, _vec, score=_sr, name=node.name + '1')
+        if node.has_children and (_vec > 0 or not force_split):
+            break
+
+    return left, right
+
+
+# ==============================================================================
+# Main
+# ==============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the micro-benchmarks of the framework.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    p = subparsers.add_parser('parser', help='DenseTrackStab output parsing (tracklet_extraction).')
+    p.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 500000], help='Number of tracklets.')
+    p.add_argument('--max-per-line', dest='max_per_line', type=int, default=500000,
+                   help='Do not run the (slow) per-line parser above this number of tracklets.')
+    p.set_defaults(func=bench_parser)
+
+    p = subparsers.add_parser('stream', help='Streaming of DenseTrackStab output (tracklet_extraction).')
+    p.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000], help='Number of tracklets.')
+    p.set_defaults(func=bench_stream)
+
+    p = subparsers.add_parser('density', help='Low density tracklets filtering (tracklet_extraction).')
+    p.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 500000], help='Number of tracklets.')
+    p.add_argument('--num-frames', dest='num_frames', type=int, default=1000, help='Number of frames of the video.')
+    p.add_argument('--max-per-tracklet', dest='max_per_tracklet', type=int, default=100000,
+                   help='Do not run the (slow) per-tracklet filter above this number of tracklets.')
+    p.set_defaults(func=bench_density)
+
+    p = subparsers.add_parser('scaling', help='Scaling of the parallelization backends (parallelism).')
+    p.add_argument('--backends', nargs='+', default=['threading', 'loky', 'hybrid'], help='Backends to compare.')
+    p.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8], help='Number of workers.')
+    p.add_argument('--num-videos', dest='num_videos', type=int, default=32, help='Number of videos to process.')
+    p.add_argument('--num-rows', dest='num_rows', type=int, default=5000, help='Number of tracklets per video.')
+    p.set_defaults(func=bench_scaling)
+
+    p = subparsers.add_parser('schedule', help='Longest-first scheduling of the videos (parallelism).')
+    p.add_argument('--workers', nargs='+', type=int, default=[4, 8, 16], help='Number of workers.')
+    p.add_argument('--num-videos', dest='num_videos', type=int, default=100, help='Number of videos to process.')
+    p.add_argument('--unit', type=float, default=0.05, help='Minimum cost of a video (in secs).')
+    p.set_defaults(func=bench_schedule)
+
+    p = subparsers.add_parser('channels', help='Tracklets\' channels construction (tracklet_clustering).')
+    p.add_argument('--sizes', nargs='+', type=int, default=[50000, 100000, 300000], help='Number of tracklets.')
+    p.set_defaults(func=bench_channels)
+
+    p = subparsers.add_parser('kernel', help='Multimodal product kernel (tracklet_clustering).')
+    p.add_argument('--sizes', nargs='+', type=int, default=[20000, 50000], help='Number of tracklets.')
+    p.add_argument('--sample-ratio', dest='sample_ratio', type=float, default=0.02,
+                   help='Fraction of tracklets in the Nystrom sample.')
+    p.set_defaults(func=bench_kernel)
+
+    p = subparsers.add_parser('eigen', help='Eigen-solvers of the Nystrom embedding (spectral_division).')
+    p.add_argument('--sizes', nargs='+', type=int, default=[500, 1000, 2000, 5000], help='Nystrom sample sizes (n).')
+    p.add_argument('--ratio', type=int, default=4, help='Number of out-of-sample points per sample point.')
+    p.set_defaults(func=bench_eigen)
+
+    p = subparsers.add_parser('split', help='Thresholding split of the spectral tree (spectral_division).')
+    p.add_argument('--sizes', nargs='+', type=int, default=[10000, 50000, 200000], help='Number of points.')
+    p.add_argument('--num-vecs', dest='num_vecs', type=int, default=5, help='Number of eigen-vectors.')
+    p.add_argument('--num-threshs', dest='num_threshs', type=int, default=10, help='Number of thresholds.')
+    p.set_defaults(func=bench_split)
+
+    p = subparsers.add_parser('neighbors', help='Sparsest connected geometrical adjacency (spectral_division).')
+    p.add_argument('--sizes', nargs='+', type=int, default=[10000, 50000, 200000], help='Number of points.')
+    p.add_argument('--num-blobs', dest='num_blobs', type=int, default=20, help='Number of blobs of points.')
+    p.add_argument('--spread', type=float, default=4., help='Spread of the blobs (w.r.t. their own std).')
+    p.set_defaults(func=bench_neighbors)
+
+    p = subparsers.add_parser('membership', help='Tracklets of the nodes of the clustering trees (cluster_tree).')
+    p.add_argument('--sizes', nargs='+', type=int, default=[50000, 200000], help='Number of tracklets.')
+    p.add_argument('--num-leafs', dest='num_leafs', nargs='+', type=int, default=[16, 64, 256], help='Number of leafs.')
+    p.set_defaults(func=bench_membership)
+
+    p = subparsers.add_parser('bovw_tree', help='BoVWs of the nodes of the clustering trees (tracklet_representation).')
+    p.add_argument('--depths', nargs='+', type=int, default=[5, 10, 15], help='Depths of the trees.')
+    p.add_argument('--num-rows', dest='num_rows', type=int, default=100000, help='Number of tracklets.')
+    p.add_argument('--num-dims', dest='num_dims', type=int, default=48, help='Number of dimensions of the features.')
+    p.add_argument('--num-words', dest='num_words', type=int, default=1000, help='Number of codewords.')
+    p.set_defaults(func=bench_bovw_tree)
+
+    p = subparsers.add_parser('fv_tree', help='FVs of the nodes of the clustering trees (tracklet_representation).')
+    p.add_argument('--depths', nargs='+', type=int, default=[5, 10, 15], help='Depths of the trees.')
+    p.add_argument('--num-rows', dest='num_rows', type=int, default=50000, help='Number of tracklets.')
+    p.add_argument('--num-dims', dest='num_dims', type=int, default=48, help='Number of dimensions of the features.')
+    p.add_argument('--num-components', dest='num_components', type=int, default=64, help='Number of GMM components.')
+    p.set_defaults(func=bench_fv_tree)
+
+    p = subparsers.add_parser('vd_tree', help='Per-frame FVs of the nodes of the clustering trees (tracklet_representation).')
+    p.add_argument('--depths', nargs='+', type=int, default=[5, 10, 15], help='Depths of the trees.')
+    p.add_argument('--num-rows', dest='num_rows', type=int, default=20000, help='Number of tracklets.')
+    p.add_argument('--num-frames', dest='num_frames', type=int, default=100, help='Number of frames.')
+    p.add_argument('--num-dims', dest='num_dims', type=int, default=48, help='Number of dimensions of the features.')
+    p.add_argument('--num-components', dest='num_components', type=int, default=32, help='Number of GMM components.')
+    p.set_defaults(func=bench_vd_tree)
+
+    p = subparsers.add_parser('darwin', help='VideoDarwin of many sequences (videodarwin).')
+    p.add_argument('--dims', nargs='+', type=int, default=[64, 4096, 100000], help='Dimensions of the sequences.')
+    p.add_argument('--num-seqs', dest='num_seqs', type=int, default=10000, help='Number of sequences.')
+    p.add_argument('--min-length', dest='min_length', type=int, default=20, help='Minimum length of the sequences.')
+    p.add_argument('--max-length', dest='max_length', type=int, default=500, help='Maximum length of the sequences.')
+    p.add_argument('--chunk-size', dest='chunk_size', type=int, default=100, help='Number of sequences in memory at once.')
+    p.add_argument('--num-checks', dest='num_checks', type=int, default=20, help='Number of sequences checked with tol=1e-10.')
+    p.set_defaults(func=bench_darwin)
+
+    p = subparsers.add_parser('ridge', help='Accuracy of the closed-form ridge VideoDarwin (videodarwin).')
+    p.add_argument('--feats-path', dest='feats_path', default=None, help='Stored per-frame features (otherwise synthetic).')
+    p.add_argument('--num-videos', dest='num_videos', type=int, default=None, help='Number of stored videos.')
+    p.add_argument('--num-seqs', dest='num_seqs', type=int, default=100, help='Number of synthetic sequences.')
+    p.add_argument('--dim', type=int, default=32768, help='Dimension of the synthetic sequences.')
+    p.add_argument('--min-length', dest='min_length', type=int, default=20, help='Minimum length of the sequences.')
+    p.add_argument('--max-length', dest='max_length', type=int, default=300, help='Maximum length of the sequences.')
+    p.set_defaults(func=bench_ridge)
+
+    p = subparsers.add_parser('pooling', help='Pooling of the long sequences of the videodarwin (videodarwin).')
+    p.add_argument('--lengths', nargs='+', type=int, default=[1000, 5000], help='Lengths of the sequences.')
+    p.add_argument('--num-dims', dest='num_dims', type=int, default=8192, help='Dimension of the sequences.')
+    p.set_defaults(func=bench_pooling)
+
+    p = subparsers.add_parser('branches', help='VideoDarwin of the branches of the trees (kernels, ATNBEP).')
+    p.add_argument('--num-leafs', dest='num_leafs', nargs='+', type=int, default=[50, 200, 500], help='Number of leafs of the trees.')
+    p.add_argument('--num-dims', dest='num_dims', type=int, default=4000, help='Dimension of the representations of the nodes.')
+    p.set_defaults(func=bench_branches)
+
+    args = parser.parse_args()
+    args.func(args)
+    sys.stdout.flush()
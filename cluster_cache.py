@@ -0,0 +1,137 @@
+__author__ = 'aclapes'
+
+'''Content-addressed cache of the clustering results.
+
+The entries are keyed by a hash of what they are computed from: the tracklets (obj and trj) and the parameters
+of every step, including the random seed. The embedding of a video (the costly part) and the clustering tree
+obtained from it are cached separately, so changing a parameter of the tree split (e.g. min_tube_size) only
+recomputes the trees, and results never outlive the parameters they were computed with.
+
+    <cache_path>/embeddings/<key>.npz
+    <cache_path>/clusters/<key>.pkl
+
+'''
+
+import cPickle
+import hashlib
+import tempfile
+from os import makedirs, rename, fdopen, chmod
+from os.path import getsize, isfile, join, dirname
+
+import numpy as np
+
+
+ENTRY_TYPES = dict(
+    embeddings = '.npz',
+    clusters = '.pkl',
+)
+
+
+# ==============================================================================
+# Main functions
+# ==============================================================================
+
+def get_key(parent_key=None, arrays=None, params=None):
+    """
+    Hash the content an entry is computed from.
+    :param parent_key: the key of the entry it is computed from (if any).
+    :param arrays: a list of arrays (their shape, dtype and data are hashed).
+    :param params: a dictionary of parameters (their repr is hashed, so use built-in types).
+    :return: a hexadecimal digest.
+    """
+    h = hashlib.sha1()
+    if parent_key is not None:
+        h.update(parent_key)
+    for a in (arrays if arrays is not None else []):
+        a = np.ascontiguousarray(a)
+        h.update(repr((a.shape, a.dtype.str)))
+        h.update(a.data)
+    if params is not None:
+        h.update(repr(sorted(params.items())))
+    return h.hexdigest()
+
+
+def new_stats():
+    """
+    Get the (empty) statistics of the accesses to the cache, per entry type.
+    """
+    return {entry_t : dict(hits=0, misses=0, bytes_read=0, bytes_written=0) for entry_t in ENTRY_TYPES}
+
+
+def merge_stats(stats_list):
+    """
+    Sum up the statistics of several accesses to the cache (e.g. the ones of the different workers).
+    """
+    total = new_stats()
+    for stats in stats_list:
+        for entry_t, counts in stats.iteritems():
+            for k, v in counts.iteritems():
+                total[entry_t][k] += v
+    return total
+
+
+def format_stats(stats):
+    return '; '.join(['%s: %d hits, %d misses, %.1f MB read, %.1f MB written'
+                      % (entry_t, s['hits'], s['misses'], s['bytes_read'] / 2.**20, s['bytes_written'] / 2.**20)
+                      for entry_t, s in sorted(stats.iteritems())])
+
+
+def load_entry(cache_path, entry_t, key, stats=None):
+    """
+    Load an entry from the cache.
+    :param cache_path: the root of the cache.
+    :param entry_t: 'embeddings' (a dictionary of arrays) or 'clusters' (any picklable object).
+    :param key: see get_key.
+    :param stats: statistics to update (see new_stats).
+    :return: the entry, or None if not cached.
+    """
+    filepath = _get_entry_filepath(cache_path, entry_t, key)
+    if not isfile(filepath):
+        if stats is not None:
+            stats[entry_t]['misses'] += 1
+        return None
+
+    if entry_t == 'embeddings':
+        with np.load(filepath) as npz:
+            entry = {k : npz[k] for k in npz.files}
+    else:
+        with open(filepath, 'rb') as f:
+            entry = cPickle.load(f)
+
+    if stats is not None:
+        stats[entry_t]['hits'] += 1
+        stats[entry_t]['bytes_read'] += getsize(filepath)
+    return entry
+
+
+def save_entry(cache_path, entry_t, key, entry, stats=None):
+    """
+    Store an entry in the cache (see load_entry).
+    """
+    try:
+        makedirs(join(cache_path, entry_t))
+    except OSError:
+        pass
+
+    # write to a temporary file first, so that concurrent or interrupted writes never leave a truncated entry (unique
+    # per writer, so that two writers of the same entry never rename each other's partial file)
+    filepath = _get_entry_filepath(cache_path, entry_t, key)
+    fd, tmp_filepath = tempfile.mkstemp(suffix='.tmp', dir=dirname(filepath))
+    with fdopen(fd, 'wb') as f:
+        if entry_t == 'embeddings':
+            np.savez(f, **entry)
+        else:
+            cPickle.dump(entry, f, protocol=cPickle.HIGHEST_PROTOCOL)
+    chmod(tmp_filepath, 0644)  # (mkstemp's are only readable by their owner)
+    rename(tmp_filepath, filepath)
+
+    if stats is not None:
+        stats[entry_t]['bytes_written'] += getsize(filepath)
+
+
+# ==============================================================================
+# Helper functions
+# ==============================================================================
+
+def _get_entry_filepath(cache_path, entry_t, key):
+    return join(cache_path, entry_t, key + ENTRY_TYPES[entry_t])
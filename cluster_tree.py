@@ -0,0 +1,155 @@
+__author__ = 'aclapes'
+
+'''Compact representation of the clustering trees.
+
+The nodes of a tree are identified by their paths: the root is 1 and the children of node p are 2p (left) and
+2p+1 (right), as in the int_paths of the tracklets (spectral_division). The nodes are stored in depth-first
+pre-order, so that the descendants of a node, and the leafs among them, are contiguous ranges.
+
+'''
+
+import numpy as np
+from scipy import sparse
+
+
+class ClusterTree(object):
+    """
+    A binary tree given by its leafs.
+
+    Attributes:
+    node_ids: the paths of the nodes, in depth-first pre-order (the root first).
+    parents: the position (in node_ids) of the parent of every node (-1 for the root).
+    first_children: the position of the first child of every node (-1 for the leafs).
+    subtree_ends: the descendants of node i are the nodes i+1, ..., subtree_ends[i]-1.
+    leafs: the paths of the leafs, in depth-first order.
+    leaf_ranges: the leafs of the subtree of node i are leafs[leaf_ranges[i,0]:leaf_ranges[i,1]].
+    """
+
+    def __init__(self, leafs):
+        """
+        :param leafs: the paths of the leafs (e.g. np.unique(int_paths)). Paths lower than 1 (outliers) are ignored.
+        """
+        leafs = set([int(p) for p in leafs if p >= 1])
+
+        # the leafs and all their ancestors
+        nodes = set()
+        for p in leafs:
+            while p >= 1 and p not in nodes:
+                nodes.add(p)
+                p >>= 1
+
+        # pre-order: sort by the paths left-aligned to the deepest level, ancestors first
+        depth = max([p.bit_length() for p in nodes]) if len(nodes) > 0 else 0
+        node_ids = sorted(nodes, key=lambda p: (p << (depth - p.bit_length()), p.bit_length()))
+        index = dict((p, i) for i, p in enumerate(node_ids))
+
+        n_nodes = len(node_ids)
+        self.node_ids = np.array(node_ids, dtype=np.int64)
+        self.parents = np.array([index.get(p >> 1, -1) for p in node_ids], dtype=np.int32)
+        self.first_children = -np.ones((n_nodes,), dtype=np.int32)
+        self.subtree_ends = np.arange(1, n_nodes + 1, dtype=np.int32)
+        for i in xrange(n_nodes - 1, 0, -1):  # (children come after their parents)
+            parent = self.parents[i]
+            self.first_children[parent] = i  # the last one seen in reverse order is the first one
+            self.subtree_ends[parent] = max(self.subtree_ends[parent], self.subtree_ends[i])
+
+        is_leaf = self.first_children < 0
+        n_leafs_before = np.concatenate([[0], np.cumsum(is_leaf)]).astype(np.int32)
+        self.leafs = self.node_ids[is_leaf]
+        self.leaf_ranges = np.vstack([n_leafs_before[:-1], n_leafs_before[self.subtree_ends]]).T
+
+        self._index = index
+        self._leafs_order = np.argsort(self.leafs)  # (to look for the leafs' positions)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node_id):
+        return node_id in self._index
+
+    def keys(self):
+        return [int(p) for p in self.node_ids]
+
+    def index(self, node_id):
+        """
+        Get the position of a node in node_ids.
+        """
+        return self._index[node_id]
+
+    def is_leaf(self, node_id):
+        return self.first_children[self._index[node_id]] < 0
+
+    def get_descendants(self, node_id):
+        """
+        Get the paths of the descendants of a node (not including itself), in pre-order.
+        """
+        i = self._index[node_id]
+        return self.node_ids[i+1:self.subtree_ends[i]]
+
+    def get_leafs(self, node_id):
+        """
+        Get the paths of the leafs of the subtree of a node (itself, if it is a leaf).
+        """
+        st, en = self.leaf_ranges[self._index[node_id]]
+        return self.leafs[st:en]
+
+    def get_leaf_positions(self, int_paths):
+        """
+        Get the position in leafs of the leaf of every tracklet (-1 if not a leaf, e.g. an outlier).
+        :param int_paths: the paths of the leafs of the tracklets.
+        :return:
+        """
+        int_paths = np.asarray(int_paths, dtype=np.int64)
+        if len(self.leafs) == 0:
+            return -np.ones(int_paths.shape, dtype=np.int64)
+        sorted_leafs = self.leafs[self._leafs_order]
+        pos = np.minimum(np.searchsorted(sorted_leafs, int_paths), len(sorted_leafs) - 1)
+        return np.where(sorted_leafs[pos] == int_paths, self._leafs_order[pos], -1)
+
+    def get_node_ranges(self, int_paths):
+        """
+        Sort the tracklets by leaf (in depth-first order), so that the tracklets of every node are contiguous.
+        :param int_paths: the paths of the leafs of the N tracklets.
+        :return order, ranges: the tracklets of node i are order[ranges[i,0]:ranges[i,1]] (the ones not in any leaf,
+        e.g. outliers, go last).
+        """
+        leaf_pos = self.get_leaf_positions(int_paths)
+        leaf_pos[leaf_pos < 0] = len(self.leafs)
+        order = np.argsort(leaf_pos, kind='mergesort')  # (stable: in their original order within a leaf)
+        n_before = np.concatenate([[0], np.cumsum(np.bincount(leaf_pos, minlength=len(self.leafs) + 1))])
+        return order, n_before[self.leaf_ranges]
+
+    def sum_over_subtrees(self, leaf_values):
+        """
+        Sum some additive values of the leafs (e.g. histograms) up the tree, bottom-up.
+        :param leaf_values: a len(leafs)-by-... array (in the order of leafs).
+        :return: a len(self)-by-... array with the sums over the leafs of the subtree of every node.
+        """
+        leaf_values = np.asarray(leaf_values)
+        sums = np.zeros((len(self),) + leaf_values.shape[1:], dtype=leaf_values.dtype)
+        sums[self.first_children < 0] = leaf_values
+        for i in xrange(len(self) - 1, 0, -1):  # (children come after their parents)
+            sums[self.parents[i]] += sums[i]
+        return sums
+
+    def get_membership(self, int_paths):
+        """
+        Get the nodes every tracklet belongs to (the ones from its leaf up to the root).
+        :param int_paths: the paths of the leafs of the N tracklets.
+        :return: a N-by-len(self) sparse boolean matrix (CSC, so the column of a node lists its tracklets, sorted).
+        """
+        leaf_pos = self.get_leaf_positions(int_paths)
+        rows = np.where(leaf_pos >= 0)[0]
+        L = sparse.csr_matrix((np.ones((len(rows),), dtype=np.int8), (rows, leaf_pos[rows])),
+                              shape=(len(leaf_pos), len(self.leafs)))
+
+        # leafs-by-nodes: the subtree of node i covers the leafs in leaf_ranges[i]
+        counts = self.leaf_ranges[:,1] - self.leaf_ranges[:,0]
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        indices = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - self.leaf_ranges[:,0], counts)
+        M = sparse.csc_matrix((np.ones((indptr[-1],), dtype=np.int8), indices, indptr),
+                              shape=(len(self.leafs), len(self)))
+
+        membership = (L * M).tocsc().astype(bool)
+        membership.sort_indices()
+        return membership
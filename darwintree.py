@@ -1,55 +1,136 @@
 __author__ = 'aclapes'
 
 from os.path import isfile, isdir, exists, join, splitext, basename, dirname
-from os import makedirs
+from os import makedirs, rename, fdopen, chmod, fstat
 import cPickle
+import pickletools
+import tempfile
+import sys
 import time
 import numpy as np
+from joblib import delayed
 
-from videodarwin import darwin
+import videodarwin
+from parallelism import run_parallel, get_files_cost
 
 INTERNAL_PARAMETERS = dict(
-
+    darwin_solver = 'liblinear',  # see videodarwin.darwin ('exact' instead of 'liblinear' with darwin_batch)
+    # solve all the nodes of a video at once with videodarwin.darwin_batch. Its solutions are exact, so they differ
+    # from the ones of videodarwin.darwin (LinearSVR, tol=0.001) by up to ~20%: all the outputs must be recomputed
+    # if this is changed, not mixed with the existing ones
+    darwin_batch = False,
 )
 
-def darwin(fullfeatnames, st, num_videos, darwins_path):
-    if not exists(darwins_path):
-        makedirs(darwins_path)
-
+def darwin(fullfeatnames, st, num_videos, darwins_path, nt=1, backend='loky', verbose=True):
+    '''
+    Compute the videodarwin of the root and every node of the videos' trees, in parallel (a job per video). The
+    outputs are written atomically, and existing ones are checked (cheaply, see _is_valid_output) before being
+    skipped, so the stage can be interrupted and resumed.
+    :param fullfeatnames: a dictionary with the per-frame features' files (pickles with 'X' and 'tree_perframe')
+    of every feature type.
+    :param st: the first video to process.
+    :param num_videos: the number of videos to process (None for all from st).
+    :param darwins_path: where to write the videodarwins (a subdirectory per feature type).
+    :param nt: the number of workers.
+    :param backend: see parallelism.run_parallel.
+    :return:
+    '''
     for feat_t in fullfeatnames:
-        # node_darwins[feat_t] = dict()
-
-        if not exists(join(darwins_path, feat_t)):
+        try:
             makedirs(join(darwins_path, feat_t))
-
-        for featname in fullfeatnames[feat_t]:
-            output_filepath = join(darwins_path, feat_t, basename(featname))
-            if isfile(output_filepath):
-                print('%s -> OK' % (featname))
-                continue
-
-            start_time = time.time()
-
-            with open(featname, 'rb') as f:
-                data = cPickle.load(f)
-
-            # compute VD
-            node_darwins = dict()
-            node_darwins[1] = darwin(data['X'])
-            for id, X in data['tree_perframe'].iteritems():
-                node_darwins[id] = darwin(X)
-
-            # construct a list of edge pairs for easy access
-
-            with open(output_filepath, 'wb') as f:
-                cPickle.dump(dict(node_darwins=node_darwins), f)
-
-            elapsed_time = time.time() - start_time
-            print('%s -> DONE (in %.2f secs)' % (output_filepath, elapsed_time))
+        except OSError:
+            pass
+
+        featnames = fullfeatnames[feat_t][st:(st + num_videos) if num_videos is not None else None]
+        output_filepaths = [join(darwins_path, feat_t, basename(featname)) for featname in featnames]
+
+        # (re)compute the missing or invalid ones
+        inds = []
+        for i, output_filepath in enumerate(output_filepaths):
+            if _is_valid_output(output_filepath):
+                if verbose:
+                    print('%s -> OK' % (featnames[i]))
+            else:
+                inds.append(i)
+
+        stats = dict()
+        ret = run_parallel([delayed(_darwin)(featnames[i], output_filepaths[i], verbose=verbose) for i in inds],
+                           nt=nt, backend=backend, costs=get_files_cost([featnames[i] for i in inds]),
+                           name='darwin', stats=stats, verbose=verbose)
+
+        # report the throughput (to size the pool)
+        ret = [r for r in ret if r is not None]
+        if verbose and len(ret) > 0:
+            elapsed_times, n_nodes = zip(*ret)
+            print('[darwin] %s: %d videos (%d nodes) in %.2f secs: %.2f videos/sec, %.1f nodes/sec '
+                  '(per video: %.2f secs on average, %.2f max)'
+                  % (feat_t, len(ret), sum(n_nodes), stats['makespan'], len(ret) / stats['makespan'],
+                     sum(n_nodes) / stats['makespan'], np.mean(elapsed_times), np.max(elapsed_times)))
 
     return None
 
 
 # ==============================================================================
 # Helper functions
-# ==============================================================================
\ No newline at end of file
+# ==============================================================================
+
+def _darwin(featname, output_filepath, verbose=True):
+    '''
+    Compute the videodarwins of a video (its root and all its nodes, in one batch if
+    INTERNAL_PARAMETERS['darwin_batch']) and write them atomically.
+    :return: the elapsed time and the number of nodes, or None if the features could not be read.
+    '''
+    start_time = time.time()
+
+    try:
+        with open(featname, 'rb') as f:
+            data = cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        sys.stderr.write('[Error] Reading features file: ' + featname + '\n')
+        sys.stderr.flush()
+        return None
+
+    # compute VD
+    ids = [1] + [id for id in data['tree_perframe'].keys()]
+    Xs = [data['X']] + [data['tree_perframe'][id] for id in ids[1:]]
+    if INTERNAL_PARAMETERS['darwin_batch']:
+        solver = 'exact' if INTERNAL_PARAMETERS['darwin_solver'] == 'liblinear' else INTERNAL_PARAMETERS['darwin_solver']
+        node_darwins = dict(zip(ids, videodarwin.darwin_batch(Xs, solver=solver)))
+    else:
+        node_darwins = dict(zip(ids, [videodarwin.darwin(X, solver=INTERNAL_PARAMETERS['darwin_solver']) for X in Xs]))
+
+    # write to a temporary file first, so that an interrupted write never leaves a truncated output behind
+    # (a unique one, so that concurrent runs do not write to the same one)
+    fd, tmp_filepath = tempfile.mkstemp(suffix='.tmp', dir=dirname(output_filepath))
+    with fdopen(fd, 'wb') as f:
+        cPickle.dump(dict(node_darwins=node_darwins), f, protocol=cPickle.HIGHEST_PROTOCOL)
+    chmod(tmp_filepath, 0644)
+    rename(tmp_filepath, output_filepath)
+
+    elapsed_time = time.time() - start_time
+    if verbose:
+        print('%s -> DONE (%d nodes in %.2f secs)' % (output_filepath, len(ids), elapsed_time))
+
+    return elapsed_time, len(ids)
+
+
+def _is_valid_output(output_filepath):
+    # the outputs are written atomically (see _darwin), so an existing one can only be invalid if it was written
+    # by a former run, when they were not. It is valid if it is a well-formed pickle ending exactly at its STOP:
+    # its opcodes are walked (pickletools.genops) without building any object, which detects a truncated or
+    # overlong output. Corrupted bytes within the pickled data (e.g. the arrays' buffers) are not detected, nor is
+    # a well-formed pickle of something else than a dictionary of node darwins
+    if not isfile(output_filepath):
+        return False
+    try:
+        with open(output_filepath, 'rb') as f:
+            opcode = None
+            for opcode, arg, pos in pickletools.genops(f):
+                pass
+            if opcode is not None and opcode.name == 'STOP' and pos + 1 == fstat(f.fileno()).st_size:
+                return True
+    except (IOError, ValueError):  # (genops raises ValueError if truncated or not a pickle)
+        pass
+    sys.stderr.write('[Warning] Invalid output, recomputing it: ' + output_filepath + '\n')
+    sys.stderr.flush()
+    return False
@@ -0,0 +1,170 @@
+__author__ = 'aclapes'
+
+'''Fisher vectors from additive sufficient statistics.
+
+The Fisher vector of a set of tracklets (yael's gmm_fisher) only depends on the number of tracklets and the sums,
+over them, of the GMM posteriors (zeroth-order), the posteriors times the features (first-order) and the posteriors
+times the squared features (second-order). These statistics are additive, so the ones of a tree node are the sums of
+the ones of its leafs: the posteriors are computed once per tracklet, whatever the depth of the tree.
+
+The GMMs are the (w, mu, sigma) tuples of ynumpy.gmm_learn (sigma being the diagonal variances).
+
+'''
+
+import numpy as np
+
+
+# ==============================================================================
+# Main functions
+# ==============================================================================
+
+def get_posteriors(gmm, X, block_rows=10000):
+    """
+    Compute the posterior probabilities of the GMM components.
+    :param gmm: (w, mu, sigma).
+    :param X: a N-by-D matrix.
+    :return: a N-by-K matrix.
+    """
+    w, mu, sigma = [np.asarray(a, dtype=np.float64) for a in gmm]
+    inv_sigma = 1. / sigma
+    # the log-likelihoods of the diagonal gaussians, expanded to matrix products
+    log_consts = np.log(w) - 0.5 * (np.sum(np.log(2 * np.pi * sigma), axis=1) + np.sum(mu**2 * inv_sigma, axis=1))
+
+    P = np.empty((len(X), len(w)), dtype=np.float64)
+    for st in xrange(0, len(X), block_rows):
+        x = np.asarray(X[st:st+block_rows], dtype=np.float64)
+        L = log_consts + np.dot(x, (mu * inv_sigma).T) - 0.5 * np.dot(x**2, inv_sigma.T)
+        L -= np.max(L, axis=1)[:,np.newaxis]  # (log-sum-exp)
+        np.exp(L, out=L)
+        P[st:st+block_rows] = L / np.sum(L, axis=1)[:,np.newaxis]
+
+    return P
+
+
+def get_stats_per_leaf(gmm, X, leaf_pos, n_leafs, dtype=np.float64):
+    """
+    Accumulate the sufficient statistics of the tracklets of every leaf of a tree.
+    :param gmm: (w, mu, sigma).
+    :param X: the N-by-D features of the tracklets.
+    :param leaf_pos: the leaf of every tracklet (negative if none, see ClusterTree.get_leaf_positions), or any other
+    group (e.g. a frame).
+    :param n_leafs:
+    :param dtype: the type of the (n_leafs-by-K-by-D) s1 and s2, e.g. float32 to halve their size (they are computed
+    in float64 anyway).
+    :return: a dictionary with the n_leafs-by-... arrays n (the number of tracklets), s0, s1 and s2 (see get_stats).
+    """
+    K, D = np.asarray(gmm[1]).shape
+    stats = dict(n=np.zeros((n_leafs,), dtype=np.float64),
+                 s0=np.zeros((n_leafs, K), dtype=np.float64),
+                 s1=np.zeros((n_leafs, K, D), dtype=dtype),
+                 s2=np.zeros((n_leafs, K, D), dtype=dtype))
+
+    leaf_pos = np.asarray(leaf_pos)
+    inds = np.where(leaf_pos >= 0)[0]
+    inds = inds[np.argsort(leaf_pos[inds], kind='mergesort')]  # (sorted by leaf: the ones of every leaf contiguous)
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(leaf_pos[inds], minlength=n_leafs))])
+
+    P = get_posteriors(gmm, X[inds])
+    x = np.asarray(X[inds], dtype=np.float64)
+    for l in xrange(n_leafs):
+        st, en = bounds[l], bounds[l+1]
+        if st < en:
+            s = get_stats(P[st:en], x[st:en])
+            for k in stats:
+                stats[k][l] = s[k]
+
+    return stats
+
+
+def get_stats(P, X):
+    """
+    Get the sufficient statistics of a set of tracklets.
+    :param P: the N-by-K posteriors of the tracklets (see get_posteriors).
+    :param X: the N-by-D features of the tracklets.
+    :return: a dictionary with n (N), s0 (K, sum of posteriors), s1 (K-by-D, sum of posteriors times features) and
+    s2 (K-by-D, sum of posteriors times squared features).
+    """
+    return dict(n=len(X), s0=np.sum(P, axis=0), s1=np.dot(P.T, X), s2=np.dot(P.T, X**2))
+
+
+def fisher_from_stats(gmm, stats, include=('mu',)):
+    """
+    Compute the Fisher vector of a set of tracklets from their sufficient statistics, as yael's gmm_fisher does
+    (the gradients w.r.t. the weights, means and standard deviations, normalized by the diagonal of the Fisher
+    information matrix).
+    :param gmm: (w, mu, sigma).
+    :param stats: see get_stats (or a node of the sums over a tree, e.g. {k : v[i] for k, v in tree_stats.items()}).
+    Also the stats of several sets at once, with an extra leading dimension in n, s0, s1 and s2.
+    :param include: a list of 'w', 'mu' and/or 'sigma' (in the output, they are in this order).
+    :return: the Fisher vector (float32), or a matrix with the one of every set in its rows.
+    """
+    w, mu, sigma = [np.asarray(a, dtype=np.float64) for a in gmm]
+    n, s0, s1, s2 = np.asarray(stats['n'], dtype=np.float64), stats['s0'], stats['s1'], stats['s2']
+    n_ = n[...,np.newaxis]
+
+    parts = []
+    if 'w' in include:
+        fv_w = s0[...,1:] / w[1:] - s0[...,:1] / w[0]
+        parts.append(_normalize(fv_w, n_ * (1. / w[1:] + 1. / w[0])))
+    if 'mu' in include:
+        fv_mu = (s1 - mu * s0[...,np.newaxis]) / sigma
+        parts.append(_normalize(fv_mu, n_[...,np.newaxis] * w[:,np.newaxis] / sigma).reshape(n.shape + (-1,)))
+    if 'sigma' in include:
+        # sum_i p_i ((x_i - mu)^2 - sigma) / sigma^(3/2)
+        fv_sigma = (s2 - 2 * mu * s1 + (mu**2 - sigma) * s0[...,np.newaxis]) / sigma**1.5
+        parts.append(_normalize(fv_sigma, 2 * n_[...,np.newaxis] * w[:,np.newaxis] / sigma).reshape(n.shape + (-1,)))
+
+    return np.concatenate(parts, axis=-1).astype(np.float32)
+
+
+def iter_node_frame_fishers(gmm, X, frames, tree, int_paths, include=('mu',)):
+    """
+    Compute the per-frame Fisher vectors of every node of a tree, from the per-frame statistics of its children: the
+    posteriors are computed once per tracklet, and the statistics of a node are the sums of the ones of its children
+    in the same frames.
+
+    The nodes are visited children first, and the statistics of a node are only kept until its parent's are computed
+    (stored in float32), so at most the ones of a node per level of the tree are in memory, not the ones of every
+    (leaf, frame) pair.
+    :param gmm: (w, mu, sigma).
+    :param X: the N-by-D features of the tracklets.
+    :param frames: the frame of every tracklet.
+    :param tree: a ClusterTree.
+    :param int_paths: the paths of the leafs of the tracklets.
+    :param include: see fisher_from_stats.
+    :return: a generator of (node_id, fids, V) in reverse depth-first pre-order (the children before their parent),
+    V having the FV of the tracklets in frame fids[f] of the node in its f-th row (as the ones of ynumpy.fisher per
+    node and frame).
+    """
+    frames = np.asarray(frames)
+    order, ranges = tree.get_node_ranges(int_paths)  # (the tracklets of every leaf contiguous)
+
+    children_stats = dict()  # (the (fids, stats) of the nodes whose parent is not computed yet, by parent)
+    for node_idx in xrange(len(tree) - 1, -1, -1):  # (the children come after their parents)
+        if tree.first_children[node_idx] < 0:  # (a leaf: from its tracklets)
+            inds = order[ranges[node_idx,0]:ranges[node_idx,1]]
+            fids, frame_inds = np.unique(frames[inds], return_inverse=True)
+            stats = get_stats_per_leaf(gmm, X[inds], frame_inds, len(fids), dtype=np.float32)
+        else:  # (from its children's, in the union of their frames)
+            children = children_stats.pop(node_idx)
+            fids = np.unique(np.concatenate([c_fids for c_fids, _ in children]))
+            stats = {s : np.zeros((len(fids),) + v.shape[1:], dtype=v.dtype) for s, v in children[0][1].iteritems()}
+            for c_fids, c_stats in children:
+                pos = np.searchsorted(fids, c_fids)  # (no repeated frames in a child)
+                for s, v in c_stats.iteritems():
+                    stats[s][pos] += v
+
+        yield int(tree.node_ids[node_idx]), fids, fisher_from_stats(gmm, stats, include)
+
+        if node_idx > 0:
+            children_stats.setdefault(tree.parents[node_idx], []).append((fids, stats))
+
+
+# ==============================================================================
+# Helper functions
+# ==============================================================================
+
+def _normalize(grad, fisher_info):
+    # (by the square root of the fisher information, unless it is zero, e.g. of an empty set)
+    nf = np.sqrt(fisher_info)
+    return np.where(nf > 0, grad / np.where(nf > 0, nf, 1.), grad)
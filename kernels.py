@@ -11,6 +11,7 @@ from sklearn.cross_validation import StratifiedKFold
 import sys
 import itertools
 from joblib import delayed, Parallel
+from parallelism import run_parallel, get_files_cost
 from random import shuffle
 import time
 from sklearn import preprocessing
@@ -18,6 +19,13 @@ from sklearn import preprocessing
 import videodarwin
 from tracklet_representation import normalize
 
+INTERNAL_PARAMETERS = dict(
+    # the branch evolutions of a tree at once with videodarwin.darwin_tree. Its solutions are exact, so they differ
+    # from the per-branch ones of videodarwin.darwin (LinearSVR, tol=0.001) by up to ~3%: all the outputs must be
+    # recomputed if this is changed, not mixed with the existing ones
+    branches_darwin_tree = False,
+)
+
 def compute_ATEP_kernels(feats_path, videonames, traintest_parts, feat_types, kernels_output_path, \
                          kernel_type='linear', norm='l2', power_norm=True, \
                          nt=4, use_disk=False, verbose=False):
@@ -203,9 +211,10 @@ def compute_ATNBEP_kernels(feats_path, videonames, traintest_parts, feat_types,
                 if not exists(kernel_repr_path):
                     makedirs(kernel_repr_path)
 
-                Parallel(n_jobs=nt, backend='threading')(delayed(construct_branch_evolutions)(join(feats_path, feat_t + '-' + str(k), videonames[i] + '.pkl'),
-                                                                                              join(kernel_repr_path, videonames[i] + '.pkl'))
-                                                               for i in xrange(total))
+                input_filepaths = [join(feats_path, feat_t + '-' + str(k), videonames[i] + '.pkl') for i in xrange(total)]
+                run_parallel([delayed(construct_branch_evolutions)(input_filepaths[i], join(kernel_repr_path, videonames[i] + '.pkl'))
+                              for i in xrange(total)], nt=nt, backend='threading',
+                             costs=get_files_cost(input_filepaths), name='construct_branch_evolutions', verbose=verbose)
                 try:
                     with open(train_filepath, 'rb') as f:
                         data = cPickle.load(f)
@@ -424,17 +433,24 @@ def construct_branch_evolutions(input_filepath, output_filepath):
 def _construct_branch_evolutions(data, dtype=np.float32):
     root = [np.array([0],dtype=dtype), np.array([0],dtype=dtype)]
 
+    if INTERNAL_PARAMETERS['branches_darwin_tree']:
+        # the darwins of the paths from every node up to the root, sharing the ancestors' computations
+        darwins = videodarwin.darwin_tree(data['tree'])
+
     branches = []
     for (id_i, x) in data['tree'].iteritems():
         if id_i > 1:
-            # construct the path matrix
-            X = []
-            id_j = id_i
-            while id_j > 0:
-                X.append(data['tree'][id_j])
-                id_j /= 2
-
-            w_fw, w_rv = videodarwin._darwin(np.array(X))
+            if INTERNAL_PARAMETERS['branches_darwin_tree']:
+                w_fw, w_rv = darwins[id_i]
+            else:
+                # construct the path matrix
+                X = []
+                id_j = id_i
+                while id_j > 0:
+                    X.append(data['tree'][id_j])
+                    id_j /= 2
+
+                w_fw, w_rv = videodarwin._darwin(np.array(X))
             branches.append( [normalize(w_fw), normalize(w_rv)] )
 
     return root, branches
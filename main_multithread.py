@@ -15,7 +15,7 @@ import itertools
 import argparse
 
 from configuration import *
-import tracklet_extraction, tracklet_clustering, tracklet_representation, kernels, classification
+import tracklet_extraction, tracklet_clustering, tracklet_representation, kernels, classification, parallelism
 
 # ==============================================================================
 # Main
@@ -49,6 +49,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process the videos to see whether they contain speaking-while-facing-a-camera scenes.')
     parser.add_argument('dataset_name', nargs=1, help='Choose among: ucf_sports_actions, highfive, olympic_sports, hollywood2.')
     parser.add_argument('--num-threads', dest='nt', type=int, default=1, help='Set the number of threads for parallelization.')
+    parser.add_argument('--backend', default='threading', choices=parallelism.BACKENDS, help='Set the parallelization backend (of extraction, clustering, and descriptors): threads, processes (loky, multiprocessing), or processes of threads (hybrid).')
     parser.add_argument('--methods', nargs='+', default=[], help='List methods to use: atep-bovw, atep-fv, atep-vd, atnbep, and combinations using + sign.')
     parser.add_argument('-v', '--verbose', action='store_true', help='Whether or not print debugging information.')
     args = parser.parse_args()
@@ -70,14 +71,14 @@ if __name__ == "__main__":
     ##########################
 
     # whatever is the method, these two are mandatory
-    tracklet_extraction.extract_multithread(fullvideonames, videonames, xml_config['features_list'], tracklets_path, nt=args.nt, verbose=args.verbose)
-    tracklet_clustering.cluster_multithread(tracklets_path, videonames, clusters_path, nt=args.nt, verbose=args.verbose)
+    tracklet_extraction.extract_multithread(fullvideonames, videonames, xml_config['features_list'], tracklets_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
+    tracklet_clustering.cluster_multithread(tracklets_path, videonames, clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
 
     if 'atep-bovw' in args.methods:
         tracklet_representation.train_bovw_codebooks(tracklets_path, videonames, traintest_parts, xml_config['features_list'], intermediates_path, pca_reduction=True, nt=args.nt, verbose=args.verbose)
         tracklet_representation.compute_bovw_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                      feats_path + '/bovwtree/', \
-                                                                     treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                     treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
 
         atep_bovw = kernels.compute_ATEP_kernels(feats_path + '/bovwtree/', videonames, traintest_parts, xml_config['features_list'], \
                                                  kernels_path + '/atep-bovw/', kernel_type='intersection', norm='l1', power_norm=False, \
@@ -97,7 +98,7 @@ if __name__ == "__main__":
         tracklet_representation.train_fv_gmms(tracklets_path, videonames, traintest_parts, xml_config['features_list'], intermediates_path, pca_reduction=True, nt=args.nt, verbose=args.verbose)
         tracklet_representation.compute_fv_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/fvtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
 
         atep_fv = kernels.compute_ATEP_kernels(feats_path + '/fvtree/', videonames, traintest_parts, xml_config['features_list'], \
                                                kernels_path + '/atep-fv/', use_disk=False, nt=args.nt, verbose=args.verbose)
@@ -117,7 +118,7 @@ if __name__ == "__main__":
         tracklet_representation.train_fv_gmms(tracklets_path, videonames, traintest_parts, xml_config['features_list'], intermediates_path, pca_reduction=True, nt=args.nt)
         tracklet_representation.compute_vd_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/vdtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
 
         atep_vd = kernels.compute_ATEP_kernels(feats_path + '/vdtree/', videonames, traintest_parts, xml_config['features_list'], \
                                                kernels_path + '/atep-vd/', use_disk=False, nt=args.nt, verbose=args.verbose)
@@ -136,7 +137,7 @@ if __name__ == "__main__":
         tracklet_representation.train_fv_gmms(tracklets_path, videonames, traintest_parts, xml_config['features_list'], intermediates_path, pca_reduction=True, nt=args.nt, verbose=args.verbose)
         tracklet_representation.compute_fv_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/fvtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
 
         atnbep = kernels.compute_ATNBEP_kernels(feats_path + '/fvtree/', videonames, traintest_parts, xml_config['features_list'], \
                                                    kernels_path + '/atnbep/', use_disk=False, nt=args.nt, verbose=args.verbose)
@@ -156,10 +157,10 @@ if __name__ == "__main__":
         tracklet_representation.train_fv_gmms(tracklets_path, videonames, traintest_parts, xml_config['features_list'], intermediates_path, pca_reduction=True, nt=args.nt)
         tracklet_representation.compute_fv_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/fvtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
         tracklet_representation.compute_vd_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/vdtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
 
         atep_fv = kernels.compute_ATEP_kernels(feats_path + '/fvtree/', videonames, traintest_parts, xml_config['features_list'], \
                                             kernels_path + '/atep-fv/', use_disk=False, nt=args.nt, verbose=args.verbose)
@@ -183,7 +184,7 @@ if __name__ == "__main__":
         tracklet_representation.train_fv_gmms(tracklets_path, videonames, traintest_parts, xml_config['features_list'], intermediates_path, pca_reduction=True, nt=args.nt)
         tracklet_representation.compute_fv_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/fvtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
 
         atep_fv = kernels.compute_ATEP_kernels(feats_path + '/fvtree/', videonames, traintest_parts, xml_config['features_list'], \
                                             kernels_path + '/atep-fv/', use_disk=False, nt=args.nt, verbose=args.verbose)
@@ -208,10 +209,10 @@ if __name__ == "__main__":
         tracklet_representation.train_fv_gmms(tracklets_path, videonames, traintest_parts, xml_config['features_list'], intermediates_path, pca_reduction=True, nt=args.nt)
         tracklet_representation.compute_vd_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/vdtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
         tracklet_representation.compute_fv_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/fvtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
 
         atep_vd = kernels.compute_ATEP_kernels(feats_path + '/vdtree/', videonames, traintest_parts, xml_config['features_list'], \
                                                kernels_path + '/atep-vd/', use_disk=False, nt=args.nt, verbose=args.verbose)
@@ -236,10 +237,10 @@ if __name__ == "__main__":
         tracklet_representation.train_fv_gmms(tracklets_path, videonames, traintest_parts, xml_config['features_list'], intermediates_path, pca_reduction=True, nt=args.nt)
         tracklet_representation.compute_fv_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/fvtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
         tracklet_representation.compute_vd_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, xml_config['features_list'], \
                                                                    feats_path + '/vdtree/', \
-                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, verbose=args.verbose)
+                                                                   treelike=True, pca_reduction=True, clusters_path=clusters_path, nt=args.nt, backend=args.backend, verbose=args.verbose)
 
         atep_fv = kernels.compute_ATEP_kernels(feats_path + '/fvtree/', videonames, traintest_parts, xml_config['features_list'], \
                                             kernels_path + '/atep-fv/', use_disk=False, nt=args.nt, verbose=args.verbose)
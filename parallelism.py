@@ -0,0 +1,153 @@
+__author__ = 'aclapes'
+
+'''Parallel execution of the per-video jobs of the framework's stages.
+
+The pure-python parts of the stages are GIL-bound, so they do not scale with threads. The jobs can also be run in
+processes ('loky' or 'multiprocessing') or in processes running some threads each ('hybrid'). Process workers
+cap the number of BLAS threads so that they do not oversubscribe the cores.
+
+Given the (estimated) cost of the jobs, these are dispatched longest-first, one at a time, to the first idle worker.
+Otherwise, a few big videos scheduled last leave the rest of the workers idle at the end of the stage.
+
+'''
+
+import time
+from os.path import isfile, getsize
+
+import numpy as np
+from joblib import Parallel, delayed, parallel_backend, cpu_count
+
+try:
+    from threadpoolctl import threadpool_limits  # (optional) caps BLAS threads of already initialized workers
+except ImportError:
+    threadpool_limits = None
+
+
+BACKENDS = ['threading', 'loky', 'multiprocessing', 'hybrid']
+
+INTERNAL_PARAMETERS = dict(
+    hybrid_threads_per_process = 4,
+)
+
+
+# ==============================================================================
+# Main functions
+# ==============================================================================
+
+def run_parallel(tasks, nt=4, backend='threading', costs=None, blas_threads=None, name=None, stats=None, verbose=False):
+    """
+    Run a list of jobs in parallel.
+    :param tasks: the jobs, built using joblib's delayed (e.g. [delayed(_cluster)(..., [i], ...) for i in inds]).
+    :param nt: number of workers (in total, i.e. processes x threads per process if 'hybrid').
+    :param backend: 'threading', 'loky', 'multiprocessing', or 'hybrid' (loky processes running
+                    INTERNAL_PARAMETERS['hybrid_threads_per_process'] threads each).
+    :param costs: the estimated cost of each job (any unit), to dispatch them longest-first. None keeps the order.
+    :param blas_threads: max number of BLAS threads per process worker (by default, the cores over nt).
+    :param name: the name of the stage (to report its makespan and idle time if verbose).
+    :param stats: a dictionary to fill with the makespan, busy and idle times (in secs, and core-secs).
+    :return: the values returned by the jobs (in the same order).
+    """
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend: %s (choose among: %s)' % (backend, ', '.join(BACKENDS)))
+
+    tasks = list(tasks)
+    order = np.arange(len(tasks)) if costs is None else np.argsort(-np.asarray(costs), kind='mergesort')
+    timed_tasks = [delayed(_timed_call)(*tasks[i]) for i in order]
+
+    st_time = time.time()
+    if backend == 'threading':
+        ret = Parallel(n_jobs=nt, backend='threading', batch_size=1, pre_dispatch='n_jobs')(timed_tasks)
+    else:
+        ret = _run_processes(timed_tasks, nt, backend, blas_threads, costs=(None if costs is None else np.asarray(costs)[order]))
+
+    # undo the ordering
+    results = [None] * len(tasks)
+    for i, (result, _, _) in zip(order, ret):
+        results[i] = result
+
+    # report the tail of the stage
+    makespan = (max([en for (_, _, en) in ret]) - st_time) if len(ret) > 0 else 0.
+    busy = sum([en - st for (_, st, en) in ret])
+    idle = max(0., nt * makespan - busy)
+    if stats is not None:
+        stats.update(makespan=makespan, busy=busy, idle=idle)
+    if verbose:
+        print('[run_parallel] %s: %d jobs, makespan %.2f secs, idle %.2f core-secs (%.1f%%)'
+              % (name if name is not None else 'stage', len(tasks), makespan, idle,
+                 (100. * idle / (nt * makespan)) if makespan > 0 else 0.))
+
+    return results
+
+
+def get_files_cost(filepaths):
+    """
+    Estimate the cost of processing some files by their size (missing files cost 0).
+    """
+    return [(getsize(filepath) if isfile(filepath) else 0) for filepath in filepaths]
+
+
+# ==============================================================================
+# Helper functions
+# ==============================================================================
+
+def _run_processes(timed_tasks, nt, backend, blas_threads, costs=None):
+    if blas_threads is None:
+        blas_threads = max(1, cpu_count() // nt)
+
+    if backend == 'hybrid':
+        # the threads of a process pick its jobs dynamically, but jobs are assigned to processes beforehand
+        nt_inner = max(1, min(INTERNAL_PARAMETERS['hybrid_threads_per_process'], nt))
+        n_procs = max(1, nt // nt_inner)
+        assignment = _assign_longest_first(costs if costs is not None else np.ones((len(timed_tasks),)), n_procs)
+        groups = [[i for i in xrange(len(timed_tasks)) if assignment[i] == p] for p in xrange(n_procs)]
+    else:
+        nt_inner = 1
+        n_procs = nt
+        groups = [[i] for i in xrange(len(timed_tasks))]
+
+    jobs = [delayed(_run_capped)([timed_tasks[i] for i in g], blas_threads, nt_inner) for g in groups]
+    if backend == 'multiprocessing':
+        ret = Parallel(n_jobs=n_procs, backend='multiprocessing', batch_size=1, pre_dispatch='n_jobs')(jobs)
+    else:  # (new loky workers read the BLAS threads' limit from the environment)
+        with parallel_backend('loky', inner_max_num_threads=blas_threads):
+            ret = Parallel(n_jobs=n_procs, batch_size=1, pre_dispatch='n_jobs')(jobs)
+
+    # undo the grouping
+    results = [None] * len(timed_tasks)
+    for g, group_results in zip(groups, ret):
+        for i, r in zip(g, group_results):
+            results[i] = r
+
+    return results
+
+
+def _assign_longest_first(costs, n_bins):
+    # greedily assign jobs (sorted by decreasing cost) to the least loaded bin
+    loads = np.zeros((n_bins,), dtype=np.float64)
+    assignment = np.zeros((len(costs),), dtype=np.int32)
+    for i in xrange(len(costs)):
+        p = np.argmin(loads)
+        assignment[i] = p
+        loads[p] += costs[i]
+
+    return assignment
+
+
+def _timed_call(func, args, kwargs):
+    st_time = time.time()
+    result = func(*args, **kwargs)
+    return result, st_time, time.time()
+
+
+def _run_capped(tasks, blas_threads, nt):
+    # (in a worker process) run the jobs with a limited number of BLAS threads
+    if threadpool_limits is None:
+        return _run_threads(tasks, nt)
+    with threadpool_limits(limits=blas_threads):
+        return _run_threads(tasks, nt)
+
+
+def _run_threads(tasks, nt):
+    if nt == 1:
+        return [func(*args, **kwargs) for func, args, kwargs in tasks]
+    return Parallel(n_jobs=nt, backend='threading', batch_size=1, pre_dispatch='n_jobs')(tasks)
@@ -18,15 +18,27 @@ Copyrights: Adrien Gaidon, 2012-2014
 
 import sys
 import heapq
+import zlib
 
 import numpy as np
 from scipy import sparse, linalg
-from scipy.sparse.sparsetools import cs_graph_components
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from scipy.sparse.linalg import eigsh, ArpackNoConvergence
+from scipy.spatial import cKDTree
+
+try:
+    import pyflann
+except ImportError:
+    pyflann = None  # (optional) use scipy's cKDTree instead
 
-import pyflann
 from sklearn.cluster import MiniBatchKMeans, KMeans
+from sklearn.utils.extmath import randomized_svd
+from sklearn.utils import check_random_state
+from joblib import delayed
+
+from parallelism import run_parallel
 
-import Queue
+from cluster_tree import ClusterTree
 
 # The fixed internal paramaters for clustering
 INTERNAL_PARAMETERS = dict(
@@ -37,13 +49,19 @@ INTERNAL_PARAMETERS = dict(
     # build_sym_geom_adjacency
     min_geom_neighbors=10,  # minimum number of geometrical neighbors
     # spectral_clustering_division
+    split_type='threshold',  # 'threshold' or 'kmeans' (see SpectralTree)
     n_threshs=10,  # number of evenly-spaced thresholds to try
     max_depth=62,  # maximum depth for cluster-trees (-> max nodes = 2**h - 1)
     min_evect_amplitude=1e-10,  # min amplitude of proj on eigenvector to split
+    build_nt=1,  # number of workers splitting independent subtrees (1: serial)
+    build_backend='threading',  # parallelization backend of those (see parallelism)
+    # spectral_embedding_nystrom_blocked
+    nystrom_block_bytes=1 << 27,  # size of the (float64) blocks of B processed at once
 )
 
 
-def spectral_embedding_nystrom(AB, ridge=1e-10, nvec=2, copy=True):
+def spectral_embedding_nystrom(AB, ridge=1e-10, nvec=2, copy=True, block_size=None,
+                               solver='full', n_components=None, check_stability=True):
     """Approximate spectral embedding using the Nystrom approximation
 
     Parameters
@@ -59,7 +77,14 @@ def spectral_embedding_nystrom(AB, ridge=1e-10, nvec=2, copy=True):
           number of embedding vectors to use (output dimensionality, nvec < n)
 
     copy: boolean, optional, default: True,
-          work on a copy of AB or not
+          kept for compatibility: AB is never modified
+
+    block_size: int, optional, default: None,
+                number of columns of B processed at once (see
+                spectral_embedding_nystrom_blocked)
+
+    solver, n_components, check_stability: optional,
+                see spectral_embedding_nystrom_blocked
 
     Returns
     -------
@@ -75,7 +100,7 @@ def spectral_embedding_nystrom(AB, ridge=1e-10, nvec=2, copy=True):
     - One shot-technique from [1]: assumes A is p.d.
       Note, that [1] has some mistakes that are corrected here.
 
-    - Cost in memory is at most 4 time the memory size of AB.
+    - Besides AB, only O(n^2 + n * block_size) memory is used.
 
     References
     ----------
@@ -83,42 +108,117 @@ def spectral_embedding_nystrom(AB, ridge=1e-10, nvec=2, copy=True):
         Fowlkes, C. and Belongie, S. and Chung, F. and Malik, J.
         PAMI 2004
     """
-    if copy:
-        AB = AB.copy()  # XXX memory bottleneck
     n = AB.shape[0]
-    #m = AB.shape[1] - n
+    return spectral_embedding_nystrom_blocked(AB[:, :n], AB[:, n:], AB.shape[1] - n,
+                                              ridge=ridge, nvec=nvec, block_size=block_size,
+                                              solver=solver, n_components=n_components,
+                                              check_stability=check_stability)
+
+
+def spectral_embedding_nystrom_blocked(A, B, m, ridge=1e-10, nvec=2, block_size=None,
+                                       solver='full', n_components=None, check_stability=True):
+    """Approximate spectral embedding using the Nystrom approximation,
+    processing B by blocks of columns
+
+    B is read three times (to get its row sums, to accumulate the S matrix,
+    and to project it onto the embedding vectors), but it is never scaled or
+    copied as a whole. It can even be computed lazily, block by block, so
+    that it is never kept in memory.
+
+    Parameters
+    ----------
+    A: (n, n) array,
+       similarities between the n sub-sampled points (assumed p.d.)
+
+    B: (n, m) array or callable,
+       similarities between the n sub-sampled points and the m other points,
+       or a function B(start, stop) returning the (n, stop - start) block of
+       the similarities to the points start to stop - 1
+
+    m: int,
+       number of other points (columns of B)
+
+    ridge: float,
+           small offset added to the diagonal of A for numerical stability
+
+    nvec: int, optional, default: 2,
+          number of embedding vectors to use (output dimensionality, nvec < n)
+
+    block_size: int, optional, default: None,
+                number of columns of B processed at once (by default, the
+                ones fitting in INTERNAL_PARAMETERS['nystrom_block_bytes'])
+
+    solver: 'full', 'eigsh' or 'randomized', optional, default: 'full',
+            eigen-solver of S (see eigh_solver), of which only the nvec + 1
+            largest eigen-vectors are needed
+
+    n_components: int, optional, default: None,
+                  if not None, use a rank-`n_components` pseudo-inverse of A
+                  computed with `solver` (full eigen-decomposition otherwise)
+
+    check_stability: boolean or 'probe', optional, default: True,
+                     stability checks of the pseudo-inverses (see spd_pinv)
+
+    Returns
+    -------
+    E: (n+m, nvec) array,
+       the spectral embedding of all points (the n sub-sampled ones first)
+
+    Raises
+    ------
+    IndefiniteError: if A is not positive-definite
+    """
+    n = A.shape[0]
     assert nvec < n, "Too large number of embedding vectors (%d >= %d)" % (
         nvec, n)
-    # make views of the blocks
-    A = AB[:, :n]
-    B = AB[:, n:]
+    if block_size is None:
+        block_size = max(1, INTERNAL_PARAMETERS['nystrom_block_bytes'] // (8 * n))
+    blocks = [(st, min(st + block_size, m)) for st in xrange(0, m, block_size)]
+    get_block = B if callable(B) else (lambda st, en: B[:, st:en])
+
     # add a ridge for numerical stability as A is generally badly-conditionned
     # XXX use QR decompostion of A for num stab (cf. stable GP)?
+    A = np.array(A, dtype=np.float64)
     A[np.diag_indices_from(A)] += ridge
     # normalize the components of AB
-    b_r = B.sum(axis=1)
-    pinvA = spd_pinv(A)
+    b_r = np.zeros((n,), dtype=np.float64)
+    for st, en in blocks:
+        b_r += get_block(st, en).sum(axis=1)
+    pinv_solver = 'full' if n_components is None else solver
+    pinvA = spd_pinv(A, check_stability=check_stability,
+                     solver=pinv_solver, n_components=n_components)
     d1 = A.sum(axis=1) + b_r
-    d2 = np.abs(B.sum(axis=0) + np.dot(np.dot(b_r, pinvA), B))
-    # Note: abs not required except when numerical problems
     if np.any(d1 <= 0):
         raise ValueError("numerical issue: negative or null d1 entries")
-    if np.any(d2 <= 0):
-        raise ValueError("numerical issue: negative or null d2 entries")
-    dhat = np.sqrt(1.0 / np.r_[d1, d2])[:, np.newaxis]
-    A *= np.dot(dhat[:n], dhat[:n].T)
-    B *= np.dot(dhat[:n], dhat[n:].T)
+    dhat1 = np.sqrt(1.0 / d1)
+    A *= np.outer(dhat1, dhat1)
     # square root of the pseudo-inverse
-    Asi = spd_pinv(A, square_root=True)
-    # compute the embedding vectors
-    AsiB = np.dot(Asi, B)  # XXX time & memory bottleneck (20% of total)
-    S = A + np.dot(AsiB, AsiB.T)  # XXX bottleneck (20% of total)
+    Asi = spd_pinv(A, square_root=True, check_stability=check_stability,
+                   solver=pinv_solver, n_components=n_components)
+    # compute the embedding vectors: S = A + (Asi B)(Asi B)^T, accumulated
+    # over the (normalized) blocks of B
+    u = np.dot(b_r, pinvA)
+    dhat2 = np.zeros((m,), dtype=np.float64)
+    S = A.copy()
+    for st, en in blocks:
+        B_blk = np.asarray(get_block(st, en), dtype=np.float64)
+        d2 = np.abs(B_blk.sum(axis=0) + np.dot(u, B_blk))
+        # Note: abs not required except when numerical problems
+        if np.any(d2 <= 0):
+            raise ValueError("numerical issue: negative or null d2 entries")
+        dhat2[st:en] = np.sqrt(1.0 / d2)
+        AsiB = np.dot(Asi, B_blk * np.outer(dhat1, dhat2[st:en]))
+        S += np.dot(AsiB, AsiB.T)
     QS, deltaS = None, None
     for _i in range(4):
         try:
-            QS, deltaS, _ = np.linalg.svd(S)
+            if solver == 'full':
+                QS, deltaS, _ = np.linalg.svd(S)
+            else:
+                deltaS, QS = eigh_solver(S, n_components=nvec + 1, solver=solver)
+                deltaS, QS = deltaS[::-1], QS[:, ::-1]  # (decreasing order)
             break
-        except np.linalg.LinAlgError:
+        except (np.linalg.LinAlgError, ArpackNoConvergence):
             _qridge = ridge * 10 ** _i
             S[np.diag_indices_from(S)] += _qridge
             sys.stderr.write(
@@ -128,8 +228,14 @@ def spectral_embedding_nystrom(AB, ridge=1e-10, nvec=2, copy=True):
         raise ValueError("numerical issue: ridge too low or weird S")
     if np.any(deltaS <= 0):
         raise ValueError("numerical issue: negative or null deltaS entry")
-    _VT = np.dot(np.diag(1.0 / np.sqrt(deltaS)), np.dot(QS.T, Asi))
-    VT = np.dot(_VT, AB)  # XXX time & memory bottleneck (20% of total)
+    # (only the first nvec + 1 embedding vectors are used)
+    _VT = np.dot(np.diag(1.0 / np.sqrt(deltaS[:nvec + 1])),
+                 np.dot(QS[:, :nvec + 1].T, Asi))
+    VT = np.empty((nvec + 1, n + m), dtype=np.float64)
+    VT[:, :n] = np.dot(_VT, A)
+    for st, en in blocks:
+        B_blk = np.asarray(get_block(st, en), dtype=np.float64)
+        VT[:, n + st:n + en] = np.dot(_VT * dhat1[np.newaxis, :], B_blk) * dhat2[np.newaxis, st:en]
     # return the first nvec embedding vectors
     if np.any(VT[0] == 0):
         sys.stderr.write(
@@ -145,7 +251,7 @@ def spectral_embedding_nystrom(AB, ridge=1e-10, nvec=2, copy=True):
     return E
 
 
-def spectral_clustering_division(E, geoms, split_type="threshold"):
+def spectral_clustering_division(E, geoms, split_type=None, params=None):
     """Divisive hierarchical clustering + model selection
 
     Recursively split in two by thresholding the eigenvectors in increasing
@@ -161,8 +267,13 @@ def spectral_clustering_division(E, geoms, split_type="threshold"):
     geoms: (n_pts, 3) array,
            array of global (x, y, t) positions of the point tracks
 
-    split_type: 'kmeans' or 'threshold' (default),
+    split_type: 'kmeans' or 'threshold', optional,
                 the bi-partitioning algorithm used to split nodes
+                (INTERNAL_PARAMETERS['split_type'] by default)
+
+    params: dict, optional,
+            values overriding the ones of INTERNAL_PARAMETERS
+            (e.g. to try several ones from the same embedding)
 
     Returns
     -------
@@ -174,20 +285,23 @@ def spectral_clustering_division(E, geoms, split_type="threshold"):
                Note: root is the left-most '1', outliers have path 0
     """
     global INTERNAL_PARAMETERS
+    params = dict(INTERNAL_PARAMETERS, **(params if params is not None else {}))
+    if split_type is None:
+        split_type = params['split_type']
     n_pts, n_vec = E.shape
     _n, _d = geoms.shape
     assert _n == n_pts and _d == 3, "Invalid geoms (%s)" % (str(geoms.shape))
     # limit on tube sizes
-    mts = int(INTERNAL_PARAMETERS['min_tube_size'])
-    Mts = int(INTERNAL_PARAMETERS['max_tube_size'])
+    mts = int(params['min_tube_size'])
+    Mts = int(params['max_tube_size'])
     # lower limit on the number of clusters
-    min_n_clusters = int(INTERNAL_PARAMETERS['min_k'])
+    min_n_clusters = int(params['min_k'])
     # max allowed node depth
-    max_depth = int(INTERNAL_PARAMETERS['max_depth'])
+    max_depth = int(params['max_depth'])
     # min eigenvector amplitude for split
-    min_evect_amplitude = float(INTERNAL_PARAMETERS['min_evect_amplitude'])
+    min_evect_amplitude = float(params['min_evect_amplitude'])
     # number of thresholds to try when using thresholding splits
-    n_threshs = int(INTERNAL_PARAMETERS['n_threshs'])
+    n_threshs = int(params['n_threshs'])
 
     # check degenerate case: just issue a warning and lower mts
     if n_pts <= 2 * min_n_clusters * mts:
@@ -205,9 +319,9 @@ def spectral_clustering_division(E, geoms, split_type="threshold"):
     # initialize the tree structure
     stree = SpectralTree(
         E, ngeoms, mts, Mts, min_n_clusters, max_depth, min_evect_amplitude,
-        split_type, n_threshs)
+        split_type, n_threshs, min_gnn=int(params['min_geom_neighbors']))
     # recursively split the leaves in depth-first left-to-right order
-    stree.build()
+    stree.build(nt=int(params['build_nt']), backend=params['build_backend'])
 
     return stree.labels, stree.int_paths
 
@@ -224,38 +338,13 @@ def reconstruct_tree_from_leafs(leafs):
 
     Returns
     -------
-    A dictionary indicating for each node a list of all its descendents.
+    A ClusterTree (see cluster_tree), giving the descendants and leafs of
+    every node as contiguous ranges.
     Exemple:
-        { 1 : [2,3,4,5,6,7,12,13,26,27],
-          2 : [4,5],
-          3 : [6,7,12,13,26,27],
-          ...
-        }
+        tree.get_descendants(3) -> [6, 12, 13, 7]
+        tree.get_leafs(3) -> [12, 13, 7]
     """
-    h = dict()
-    q = Queue.PriorityQueue()
-
-    # recover first intermediate nodes (direct parents from leafs)
-    for path in leafs:
-        parent_path = int(path/2)
-        if not parent_path in h and parent_path > 1:
-            q.put(-parent_path)  # deeper nodes go first (queue reversed by "-")
-        h.setdefault(parent_path, []).append(path)
-
-    # recover other intermediates notes recursevily
-    while not q.empty():
-        path = -q.get()
-        parent_path = int(path/2)
-        if not parent_path in h and parent_path > 1:  # list parent also for further processing
-            q.put(-parent_path)
-
-        h.setdefault(parent_path, [])
-        h[parent_path] += ([path] + h[path])  # append children from current node to their parent
-
-    # update with leafs
-    h.update(dict((i,[i]) for i in leafs))
-
-    return h
+    return ClusterTree(leafs)
 
 
 # ==============================================================================
@@ -263,7 +352,8 @@ def reconstruct_tree_from_leafs(leafs):
 # ==============================================================================
 
 
-def spd_pinv(a, rcond=1e-10, square_root=False, check_stability=True):
+def spd_pinv(a, rcond=1e-10, square_root=False, check_stability=True,
+             solver='full', n_components=None, random_state=0):
     """ Pseudo-inverse of a symetric positive-definite matrix
 
     Parameters
@@ -280,6 +370,23 @@ def spd_pinv(a, rcond=1e-10, square_root=False, check_stability=True):
     square_root: boolean, optional, default: False,
                  return the matrix square-root of the pseudo-inverse instead
 
+    check_stability: boolean or 'probe', optional, default: True,
+                     check the eigen-decomposition and the pseudo-inverse
+                     reconstruct `a` (True), check it only on a random probe
+                     vector ('probe', O(N^2) instead of O(N^3)), or not at all
+
+    solver: 'full', 'eigsh' or 'randomized', optional, default: 'full',
+            the eigen-solver (see eigh_solver)
+
+    n_components: int, optional, default: None,
+                  number of (largest) eigen-values used by the truncated
+                  solvers, i.e. a rank-`n_components` pseudo-inverse
+
+    random_state: int or RandomState, optional, default: 0,
+                  generator of the probe vectors (seeded, so that the
+                  checks are reproducible and numpy's global one is
+                  left untouched)
+
     Returns
     -------
     res: ndarray, shape (N, M)
@@ -289,6 +396,8 @@ def spd_pinv(a, rcond=1e-10, square_root=False, check_stability=True):
     Raises
     ------
     IndefiniteError: if a is not positive-definite.
+                     (only the computed eigen-values are checked by the
+                     truncated solvers)
 
     Notes
     -----
@@ -302,7 +411,7 @@ def spd_pinv(a, rcond=1e-10, square_root=False, check_stability=True):
     N, _N = a.shape
     assert N == _N, "Matrix is not square!"
     # get the eigen-decomposition
-    w, v = np.linalg.eigh(a)
+    w, v = eigh_solver(a, n_components=n_components, solver=solver)
 
     # check positive-definiteness
     ev_min = w.min()
@@ -310,7 +419,15 @@ def spd_pinv(a, rcond=1e-10, square_root=False, check_stability=True):
         msg = "Matrix is not positive-definite: min ev = {0}"
         raise IndefiniteError(msg.format(ev_min))
     # check stability of eigen-decomposition
-    if check_stability:
+    if check_stability == 'probe':
+        random_state = check_random_state(random_state)
+        # (on a random combination of the eigen-vectors)
+        x = random_state.randn(len(w))
+        if not np.allclose(np.dot(a, np.dot(v, x)), np.dot(v, w * x)):
+            raise NumericalError(
+                "Instability in eigh (condition number={:g})".format(
+                    (w.max() / w.min())))
+    elif check_stability:
         # XXX use a preconditioner?
         if not np.allclose(a, np.dot(v, w[:, np.newaxis] * v.T)):
             raise NumericalError(
@@ -319,19 +436,28 @@ def spd_pinv(a, rcond=1e-10, square_root=False, check_stability=True):
 
     # invert the "large enough" part of s
     cutoff = rcond * w.max()
-    for i in range(N):
-        if w[i] > cutoff:
-            if square_root:
-                # square root of the pseudo-inverse
-                w[i] = np.sqrt(1. / w[i])
-            else:
-                w[i] = 1. / w[i]
-        else:
-            w[i] = 0.
+    large = w > cutoff
+    w[large] = np.sqrt(1. / w[large]) if square_root else 1. / w[large]
+    w[~large] = 0.
     # compute the pseudo-inverse (using broadcasting)
     res = np.real(np.dot(v, w[:, np.newaxis] * v.T))
     # check stability of pseudo-inverse
-    if check_stability:
+    if check_stability == 'probe':
+        # a pinv(a) y = y, for y in the range of a
+        y = np.dot(a, np.dot(v, random_state.randn(len(w))))
+        approx_y = np.dot(res, y)
+        if square_root:
+            approx_y = np.dot(res, approx_y)
+            msg = "Instability in square-root of pseudo-inverse"
+        else:
+            msg = "Instability in pseudo-inverse"
+        approx_y = np.dot(a, approx_y)
+        if not np.allclose(y, approx_y):
+            # (relative error, as the scale of y is arbitrary)
+            mse = np.mean((y - approx_y) ** 2) / np.mean(y ** 2)
+            if mse > 1e-12:
+                raise NumericalError("{} (relative MSE on a probe={:g})".format(msg, mse))
+    elif check_stability:
         if square_root:
             pa = np.dot(res, res)
             approx_a = np.dot(a, np.dot(pa, a))
@@ -347,6 +473,50 @@ def spd_pinv(a, rcond=1e-10, square_root=False, check_stability=True):
     return res
 
 
+def eigh_solver(a, n_components=None, solver='full'):
+    """ Eigen-decomposition of a symetric matrix
+
+    Parameters
+    ----------
+    a: array_like, shape (N, N),
+       Symetric (not checked) matrix.
+
+    n_components: int, optional, default: None,
+                  number of largest eigen-values (and vectors) to compute,
+                  required by the truncated solvers (all if None)
+
+    solver: 'full', 'eigsh' or 'randomized', optional, default: 'full',
+            full LAPACK decomposition (numpy.linalg.eigh, then truncated),
+            Lanczos iterations (ARPACK, scipy.sparse.linalg.eigsh), or
+            randomized SVD (sklearn, assumes `a` is positive semi-definite)
+
+    Returns
+    -------
+    w: (n_components,) array,
+       the eigen-values (in ascending order)
+
+    v: (N, n_components) array,
+       the corresponding eigen-vectors (in columns)
+    """
+    N = a.shape[0]
+    if solver not in ('full', 'eigsh', 'randomized'):
+        raise ValueError("Unknown eigen-solver: {}".format(solver))
+    if solver != 'full' and n_components is None:
+        raise ValueError("The {} solver needs n_components".format(solver))
+
+    if solver == 'full' or n_components >= N - 1:
+        # (ARPACK cannot get all the eigen-values)
+        w, v = np.linalg.eigh(a)
+        if n_components is not None:
+            w, v = w[N - n_components:], v[:, N - n_components:]
+    elif solver == 'eigsh':
+        w, v = eigsh(a, k=n_components, which='LA')
+    else:
+        U, w, _ = randomized_svd(a, n_components, random_state=0)
+        w, v = w[::-1], U[:, ::-1]
+    return w, v
+
+
 class IndefiniteError(Exception):
     """Error raised on problematic non-positive-definiteness"""
     pass
@@ -357,7 +527,42 @@ class NumericalError(Exception):
     pass
 
 
-def build_geom_neighbor_graph(geoms, n_neighbors):
+def get_geom_neighbors_index(geoms):
+    """ Build a nearest neighbors index of the geometrical info (once)
+
+    Parameters
+    ----------
+    geoms: (n_pts, d) array,
+           the geometrical info
+
+    Returns
+    -------
+    query: function,
+           query(n_neighbors) returns the (n_pts, n_neighbors) array of the
+           ids of the nearest neighbors of every point (closest first)
+
+    Notes
+    -----
+    Uses pyflann if installed, scipy's cKDTree otherwise.
+    """
+    n_pts = geoms.shape[0]
+    if pyflann is not None:
+        pyflann.set_distance_type('euclidean')  # squared euclidean actually
+        fli = pyflann.FLANN()
+        fli.build_index(geoms, algorithm='kdtree')
+        _nn = lambda n_neighbors: fli.nn_index(geoms, num_neighbors=n_neighbors)[0]
+    else:
+        tree = cKDTree(geoms)
+        _nn = lambda n_neighbors: tree.query(geoms, k=n_neighbors)[1]
+
+    def query(n_neighbors):
+        gneighbs = _nn(n_neighbors)
+        return np.asarray(gneighbs, dtype=int).reshape((n_pts, n_neighbors))
+
+    return query
+
+
+def build_geom_neighbor_graph(geoms, n_neighbors, gneighbs=None):
     """ Computes the sparse CSR geometrical adjacency matrix gadj
 
     Parameters
@@ -368,6 +573,10 @@ def build_geom_neighbor_graph(geoms, n_neighbors):
     n_neighbors: int,
                  number of neighbors
 
+    gneighbs: (n_pts, >= n_neighbors) array, optional,
+              the already queried nearest neighbors of every point
+              (only their n_neighbors first columns are used)
+
     Returns
     -------
     gadj: (n_pts, n_pts) sparse CSR array,
@@ -379,39 +588,66 @@ def build_geom_neighbor_graph(geoms, n_neighbors):
     gadj might not be symmetric!
     """
     n_pts = geoms.shape[0]
-    pyflann.set_distance_type('euclidean')  # squared euclidean actually
-    fli = pyflann.FLANN()
-    build_params = dict(algorithm='kdtree', num_neighbors=n_neighbors)
-    gneighbs, _ = fli.nn(geoms, geoms, **build_params)
+    if gneighbs is None:
+        gneighbs = get_geom_neighbors_index(geoms)(n_neighbors)
     data = np.ones((n_pts, n_neighbors), dtype='u1')
     indptr = np.arange(0, n_pts * n_neighbors + 1, n_neighbors, dtype=int)
     gadj = sparse.csr_matrix(
-        (data.ravel(), gneighbs.ravel(), indptr), shape=(n_pts, n_pts))
+        (data.ravel(), gneighbs[:, :n_neighbors].ravel(), indptr),
+        shape=(n_pts, n_pts))
     return gadj
 
 
-def build_sym_geom_adjacency(geoms, max_gnn=100):
+def build_sym_geom_adjacency(geoms, max_gnn=100, min_gnn=None):
     """ Return the sparsest yet maximally connected symetric geometrical adjacency matrix
+
+    Notes
+    -----
+    The connectedness only grows with the number of neighbors: the index is
+    built once, queried for twice as many neighbors until the graph gets
+    connected (or max_gnn is reached), then the smallest connected number of
+    neighbors is binary searched among the prefixes of the neighbor lists.
     """
     global INTERNAL_PARAMETERS
-    min_gnn = INTERNAL_PARAMETERS['min_geom_neighbors']
+    if min_gnn is None:
+        min_gnn = INTERNAL_PARAMETERS['min_geom_neighbors']
     assert min_gnn < max_gnn, "Too high minimum number of neighbors"
     n_pts = geoms.shape[0]
-    for n_neighbors in range(min_gnn, max_gnn + 1):
-        # find the lowest number of NN s.t. the graph is not too disconnected
-        C = build_geom_neighbor_graph(geoms, n_neighbors)
-        neighbs = C.indices.reshape((n_pts, n_neighbors))
+    max_gnn = min(max_gnn, n_pts)
+    query = get_geom_neighbors_index(geoms)
+
+    def _sym_adjacency(n_neighbors):
+        C = build_geom_neighbor_graph(geoms, n_neighbors, gneighbs=gneighbs)
         C = C + C.T
         C.data[:] = 1
-        n_comp, _ = sparse.cs_graph_components(C)
-        if n_comp == 1:
-            print "# use n_neighbors=%d" % n_neighbors
-            break
-        elif n_comp < 1:
+        n_comp, _ = connected_components(C, directed=False)
+        if n_comp < 1:
             raise ValueError('Bug: n_comp=%d' % n_comp)
-    if n_comp > 1:
-        print "# use maximum n_neighbors=%d (%d components)" % (
-            n_neighbors, n_comp)
+        return n_comp, C
+
+    # find an upper bound of the lowest number of NN s.t. the graph is connected
+    lo, hi = None, min(min_gnn, max_gnn)
+    while True:
+        gneighbs = query(hi)
+        n_comp, C = _sym_adjacency(hi)
+        if n_comp == 1 or hi == max_gnn:
+            break
+        lo, hi = hi, min(2 * hi, max_gnn)
+
+    if n_comp == 1:
+        # binary search the lowest number of NN in (lo, hi]
+        while lo is not None and hi - lo > 1:
+            mid = (lo + hi) // 2
+            _n_comp, _C = _sym_adjacency(mid)
+            if _n_comp == 1:
+                hi, C = mid, _C
+            else:
+                lo = mid
+        print "# use n_neighbors=%d" % hi
+    else:
+        print "# use maximum n_neighbors=%d (%d components)" % (hi, n_comp)
+
+    neighbs = np.ascontiguousarray(gneighbs[:, :hi])
     return n_comp, C, neighbs
 
 
@@ -423,8 +659,11 @@ def allclose_rows(X):
     return np.sum(np.diff(X, axis=0) ** 2) < 1e-10
 
 
-def get_kmeans_split(X):
+def get_kmeans_split(X, random_state=None):
     """ Returns the list of row labels obtained by k-means with k == 2
+
+    random_state: int or RandomState, optional, default: None,
+                  the seed of the k-means (numpy's global generator if None)
     """
 
     n_pts, n_dims = X.shape
@@ -439,9 +678,11 @@ def get_kmeans_split(X):
     if n_pts > 1e3:
         model = MiniBatchKMeans(
             n_clusters=2, init="k-means++", max_iter=30, batch_size=1000,
-            compute_labels=True, max_no_improvement=None, n_init=5)
+            compute_labels=True, max_no_improvement=None, n_init=5,
+            random_state=random_state)
     else:
-        model = KMeans(n_clusters=2, init="k-means++", n_init=5, max_iter=100)
+        model = KMeans(n_clusters=2, init="k-means++", n_init=5, max_iter=100,
+                       random_state=random_state)
 
     model.fit(X)
     labels = model.labels_
@@ -481,6 +722,11 @@ class PriorityQueue(object):
         _, _, obj = heapq.heappop(self._heap)
         return obj
 
+    def objects(self):
+        """ Returns the objects in the queue (in no particular order)
+        """
+        return [obj for _, _, obj in self._heap]
+
 
 class SpectralNode(object):
     """ A node used to split points by thresholding a single eigen-vector
@@ -506,6 +752,10 @@ class SpectralNode(object):
 
     thresh: float,
             the threshold used to split along the projection on the selected eigen-vector
+
+    outliers: list of arrays,
+              the ids of the points discarded as outliers while splitting
+              (k-means splits only)
     """
 
     def __init__(self, ids, vec, score=None, name=""):
@@ -518,6 +768,7 @@ class SpectralNode(object):
         self.name = name  # binary string path: 0 for left, 1 for right
         self.has_children = False
         self.thresh = None
+        self.outliers = []
 
     @property
     def minus_priority(self):
@@ -560,7 +811,7 @@ class SpectralTree(object):
     """
 
     def __init__(self, E, ngeoms, min_leaf_size, max_leaf_size, min_leaves,
-                 max_depth, min_evect_amplitude, split_type, n_threshs):
+                 max_depth, min_evect_amplitude, split_type, n_threshs, min_gnn=None):
         """ Initialize with empty tree
 
         Parameters
@@ -600,6 +851,10 @@ class SpectralTree(object):
         n_threshs: int,
                    number of evenly-spaced in (0, 1) thresholds to try for splitting
 
+        min_gnn: int, optional,
+                 minimum number of geometrical neighbors of the points
+                 (INTERNAL_PARAMETERS['min_geom_neighbors'] by default)
+
         """
 
         self.E = E
@@ -636,7 +891,7 @@ class SpectralTree(object):
             self.percentiles = np.linspace(0.10, 0.90, num=self.n_threshs)
 
         # build the geom adjacency matrix (used for scoring)
-        _, self._gadj, self._gneighbs = build_sym_geom_adjacency(ngeoms)
+        _, self._gadj, self._gneighbs = build_sym_geom_adjacency(ngeoms, min_gnn=min_gnn)
 
     def _get_tube_connectedness(self, tube_idxs):
         """ Return the connectedness measure of the tube
@@ -651,21 +906,86 @@ class SpectralTree(object):
         connectedness: float in [0, 1],
                        1/#connected components
         """
-        # extract the rows of self._gadj which are in the tube
-        ids = self._gadj.indices
-        iptr = self._gadj.indptr
-        sub_indices = np.hstack(
-            [ids[iptr[i]:iptr[i + 1]] for i in tube_idxs]).astype(ids.dtype)
-        sub_indptr = np.zeros_like(iptr)
-        sub_indptr[tube_idxs + 1] = iptr[tube_idxs + 1] - iptr[tube_idxs]
-        sub_indptr = np.cumsum(sub_indptr, dtype=iptr.dtype)
-        _conn_labs = np.empty((self.n_pts,), dtype=iptr.dtype)
-        num_conn = cs_graph_components(
-            self.n_pts, sub_indptr, sub_indices, _conn_labs)
+        # connected components of the subgraph induced by the tube
+        # (the edges to points outside of the tube are ignored)
+        num_conn, _ = connected_components(
+            self._gadj[tube_idxs][:, tube_idxs], directed=False)
         assert num_conn > 0, "BUG: negative or null num_conn %d" % num_conn
         connectedness = 1. / num_conn
         return connectedness
 
+    def _get_tube_edges(self, tube_idxs):
+        """ Return the geometrical adjacencies between the points of the tube
+
+        Parameters
+        ----------
+        tube_idxs: (tube_size, ) array,
+                   the ids of the points in the tube we're interested in
+
+        Returns
+        -------
+        rows, cols: (n_edges, ) arrays,
+                    the edges (i < j) of the subgraph induced by the tube
+                    (as positions in tube_idxs)
+        """
+        sub_gadj = self._gadj[tube_idxs][:, tube_idxs].tocoo()
+        upper = sub_gadj.row < sub_gadj.col
+        return sub_gadj.row[upper], sub_gadj.col[upper]
+
+    def _get_sweep_connectedness(self, edges, evs):
+        """ Return the number of connected components of all the tubes
+        obtained by thresholding the projections of a tube at once
+
+        Parameters
+        ----------
+        edges: pair of (n_edges, ) arrays,
+               the edges of the tube (see _get_tube_edges)
+
+        evs: (tube_size, ) array,
+             the projections of the points of the tube on an eigen-vector
+
+        Returns
+        -------
+        sorted_evs: (tube_size, ) array,
+                    the sorted projections
+
+        n_conn_below: (tube_size + 1, ) array,
+                      n_conn_below[p] is the number of connected components
+                      of the p points with the smallest projections
+
+        n_conn_above: (tube_size + 1, ) array,
+                      n_conn_above[q] is the number of connected components
+                      of the q points with the largest projections
+
+        Notes
+        -----
+        Adding the points one by one in the order of their projections, the
+        number of components of the tube made of the first p points is p
+        minus the number of merges (edges joining two components) so far,
+        like in an incremental union-find. An edge can only be added once
+        both its ends are, so it is weighted by the (1-based) rank of the last
+        one: Kruskal's algorithm on these weights performs exactly the merges
+        of the sweep, and the weights of any minimum spanning forest are the
+        times at which they occur.
+        """
+        rows, cols = edges
+        n = len(evs)
+        order = np.argsort(evs, kind='mergesort')
+        ranks = np.empty((n,), dtype=np.int64)
+        ranks[order] = np.arange(n)
+        sizes = np.arange(n + 1)
+
+        n_conn = []
+        for _ranks in (ranks, n - 1 - ranks):
+            # sweep in increasing (below), then decreasing (above) projections
+            times = np.maximum(_ranks[rows], _ranks[cols]) + 1.
+            msf = minimum_spanning_tree(
+                sparse.csr_matrix((times, (rows, cols)), shape=(n, n)))
+            n_merges = np.searchsorted(np.sort(msf.data), sizes, side='right')
+            n_conn.append(sizes - n_merges)
+
+        return evs[order], n_conn[0], n_conn[1]
+
     def _get_tube_label_density(self, tube_idxs):
         """ Return the average local label agreement of the tube
 
@@ -682,7 +1002,8 @@ class SpectralTree(object):
         # get the indexes of the nearest neighbors of all tube points
         gneighbs = self._gneighbs[tube_idxs]
         # count the number of neighbors in the tube
-        fbl = np.zeros((self.n_pts, ), dtype=bool)
+        # (+1: the neighbors out of a restricted tree, see _restrict)
+        fbl = np.zeros((self.n_pts + 1, ), dtype=bool)
         fbl[tube_idxs] = True
         nnt = fbl[gneighbs].sum()
         assert nnt > len(
@@ -790,6 +1111,7 @@ class SpectralTree(object):
             best_score = None
 
         left, right = None, None
+        edges = None  # the adjacencies within the node (computed once)
 
         # iterate over embedding dimensions (first ones are more reliable)
         # up to max_n_vec (included), until we found an improving split
@@ -798,19 +1120,25 @@ class SpectralTree(object):
             # get the candidate thresholds along this dimension
             threshs = self._get_candidate_thresholds(node, _vec)
 
+            # score the tubes of all the thresholds in a single sweep
+            if len(threshs) > 0:
+                evs = self.E[node.ids, _vec]
+                if edges is None:
+                    edges = self._get_tube_edges(node.ids)
+                sorted_evs, n_conn_below, n_conn_above = \
+                    self._get_sweep_connectedness(edges, evs)
+
             # look for an improving best split along this eigenvector
             for _t in threshs:
-                # compute the split
-                below_thresh = self.E[node.ids, _vec] < _t
-                _lids = node.ids[below_thresh]
-                _rids = node.ids[np.logical_not(below_thresh)]
                 # check if the tubes are not too small
-                _nl, _nr = len(_lids), len(_rids)
+                _nl = np.searchsorted(sorted_evs, _t, side='left')
+                _nr = node.size - _nl
                 is_valid = _nl >= self.min_leaf_size and _nr >= self.min_leaf_size
                 if is_valid:
-                    # compute the score of the new tubes only
-                    _sl = self.get_tube_score(_lids)
-                    _sr = self.get_tube_score(_rids)
+                    # get the score of the new tubes only
+                    # (same as get_tube_score)
+                    _sl = np.sqrt(1. / n_conn_below[_nl])
+                    _sr = np.sqrt(1. / n_conn_above[_nr])
                     # get the score of this split
                     split_score = min(_sl, _sr)
                     if best_score is None or split_score > best_score:
@@ -818,10 +1146,13 @@ class SpectralTree(object):
                         best_score = split_score
                         node.has_children = True
                         node.thresh = _t
+                        below_thresh = evs < _t
                         left = SpectralNode(
-                            _lids, _vec, score=_sl, name=node.name + "0")
+                            node.ids[below_thresh], _vec, score=_sl,
+                            name=node.name + "0")
                         right = SpectralNode(
-                            _rids, _vec, score=_sr, name=node.name + "1")
+                            node.ids[np.logical_not(below_thresh)], _vec,
+                            score=_sr, name=node.name + "1")
 
             # check stopping criterion
             if node.has_children:
@@ -853,9 +1184,13 @@ class SpectralTree(object):
             # no limit on outliers: always split
             max_outliers = np.inf
 
+        # seeded by the node (its path), so that its split does not depend on
+        # the order in which the nodes are split (e.g. in parallel)
+        random_state = np.random.RandomState(zlib.crc32(node.name) & 0xffffffff)
+
         # iterate until valid split or reached max outliers
         while n_outliers < max_outliers:
-            labels = get_kmeans_split(self.E[ids])
+            labels = get_kmeans_split(self.E[ids], random_state=random_state)
             if labels is None:
                 # could not split
                 break
@@ -884,13 +1219,13 @@ class SpectralTree(object):
                 break
             elif _nl < self.min_leaf_size and _nr >= self.min_leaf_size:
                 # left children is too small: add as outlier
-                self.labels[_lids] = -1
+                node.outliers.append(_lids)
                 n_outliers += _nl
                 # carry on with this subset
                 ids = _rids
             elif _nr < self.min_leaf_size and _nl >= self.min_leaf_size:
                 # right children is too small: add as outlier
-                self.labels[_rids] = -1
+                node.outliers.append(_rids)
                 n_outliers += _nr
                 # carry on with this subset
                 ids = _lids
@@ -952,6 +1287,13 @@ class SpectralTree(object):
         -----
         Additionally updates the labels and number of clusters.
         """
+        left, right = self._bipartition(node)
+        self._register_split(node, right)
+        return left, right
+
+    def _bipartition(self, node):
+        """ Split a node in two, without updating the labels (see split)
+        """
         # check node was not already split
         if node.has_children:
             raise SplitError("BUG: node was already split")
@@ -1001,18 +1343,41 @@ class SpectralTree(object):
                 msg += ' not enough clusters ({0} < min_leaves={1})\n'
                 sys.stderr.write(msg.format(self.n_clusters, self.min_leaves))
 
+        return left, right
+
+    def _register_split(self, node, right):
+        """ Update the labels and number of clusters with the split of a node
+        """
+        # mark the outliers
+        for _ids in node.outliers:
+            self.labels[_ids] = -1
+
         # finalize the split
         if node.has_children:
             # update the labels of right child only (left keeps the same)
             self.labels[right.ids] = self.n_clusters
             self.n_clusters += 1
 
-        return left, right
-
-    def build(self, verbose=True):
+    def build(self, verbose=True, nt=1, backend='threading'):
         """Recursively split in two, starting from a cluster containing all points
 
         The nodes to split are decided based on a priority queue (cf. SpectralNode).
+
+        Parameters
+        ----------
+        nt: int,
+            number of workers (1: serial)
+
+        backend: str,
+                 the parallelization backend (see parallelism.run_parallel)
+
+        Notes
+        -----
+        Once there are min_leaves clusters, the split of a node does not
+        depend on the others anymore. With nt > 1, the subtrees of the nodes
+        left to split are then split in parallel, and their splits are
+        registered in the order of the priority queue, so that labels and
+        int_paths are the same as the serial ones.
         """
         # initially: one cluster
         self.labels = np.zeros((self.n_pts, ), dtype=int)
@@ -1027,10 +1392,19 @@ class SpectralTree(object):
 
         # recursively split
         #nrecs = 0
+        splits = None  # the splits of the independent subtrees (by node name)
         while len(to_split) > 0:
+            if nt > 1 and splits is None and self.n_clusters >= self.min_leaves:
+                splits = self._split_subtrees(to_split.objects(), nt, backend)
+
             # get the node with highest priority
             node = to_split.pop()
-            left, right = self.split(node)
+            if splits is not None:
+                # already split: only register the split
+                node, left, right = splits[node.name]
+                self._register_split(node, right)
+            else:
+                left, right = self.split(node)
 
             # push to the priority queue
             if node.has_children:
@@ -1053,6 +1427,72 @@ class SpectralTree(object):
         assert self.n_clusters >= self.min_leaves, \
             "BUG: not enough clusters {0}".format(self.n_clusters)
 
+    def _split_subtrees(self, nodes, nt, backend):
+        """ Split the (independent) subtrees of some nodes in parallel
+
+        Returns
+        -------
+        splits: dict,
+                the (node, left, right) split of every node of the subtrees,
+                by node name
+        """
+        splits = {}
+
+        # split the nodes level by level until there are enough subtrees to feed the workers
+        while 0 < len(nodes) < 2 * nt:
+            ret = self._run_split_subtrees(nodes, 1, nt, backend)
+            nodes = []
+            for _splits, _pending in ret:
+                splits.update(_splits)
+                nodes += _pending
+
+        # split the whole subtrees, biggest first
+        for _splits, _ in self._run_split_subtrees(nodes, None, nt, backend):
+            splits.update(_splits)
+
+        return splits
+
+    def _run_split_subtrees(self, nodes, depth, nt, backend):
+        """ Run _split_subtree on every node, each job getting only the points
+        of its node (see _restrict), and return their results with the ids of
+        the points of the tree
+        """
+        ret = run_parallel(
+            [delayed(_split_subtree)(
+                self._restrict(node.ids),
+                SpectralNode(np.arange(node.size), node.vec, score=node.score, name=node.name),
+                depth)
+             for node in nodes],
+            nt=nt, backend=backend, costs=[node.size for node in nodes])
+
+        for node, (_splits, _pending) in zip(nodes, ret):
+            # (the same node can be in several splits, as a child and as a parent)
+            _nodes = [n for split in _splits.values() for n in split if n is not None] + _pending
+            for n in dict((id(n), n) for n in _nodes).values():
+                n.ids = node.ids[n.ids]
+                n.outliers = [node.ids[_ids] for _ids in n.outliers]
+        return ret
+
+    def _restrict(self, ids):
+        """ Return a copy of the tree restricted to some points (re-indexed
+        from 0 to len(ids) - 1), to split the nodes of those points without
+        the rest of the tree
+
+        The geometrical neighbors out of the points are mapped to len(ids).
+        """
+        tree = SpectralTree.__new__(SpectralTree)
+        tree.__dict__.update(self.__dict__)
+        tree.E = self.E[ids]
+        tree.ngeoms = self.ngeoms[ids]
+        tree.n_pts = len(ids)
+        tree._gadj = self._gadj[ids][:, ids]
+        local = np.empty((self.n_pts, ), dtype=self._gneighbs.dtype)
+        local.fill(len(ids))
+        local[ids] = np.arange(len(ids))
+        tree._gneighbs = local[self._gneighbs[ids]]
+        tree.labels = tree.int_paths = None  # (not updated by the splits)
+        return tree
+
     def _print_split_infos(self, node, left, right, left_to_split):
         """ Print DEBUG infos about the split of 'node' in 'left' and 'right'
         """
@@ -1075,4 +1515,33 @@ class SpectralTree(object):
         infos['size'] = node.size
         infos['path'] = node.name
         print DEBUG_info.format(**infos)
-        sys.stdout.flush()
\ No newline at end of file
+        sys.stdout.flush()
+
+
+def _split_subtree(tree, node, depth=None):
+    """ Split a node and its descendants, down to depth levels below it (all by default)
+
+    Returns
+    -------
+    splits: dict,
+            the (node, left, right) split of every split node, by node name
+
+    pending: list,
+             the nodes left to split (at depth levels below node)
+
+    Notes
+    -----
+    The labels of the tree are not updated (see SpectralTree._register_split).
+    """
+    splits, pending = {}, []
+    to_split = [(node, 0)]
+    while len(to_split) > 0:
+        node, d = to_split.pop()
+        if depth is not None and d >= depth:
+            pending.append(node)
+            continue
+        left, right = tree._bipartition(node)
+        splits[node.name] = (node, left, right)
+        if node.has_children:
+            to_split += [(left, d + 1), (right, d + 1)]
+    return splits, pending
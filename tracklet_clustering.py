@@ -1,28 +1,47 @@
 __author__ = 'aclapes'
 
-from os.path import isfile, exists, join
-from os import makedirs
+from os.path import isfile, exists, join, dirname
+from os import makedirs, rename, fdopen, chmod
+import argparse
 import cPickle
+import json
 import random
+import tempfile
 import time
 from math import isnan
 import sys
 
 import numpy as np
-from sklearn.metrics import pairwise
 from sklearn.decomposition import PCA
+from sklearn.utils import check_random_state
 
-from spectral_division import spectral_embedding_nystrom, spectral_clustering_division, reconstruct_tree_from_leafs, IndefiniteError, NumericalError
+import spectral_division
+from spectral_division import spectral_embedding_nystrom_blocked, spectral_clustering_division, reconstruct_tree_from_leafs, IndefiniteError, NumericalError
+
+import tracklet_store
+import cluster_cache
 
 import cv2
-from joblib import delayed, Parallel
+from joblib import delayed
+from parallelism import run_parallel
 
 
 INTERNAL_PARAMETERS = dict(
     initial_ridge_value = 1e-10,
-    tries_per_ridge_value = 3
+    tries_per_ridge_value = 3,
+    # multimodal product kernel
+    kernel_block_bytes = 1 << 26,  # size of the (float64) tiles of the kernel computed at once
+    median_sample_size = 1000,  # max number of rows and columns of the distances used to estimate the medians
+    # nystrom spectral embedding
+    nystrom_memory_bytes = 1 << 31,  # max size of the (float32) similarities B kept in memory (otherwise, computed lazily)
+    nystrom_solver = 'full',  # eigen-solver: 'full', 'eigsh', or 'randomized' (see spectral_division.eigh_solver)
+    nystrom_check_stability = True,  # True, 'probe' (cheap check on a random vector), or False
+    random_seed = 0,  # seed of the subsampling of the tracklets (None: not reproducible)
 )
 
+# parameters not affecting the results (not part of the keys of the cached results)
+_EXECUTION_PARAMETERS = ['kernel_block_bytes', 'nystrom_memory_bytes', 'nystrom_block_bytes', 'build_nt', 'build_backend']
+
 def cluster(tracklets_path, videonames, clusters_path, verbose=False, visualize=False):
     inds = np.linspace(0, len(videonames)-1, len(videonames))
     _cluster(tracklets_path, videonames, inds, tracklets_path, verbose=verbose, visualize=visualize)
@@ -33,17 +52,19 @@ def cluster_multiprocess(tracklets_path, videonames, st, num_videos, clusters_pa
     _cluster(tracklets_path, videonames, inds, tracklets_path, verbose=verbose, visualize=False)
 
 
-def cluster_multithread(tracklets_path, videonames, clusters_path, nt=4, verbose=False):
-    inds = np.random.permutation(len(videonames)).astype('int')
-    # inds = np.linspace(0,len(videonames)-1,len(videonames)).astype('int')
-    # step = np.int(np.floor(len(inds)/nt)+1)
-    Parallel(n_jobs=nt, backend='threading')(delayed(_cluster)(tracklets_path, videonames, \
-                                                               [i], \
-                                                               clusters_path, verbose=verbose, visualize=False)
-                                                     for i in inds)
+def cluster_multithread(tracklets_path, videonames, clusters_path, nt=4, backend='threading', cache_path=None, verbose=False):
+    inds = np.linspace(0,len(videonames)-1,len(videonames)).astype('int')
+    stats = run_parallel([delayed(_cluster)(tracklets_path, videonames, \
+                                            [i], \
+                                            clusters_path, verbose=verbose, visualize=False, cache_path=cache_path)
+                          for i in inds], nt=nt, backend=backend,
+                         costs=[tracklet_store.get_num_tracklets(tracklets_path, videonames[i]) for i in inds],
+                         name='cluster', verbose=verbose)
+    if verbose:
+        print('[cluster_multithread] cache: %s' % cluster_cache.format_stats(cluster_cache.merge_stats(stats)))
 
 
-def _cluster(tracklets_path, videonames, indices, clusters_path, verbose=False, visualize=False):
+def _cluster(tracklets_path, videonames, indices, clusters_path, verbose=False, visualize=False, cache_path=None):
     """
     This function implements the method described in Section 2 ("Clustering dense tracklets")
     of the paper 'Activity representation with motion hierarchies' (IJCV, 2014).
@@ -52,107 +73,62 @@ def _cluster(tracklets_path, videonames, indices, clusters_path, verbose=False,
     :param indices:
     :param clusters_path:
     :param visualize:
-    :return:
+    :param cache_path: the root of the cache of embeddings and clusters (see cluster_cache). By default, in
+    clusters_path/cache/.
+    :return: the statistics of the accesses to the cache.
     """
 
     if not exists(clusters_path):
         makedirs(clusters_path)
+    if cache_path is None:
+        cache_path = join(clusters_path, 'cache')
+    stats = cluster_cache.new_stats()
 
     # process the videos
     total = len(videonames)
     for i in indices:
-        if isfile(join(clusters_path, videonames[i] + '.pkl')):
-            if verbose:
-                print('[_cluster] %s -> OK' % videonames[i])
-            continue
-
         try:
-            with open(join(tracklets_path, 'obj', videonames[i] + '.pkl'), 'rb') as f:
-                data_obj = cPickle.load(f)
-            with open(join(tracklets_path, 'trj', videonames[i] + '.pkl'), 'rb') as f:
-                data_trj = cPickle.load(f)
+            data_obj = tracklet_store.load_tracklets(tracklets_path, 'obj', videonames[i])
+            data_trj = tracklet_store.load_tracklets(tracklets_path, 'trj', videonames[i])
         except IOError:
             sys.stderr.write("[Error] Tracklet files not found for %s." % videonames[i])
             continue
 
-        start_time = time.time()
-        # (Sec. 2.2) get a dictionary of separate channels
-        D = dict()
-        for k in xrange(data_obj.shape[0]): # range(0,100):  #
-            T = np.reshape(data_trj[k], (data_trj.shape[1]/2,2))  # trajectory features into matrix (time length x 2)
-            D.setdefault('x',[]).append( T[1:,0] )  # x's offset + x's relative displacement
-            D.setdefault('y',[]).append( T[1:,1] )  #  y's offset + y's relative displacement
-            D.setdefault('t',[]).append( data_obj[k,0] - np.linspace(T.shape[0]-1, 0, T.shape[0]) )
-            D.setdefault('v_x',[]).append( T[1:,0] - T[:-1,0] )
-            D.setdefault('v_y',[]).append( T[1:,1] - T[:-1,1] )
-
-        # (Sec. 2.3.1)
-        # A, B = get_tracklet_similarities(D, data_obj[:,7:9])
-        # create a subsample (n << N) stratified by a grid
-        prob = 0.01
-        ret = False
-        while not ret:
-            insample, outsample = stratified_subsample_of_tracklets_in_grid(data_obj[:,7:9], p=prob)
-            if len(insample) > 2:
-                ret = True
-            else:
-                prob *= 10
-
-        # get the similarities of
-        A, medians = multimodal_product_kernel(D, insample, insample)  # (n), n << N tracklets
-        B, _ = multimodal_product_kernel(D, insample, outsample, medians=medians)  # (N - n) tracklets
-        # (Sec. 2.3.2 and 2.3.3)
-        AB = np.hstack((A,B)).astype('float64')
-
-        ridge = INTERNAL_PARAMETERS['initial_ridge_value']
-        success = False
-        while not success:
-            try:
-                E_ = spectral_embedding_nystrom(AB, ridge=ridge)
-                success = True
-            except (IndefiniteError, NumericalError, ValueError) as e:
-                # warn the user
-                # msg = "WARNING: increasing ridge, {0:.0e} -> {1:.0e}.\n"
-                # sys.stderr.write(msg.format(ridge, ridge * 10))
-                # sys.stderr.flush()
-                # # increase the ridge value
-                # if ridge >= 1e-6:
-                #     ridge = -1
-                #     break
-                # ridge *= 10
-                break
-
-        if not success:
-            n_left = np.count_nonzero(data_obj[:,0] <= np.median(data_obj[:,0]))
-            best_labels = ([0] * n_left) + ([1] * (data_obj.shape[0]-n_left))
-            int_paths = ([2] * n_left) + ([3] * (data_obj.shape[0]-n_left))
-        else:
-            # re-organize E rows according to in- and out-sample indices
-            E = np.zeros(E_.shape, dtype=E_.dtype)
-            E[insample,:] = E_[:len(insample),:]
-            E[outsample,:] = E_[len(insample):,:]
+        # the results are only valid for the same tracklets and parameters
+        embedding_key = _get_embedding_key(data_obj, data_trj)
+        clusters_key = _get_clusters_key(embedding_key)
 
-            # (Sec. 2.4)
-            best_labels, int_paths = spectral_clustering_division(E, data_obj[:,7:10])
-        tree = reconstruct_tree_from_leafs(np.unique(int_paths))
+        clusters_filepath = join(clusters_path, videonames[i] + '.pkl')
+        if _has_clusters(clusters_filepath, clusters_key):
+            if verbose:
+                print('[_cluster] %s -> OK' % videonames[i])
+            continue
+
+        start_time = time.time()
+        clusters = cluster_cache.load_entry(cache_path, 'clusters', clusters_key, stats=stats)
+        if clusters is None:
+            embedding = _load_or_get_embedding(data_obj, data_trj, embedding_key, cache_path, stats)
+            clusters = get_clusters(embedding, data_obj)
+            cluster_cache.save_entry(cache_path, 'clusters', clusters_key, clusters, stats=stats)
+        best_labels, int_paths, tree = clusters['best_labels'], clusters['int_paths'], clusters['tree']
 
         elapsed_time = time.time() - start_time
         if verbose:
-            print('[_cluster] %s -> %s (in %.2f secs)' % (join(clusters_path, videonames[i] + '.pkl'), 'YES' if success else 'NO', elapsed_time))
+            print('[_cluster] %s -> %s (in %.2f secs)' % (clusters_filepath, 'YES' if clusters['success'] else 'NO', elapsed_time))
 
-        with open(join(clusters_path, videonames[i] + '.pkl'), 'wb') as f:
-            cPickle.dump({'best_labels' : best_labels, 'int_paths' : int_paths, 'tree' : tree, 'ridge' : ridge}, f)
+        clusters['key'] = clusters_key
+        _save_clusters(clusters_filepath, clusters)
 
         # DEBUG
         # -----
         if visualize:
             xres, yres = 528, 224
             A = np.zeros((yres,1280,3), dtype=np.uint8)
-            n_unique_paths = len(np.unique(tree.keys()))
+            n_unique_paths = len(tree)
 
             sorted_keys = sorted(tree.keys(), key=lambda x : x)
             for i, key in enumerate(sorted_keys):
-                node = tree[key]
+                node = tree.get_leafs(key)
                 cluster_inds = np.concatenate([np.where(int_paths == i)[0] for i in node])
 
                 hue = ((float(i)/n_unique_paths) + random.random()) % 1
@@ -171,12 +147,185 @@ def _cluster(tracklets_path, videonames, indices, clusters_path, verbose=False,
                 cv2.waitKey(0)
         # -----
 
+    return stats
+
+
+def cluster_parameter_sweep(tracklets_path, videonames, clusters_path, param_sets, nt=4, backend='threading',
+                            cache_path=None, verbose=False):
+    """
+    Cluster the videos with several sets of parameters of the tree split, from the same (stored) embeddings.
+    Only the trees are computed, once the embeddings are (by _cluster, or by this function if they are not stored).
+    :param tracklets_path:
+    :param videonames:
+    :param clusters_path: the clusters of every set are stored in clusters_path/<name of the set>/
+    :param param_sets: a dictionary of parameter sets (see spectral_division.INTERNAL_PARAMETERS), by name,
+    e.g. {'kmeans' : {'split_type' : 'kmeans'}, 'min50' : {'min_tube_size' : 50}}.
+    :param cache_path: the root of the cache of embeddings and clusters (by default, in clusters_path/cache/).
+    :return:
+    """
+    if cache_path is None:
+        cache_path = join(clusters_path, 'cache')
+
+    inds = np.linspace(0,len(videonames)-1,len(videonames)).astype('int')
+    stats = run_parallel([delayed(_cluster_parameter_sweep)(tracklets_path, videonames[i], clusters_path, param_sets,
+                                                            cache_path, verbose=verbose)
+                          for i in inds], nt=nt, backend=backend,
+                         costs=[tracklet_store.get_num_tracklets(tracklets_path, videonames[i]) for i in inds],
+                         name='cluster_parameter_sweep', verbose=verbose)
+    if verbose:
+        print('[cluster_parameter_sweep] cache: %s' % cluster_cache.format_stats(cluster_cache.merge_stats(stats)))
+
+
+def _cluster_parameter_sweep(tracklets_path, videoname, clusters_path, param_sets, cache_path, verbose=False):
+    stats = cluster_cache.new_stats()
+    try:
+        data_obj = tracklet_store.load_tracklets(tracklets_path, 'obj', videoname)
+        data_trj = tracklet_store.load_tracklets(tracklets_path, 'trj', videoname)
+    except IOError:
+        sys.stderr.write("[Error] Tracklet files not found for %s." % videoname)
+        return stats
+
+    embedding_key = _get_embedding_key(data_obj, data_trj)
+    embedding = None  # (loaded once, if needed)
+    for name, params in sorted(param_sets.iteritems()):
+        start_time = time.time()
+        clusters_key = _get_clusters_key(embedding_key, params)
+        clusters = cluster_cache.load_entry(cache_path, 'clusters', clusters_key, stats=stats)
+        if clusters is None:
+            if embedding is None:
+                embedding = _load_or_get_embedding(data_obj, data_trj, embedding_key, cache_path, stats)
+            clusters = get_clusters(embedding, data_obj, params=params)
+            cluster_cache.save_entry(cache_path, 'clusters', clusters_key, clusters, stats=stats)
+
+        try:
+            makedirs(join(clusters_path, name))
+        except OSError:
+            pass
+        clusters['key'] = clusters_key
+        _save_clusters(join(clusters_path, name, videoname + '.pkl'), clusters)
+
+        elapsed_time = time.time() - start_time
+        if verbose:
+            print('[_cluster_parameter_sweep] %s -> %d leaves (in %.2f secs)'
+                  % (join(clusters_path, name, videoname + '.pkl'), len(np.unique(clusters['int_paths'])), elapsed_time))
+
+    return stats
+
+
+def get_embedding(data_obj, data_trj, random_state=None):
+    """
+    Get the spectral embedding of the tracklets of a video (Sec. 2.2 and 2.3).
+    :param data_obj:
+    :param data_trj:
+    :param random_state: seed or numpy RandomState of the subsampling of the tracklets.
+    :return: a dictionary with the embedding 'E' (empty if it failed), whether it succeeded ('success'), the
+    'ridge', the 'insample' and 'outsample' tracklets, and the 'medians' of the kernel's channels.
+    """
+    random_state = check_random_state(random_state)
+
+    # (Sec. 2.2) get a dictionary of separate channels
+    D = get_tracklet_channels(data_obj, data_trj)
+
+    # (Sec. 2.3.1)
+    # A, B = get_tracklet_similarities(D, data_obj[:,7:9])
+    # create a subsample (n << N) stratified by a grid
+    prob = 0.01
+    ret = False
+    while not ret:
+        insample, outsample = stratified_subsample_of_tracklets_in_grid(data_obj[:,7:9], p=prob, random_state=random_state)
+        if len(insample) > 2:
+            ret = True
+        else:
+            prob *= 10
+
+    # get the similarities of
+    D_insample = gather_channels(D, insample)  # (the n << N insample tracklets in float64, gathered once)
+    A, medians = multimodal_product_kernel(D, insample, insample, random_state=random_state,
+                                           D_primary=D_insample)  # (n), n << N tracklets
+    if len(insample) * len(outsample) * 4 <= INTERNAL_PARAMETERS['nystrom_memory_bytes']:
+        B, _ = multimodal_product_kernel(D, insample, outsample, medians=medians, D_primary=D_insample)  # (N - n) tracklets
+    else:  # (too long a video: compute B by blocks every time it is needed, never keeping it in memory)
+        B = lambda st, en: multimodal_product_kernel(D, insample, outsample[st:en], medians=medians,
+                                                     D_primary=D_insample)[0]
+    # (Sec. 2.3.2 and 2.3.3)
+
+    ridge = INTERNAL_PARAMETERS['initial_ridge_value']
+    success = False
+    while not success:
+        try:
+            E_ = spectral_embedding_nystrom_blocked(A, B, len(outsample), ridge=ridge,
+                                                    solver=INTERNAL_PARAMETERS['nystrom_solver'],
+                                                    check_stability=INTERNAL_PARAMETERS['nystrom_check_stability'])
+            success = True
+        except (IndefiniteError, NumericalError, ValueError) as e:
+            # warn the user
+            # msg = "WARNING: increasing ridge, {0:.0e} -> {1:.0e}.\n"
+            # sys.stderr.write(msg.format(ridge, ridge * 10))
+            # sys.stderr.flush()
+            # # increase the ridge value
+            # if ridge >= 1e-6:
+            #     ridge = -1
+            #     break
+            # ridge *= 10
+            break
+
+    E = np.zeros((0,0))  # (none)
+    if success:
+        # re-organize E rows according to in- and out-sample indices
+        E = np.zeros(E_.shape, dtype=E_.dtype)
+        E[insample,:] = E_[:len(insample),:]
+        E[outsample,:] = E_[len(insample):,:]
+
+    return dict(E=E, success=success, ridge=ridge, insample=insample, outsample=outsample, medians=np.array(medians))
+
+
+def get_clusters(embedding, data_obj, params=None):
+    """
+    Get the clustering tree of the tracklets of a video from their embedding (Sec. 2.4).
+    :param embedding: see get_embedding.
+    :param data_obj:
+    :param params: values overriding spectral_division.INTERNAL_PARAMETERS.
+    :return: a dictionary with the 'best_labels', 'int_paths', 'tree', 'ridge', and 'success' of the embedding.
+    """
+    success = bool(embedding['success'])
+    if not success:
+        n_left = np.count_nonzero(data_obj[:,0] <= np.median(data_obj[:,0]))
+        best_labels = ([0] * n_left) + ([1] * (data_obj.shape[0]-n_left))
+        int_paths = ([2] * n_left) + ([3] * (data_obj.shape[0]-n_left))
+    else:
+        # (Sec. 2.4)
+        best_labels, int_paths = spectral_clustering_division(np.array(embedding['E']), data_obj[:,7:10], params=params)
+    tree = reconstruct_tree_from_leafs(np.unique(int_paths))
+
+    return {'best_labels' : best_labels, 'int_paths' : int_paths, 'tree' : tree, 'ridge' : float(embedding['ridge']),
+            'success' : success}
+
 
 # ==============================================================================
 # Helper functions
 # ==============================================================================
 
-def stratified_subsample_of_tracklets_in_grid(P, nx=3, ny=3, p=0.01):
+def get_tracklet_channels(data_obj, data_trj):
+    """
+    Get the channels (or modalities) of the tracklets used to compute their similarities.
+    :param data_obj: N-by-num_obj_feats matrix of tracklets' info (the ending frame in the first column)
+    :param data_trj: N-by-2L matrix of tracklets' trajectories (x and y interleaved)
+    :return D: a python dict with the N-by-? (contiguous float32) matrices of the channels 'x', 'y', 't', 'v_x', 'v_y'
+    """
+    T = np.reshape(data_trj, (data_trj.shape[0], data_trj.shape[1]/2, 2))  # N x time length x 2 (a view)
+    L = T.shape[1]
+
+    D = dict()
+    D['x'] = np.ascontiguousarray(T[:,1:,0], dtype=np.float32)  # x's offset + x's relative displacement
+    D['y'] = np.ascontiguousarray(T[:,1:,1], dtype=np.float32)  # y's offset + y's relative displacement
+    D['t'] = (data_obj[:,0,np.newaxis] - np.linspace(L-1, 0, L)[np.newaxis,:]).astype(np.float32)
+    D['v_x'] = np.ascontiguousarray(T[:,1:,0] - T[:,:-1,0], dtype=np.float32)
+    D['v_y'] = np.ascontiguousarray(T[:,1:,1] - T[:,:-1,1], dtype=np.float32)
+
+    return D
+
+
+def stratified_subsample_of_tracklets_in_grid(P, nx=3, ny=3, p=0.01, random_state=None):
     """
     Subsample a factor p of the total tracklets stratifying the sampling in a
     grid of nx-by-ny cells.
@@ -184,8 +333,10 @@ def stratified_subsample_of_tracklets_in_grid(P, nx=3, ny=3, p=0.01):
     :param p: the sampling probability
     :param nx: number of horizontal divisions of the grid
     :param ny: number of vertical divisions of the grid
+    :param random_state: seed or numpy RandomState (numpy's global one if None)
     :return insample, outsample:
     """
+    random_state = check_random_state(random_state)
     p_cell = p / (nx*ny)
     insample = []
     outsample = []
@@ -195,47 +346,162 @@ def stratified_subsample_of_tracklets_in_grid(P, nx=3, ny=3, p=0.01):
             x_ran = (j*(1.0/nx), (j+1)*(1.0/nx))
             cell_inds = np.where((P[:,0] >= x_ran[0]) & (P[:,0] < x_ran[1]) & (P[:,1] >= y_ran[0]) & (P[:,1] < y_ran[1]))[0]
             m = len(cell_inds)
-            sorted_inds = sorted(np.arange(m, dtype=np.int32), key=lambda k: np.random.random())
+            sorted_inds = sorted(np.arange(m, dtype=np.int32), key=lambda k: random_state.random_sample())
             insample.append(np.array(sorted_inds[:int(np.ceil(m*p_cell))], dtype=np.int32))
             outsample.append(np.array(sorted_inds[int(np.ceil(m*p_cell)):], dtype=np.int32))
 
     return np.concatenate(insample), np.concatenate(outsample)
 
 
-def multimodal_product_kernel(D, primary_inds=None, secondary_inds=None, medians=None):
+def gather_channels(D, inds=None, channels=('x','y','t','v_x','v_y')):
+    """
+    Get the rows of some samples of every channel, in float64 (only the rows are converted, not the whole channels).
+    :param D: a python dict with the channels (see get_tracklet_channels).
+    :param inds: the indices of the samples (None for all of them).
+    :return: a python dict with the len(inds)-by-? float64 matrices of the channels.
+    """
+    return dict((channel_t, np.asarray(D[channel_t][inds] if inds is not None else D[channel_t], dtype=np.float64))
+                for channel_t in channels)
+
+
+def multimodal_product_kernel(D, primary_inds=None, secondary_inds=None, medians=None, out=None, random_state=None,
+                              D_primary=None):
     """
     Merges the different modalities (or channels) using the product of rbf kernels.
     The similarity matrix computed is the one from the samples in the primary indices to the secondary indices.
     If some indices are not specified (None) all samples are used.
+    The product of rbf kernels is computed as the exponential of the summed (weighted) squared distances, in tiles
+    of rows. So no dense distance matrices are kept but the output and one tile.
     :param D: a python dict containing the data in the different modalitites (or channels).
     keys are the names of the modalities
     :param primary_inds:
     :param secondary_inds:
-    :return K:
+    :param medians: the medians of the distances in every channel (estimated on a subsample if None)
+    :param out: n-by-m array where to write the kernel (a float32 one is allocated if None)
+    :param random_state: seed or numpy RandomState of the subsample used to estimate the medians
+    :param D_primary: the channels of the primary samples already gathered (see gather_channels), e.g. to compute
+    the kernel by blocks of secondary samples without gathering them every time
+    :return K, medians:
     """
     n = len(primary_inds) if primary_inds is not None else len(D['x'])
     m = len(secondary_inds) if secondary_inds is not None else len(D['x'])
 
     channels = ['x','y','t','v_x','v_y']
+
+    # (the rows are gathered before converting them, so only the n and m samples' rows are copied)
+    X_primary = gather_channels(D, primary_inds, channels) if D_primary is None else dict(D_primary)  # (not centered in place)
+    X_secondary = gather_channels(D, secondary_inds, channels)
+    for channel_t in channels:
+        # (distances are translation invariant, but centered data is less prone to cancellation errors)
+        mean = X_secondary[channel_t].mean(axis=0) if m > 0 else 0.
+        X_secondary[channel_t] = X_secondary[channel_t] - mean
+        X_primary[channel_t] = X_primary[channel_t] - mean
+
     if medians is None:
-        medians = []
-
-    K = np.ones((n, m), dtype=np.float32)  # prepare kernel product
-    for i, channel_t in enumerate(channels):
-        D[channel_t] = np.array(D[channel_t], dtype=np.float32)
-        X_primary = D[channel_t][primary_inds] if primary_inds is not None else D[channel_t]
-        X_secondary = D[channel_t][secondary_inds] if secondary_inds is not None else D[channel_t]
-        S = pairwise.pairwise_distances(X=X_primary, Y=X_secondary, metric='euclidean')
-        median = np.nanmedian(S[S!=0])
-        if len(medians) < len(channels):
-            medians.append(median)
-        gamma = 1.0/(2*median) if not isnan(median) and median != 0.0 else 0.0
-        K_tmp = np.exp(-gamma * np.power(S,2)) # rbf kernel and element-wise multiplication
-        K = np.multiply(K, K_tmp)
+        medians = _estimate_channel_medians(X_primary, X_secondary, channels, check_random_state(random_state))
+    gammas = [(1.0/(2*median) if not isnan(median) and median != 0.0 else 0.0) for median in medians]
+
+    K = np.empty((n, m), dtype=np.float32) if out is None else out  # prepare kernel product
+    sqnorms_secondary = [np.sum(X_secondary[channel_t]**2, axis=1) for channel_t in channels]
+
+    block_rows = max(1, INTERNAL_PARAMETERS['kernel_block_bytes'] // (8 * max(m, 1)))
+    for st in xrange(0, n, block_rows):
+        en = min(st + block_rows, n)
+        Z = np.zeros((en-st, m), dtype=np.float64)  # the exponent (sum over channels of gamma * dist^2)
+        for i, channel_t in enumerate(channels):
+            if gammas[i] == 0.0:
+                continue  # exp(0) = 1
+            S2 = _squared_euclidean_distances(X_primary[channel_t][st:en], X_secondary[channel_t],
+                                              Y_sqnorms=sqnorms_secondary[i])
+            S2 *= gammas[i]
+            Z += S2
+        np.negative(Z, out=Z)
+        np.exp(Z, out=Z)  # rbf kernels' element-wise multiplication
+        K[st:en,:] = Z
 
     return K, medians
 
 
+def _estimate_channel_medians(X_primary, X_secondary, channels, random_state):
+    # median of the non-zero distances in every channel, using (at most) median_sample_size primary and
+    # secondary samples (all of them if there are fewer)
+    s = INTERNAL_PARAMETERS['median_sample_size']
+    n, m = len(X_primary[channels[0]]), len(X_secondary[channels[0]])
+    rows = np.sort(random_state.permutation(n)[:s]) if n > s else slice(None)
+    cols = np.sort(random_state.permutation(m)[:s]) if m > s else slice(None)
+
+    medians = []
+    for channel_t in channels:
+        X, Y = X_primary[channel_t][rows], X_secondary[channel_t][cols]
+        S2 = _squared_euclidean_distances(X, Y)
+        # (identical tracklets get rounding errors instead of exact zeros)
+        S2[S2 <= 1e-12 * (np.sum(X**2, axis=1)[:,np.newaxis] + np.sum(Y**2, axis=1)[np.newaxis,:])] = 0
+        S = np.sqrt(S2[S2 != 0])
+        medians.append(np.median(S) if S.size > 0 else np.nan)
+
+    return medians
+
+
+def _get_parameters(params):
+    # the parameters affecting the results (to key the cached ones)
+    return {k : v for k, v in params.iteritems() if k not in _EXECUTION_PARAMETERS}
+
+
+def _get_embedding_key(data_obj, data_trj):
+    return cluster_cache.get_key(arrays=[data_obj, data_trj], params=_get_parameters(INTERNAL_PARAMETERS))
+
+
+def _get_clusters_key(embedding_key, params=None):
+    params = dict(spectral_division.INTERNAL_PARAMETERS, **(params if params is not None else {}))
+    return cluster_cache.get_key(embedding_key, params=_get_parameters(params))
+
+
+def _load_or_get_embedding(data_obj, data_trj, embedding_key, cache_path, stats):
+    embedding = cluster_cache.load_entry(cache_path, 'embeddings', embedding_key, stats=stats)
+    if embedding is None:
+        embedding = get_embedding(data_obj, data_trj,
+                                  random_state=np.random.RandomState(INTERNAL_PARAMETERS['random_seed']))
+        cluster_cache.save_entry(cache_path, 'embeddings', embedding_key, embedding, stats=stats)
+    return embedding
+
+
+def _has_clusters(clusters_filepath, clusters_key):
+    # the stored clusters are valid if they can be read and were computed from the same tracklets and parameters
+    if not isfile(clusters_filepath):
+        return False
+    try:
+        with open(clusters_filepath, 'rb') as f:
+            return cPickle.load(f).get('key', None) == clusters_key
+    except (IOError, EOFError, AttributeError, KeyError, TypeError, ValueError, IndexError, ImportError,
+            cPickle.UnpicklingError):
+        sys.stderr.write('[Warning] Invalid clusters file, recomputing it: ' + clusters_filepath + '\n')
+        sys.stderr.flush()
+        return False
+
+
+def _save_clusters(clusters_filepath, clusters):
+    # write to a temporary file first (unique per writer, see cluster_cache.save_entry), so that interrupted or
+    # concurrent writes never leave a truncated file behind
+    fd, tmp_filepath = tempfile.mkstemp(suffix='.tmp', dir=dirname(clusters_filepath))
+    with fdopen(fd, 'wb') as f:
+        cPickle.dump(clusters, f)
+    chmod(tmp_filepath, 0644)  # (mkstemp's are only readable by their owner)
+    rename(tmp_filepath, clusters_filepath)
+
+
+def _squared_euclidean_distances(X, Y, Y_sqnorms=None):
+    # ||x||^2 - 2 x.y + ||y||^2 (the cross term with a matrix product)
+    if Y_sqnorms is None:
+        Y_sqnorms = np.sum(Y**2, axis=1)
+    S2 = np.dot(X, Y.T)
+    S2 *= -2
+    S2 += np.sum(X**2, axis=1)[:,np.newaxis]
+    S2 += Y_sqnorms[np.newaxis,:]
+    np.maximum(S2, 0, out=S2)  # (negative rounding errors)
+
+    return S2
+
+
 def hsv_to_rgb(hsv):
     '''
     HSV values in [0..1]
@@ -265,4 +531,31 @@ def hsv_to_rgb(hsv):
     elif h_i == 5:
         r, g, b = v, p, q
 
-    return (int(r*256), int(g*256), int(b*256))
\ No newline at end of file
+    return (int(r*256), int(g*256), int(b*256))
+
+
+# ==============================================================================
+# Main
+# ==============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cluster the tracklets with several sets of parameters of the tree '
+                                                 'split, reusing the (stored) embeddings.')
+    parser.add_argument('tracklets_path', help='Root of the tracklets (containing the obj, trj, ... directories).')
+    parser.add_argument('clusters_path', help='Root of the clusters (the ones of every set go to a subdirectory).')
+    parser.add_argument('param_sets', help='JSON file with the parameter sets by name '
+                                           '(e.g. {"kmeans": {"split_type": "kmeans"}, "n5": {"n_threshs": 5}}).')
+    parser.add_argument('--videonames', nargs='+', default=None, help='Videos to cluster (all the stored ones by default).')
+    parser.add_argument('--cache-path', dest='cache_path', default=None, help='Root of the cache (clusters_path/cache/ by default).')
+    parser.add_argument('-t', '--num-threads', dest='nt', type=int, default=4, help='Number of workers.')
+    parser.add_argument('--backend', default='threading', help='Parallelization backend (see parallelism).')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.param_sets, 'r') as f:
+        param_sets = {str(name) : {str(k) : (str(v) if isinstance(v, unicode) else v) for k, v in params.iteritems()}
+                      for name, params in json.load(f).iteritems()}
+    videonames = args.videonames if args.videonames is not None else tracklet_store.get_videonames(args.tracklets_path)
+
+    cluster_parameter_sweep(args.tracklets_path, videonames, args.clusters_path, param_sets, nt=args.nt,
+                            backend=args.backend, cache_path=args.cache_path, verbose=args.verbose)
@@ -2,19 +2,19 @@ __author__ = 'aclapes'
 
 import numpy as np
 import subprocess
-from sklearn.neighbors import KDTree
+from scipy.spatial import cKDTree
 import time
-import cPickle
-from os.path import isfile, exists, join
-from os import makedirs
-import fileinput
+from os.path import isfile, exists, join, getsize
+from os import makedirs, rename
 from spectral_division import build_geom_neighbor_graph
-import pyflann
-from joblib import delayed, Parallel
+import tracklet_store
+from joblib import delayed
+from parallelism import run_parallel, get_files_cost
 import sys
 
 # some hard-coded constants
 FEATURE_EXTRACTOR_RELPATH = 'release/'
+FEATURE_EXTRACTOR_EXEC = './DenseTrackStab'  # relative to FEATURE_EXTRACTOR_RELPATH
 
 INTERNAL_PARAMETERS = dict(
     L = 15,
@@ -28,37 +28,43 @@ INTERNAL_PARAMETERS = dict(
     indices = dict(
         meanx = 1,
         meany = 2
-    )
+    ),
+    # parsing of DenseTrackStab's text output
+    parser_chunk_bytes = 1 << 24,  # read the output in blocks of 16MB (of complete lines)
+    parser_bytes_per_row = 3500,  # rough size of a 436-column row, to preallocate the output buffer
+    # keep only the inliers returned by filter_low_density (off: the tracklets are stored unfiltered)
+    filter_low_density = False,
 )
 
 
-def extract(fullvideonames, videonames, feat_types, tracklets_path, verbose=False):
-    _extract(fullvideonames, videonames, np.arange(len(videonames)), feat_types, tracklets_path, verbose=verbose)
+def extract(fullvideonames, videonames, feat_types, tracklets_path, keep_raw=False, verbose=False):
+    _extract(fullvideonames, videonames, np.arange(len(videonames)), feat_types, tracklets_path, keep_raw=keep_raw, verbose=verbose)
 
 
-def extract_multiprocess(fullvideonames, videonames, st, num_videos, feat_types, tracklets_path, verbose=False):
+def extract_multiprocess(fullvideonames, videonames, st, num_videos, feat_types, tracklets_path, keep_raw=False, verbose=False):
     inds = np.linspace(st, st+num_videos-1, num_videos)
-    _extract(fullvideonames, videonames, inds, feat_types, tracklets_path, verbose=verbose)
+    _extract(fullvideonames, videonames, inds, feat_types, tracklets_path, keep_raw=keep_raw, verbose=verbose)
 
 
-def extract_multithread(fullvideonames, videonames, feat_types, tracklets_path, nt=4, verbose=False):
-    # inds = np.random.permutation(len(videonames))
+def extract_multithread(fullvideonames, videonames, feat_types, tracklets_path, nt=4, backend='threading', keep_raw=False, verbose=False):
     inds = np.linspace(0,len(videonames)-1,len(videonames)).astype('int')
-    # step = np.int(np.floor(len(inds)/nt)+1)
-    #inds[i*step:((i+1)*step if (i+1)*step < len(inds) else len(inds))],
-    Parallel(n_jobs=nt, backend='threading')(delayed(_extract)(fullvideonames, videonames, [i], \
-                                                               feat_types, tracklets_path, verbose=verbose)
-                                             for i in inds)
+    run_parallel([delayed(_extract)(fullvideonames, videonames, [i], \
+                                    feat_types, tracklets_path, keep_raw=keep_raw, verbose=verbose)
+                  for i in inds], nt=nt, backend=backend,
+                 costs=get_files_cost([fullvideonames[i] for i in inds]), name='extract', verbose=verbose)
 
 
-def _extract(fullvideonames, videonames, indices, feat_types, tracklets_path, verbose=False):
+def _extract(fullvideonames, videonames, indices, feat_types, tracklets_path, keep_raw=False, verbose=False):
     """
     Extract features using Improved Dense Trajectories by Wang et. al.
+    The output of the extractor is parsed while it is being produced. Nothing is written to disk but the
+    final features, unless the raw output is kept.
     :param fullvideonames:
     :param videonames:
     :param indices:
     :param feat_types:
     :param tracklets_path:
+    :param keep_raw: keep the raw output of the extractor in tracklets_path/tmp/ (re-used if found).
     :return:
     """
     feats_beginend = get_features_beginend(INTERNAL_PARAMETERS['feats_dict'], INTERNAL_PARAMETERS['L'])
@@ -70,61 +76,49 @@ def _extract(fullvideonames, videonames, indices, feat_types, tracklets_path, ve
     except OSError:
         pass
 
-    try:
-        makedirs(join(tracklets_path, 'tmp'))
-    except OSError:
-        pass
-
-    for feat_t in feats_beginend.keys():
+    if keep_raw:
         try:
-            makedirs(join(tracklets_path, feat_t))
+            makedirs(join(tracklets_path, 'tmp'))
         except OSError:
             pass
 
     # process the videos
     total = len(fullvideonames)
     for i in indices:
-        all_done = np.all([isfile(join(tracklets_path, feat_t, videonames[i] + '.pkl'))
-                           for feat_t in feats_beginend.keys()])
-        if all_done:
+        if tracklet_store.has_tracklets(tracklets_path, feats_beginend.keys(), videonames[i]):
             if verbose:
                 print('[_extract] %s -> OK' % fullvideonames[i])
             continue
 
         start_time = time.time()
-        # extract the features into temporary file
+        # extract the features (or read them from a previously kept raw output)
         tracklets_filepath = join(tracklets_path, 'tmp/', videonames[i] + '.dat')
-        if not isfile(tracklets_filepath):
-            extract_wang_features(fullvideonames[i], INTERNAL_PARAMETERS['L'], tracklets_filepath)
-
-        # read the temporary file to numpy array
-        finput = fileinput.FileInput(tracklets_filepath)
-        data = []
-        for line in finput:
-            row = np.array(line.strip().split('\t'), dtype=np.float32)
-            data.append(row)
-        finput.close()
-
         try:
-            data = np.vstack(data)
-        except ValueError:
-            # empty row
-            sys.stderr.write("[Error] Reading tracklets file: " + tracklets_filepath + '\n')
+            if isfile(tracklets_filepath):
+                feats = read_split_tracklets_file(tracklets_filepath, feats_beginend)
+            else:
+                feats = stream_wang_features(fullvideonames[i], INTERNAL_PARAMETERS['L'], feats_beginend,
+                                             raw_output_path=(tracklets_filepath if keep_raw else None))
+            if feats['obj'].shape[0] == 0:
+                raise ValueError('No tracklets')
+        except (ValueError, OSError, subprocess.CalledProcessError) as e:
+            # failed extraction, or empty or malformed output
+            sys.stderr.write("[Error] Extracting tracklets: " + fullvideonames[i] + ' (' + str(e) + ')\n')
             sys.stderr.flush()
             continue
 
         # filter low density tracklets
-        try:
-            inliers = filter_low_density(data)
-        except:
-            sys.stderr.write("[Error] Filtering low density: " + tracklets_filepath + '\n')
-            sys.stderr.flush()
-            continue
+        if INTERNAL_PARAMETERS['filter_low_density']:
+            try:
+                inliers = filter_low_density(feats['obj'])
+            except:
+                sys.stderr.write("[Error] Filtering low density: " + fullvideonames[i] + '\n')
+                sys.stderr.flush()
+                continue
+            feats = dict((feat_t, d[inliers,:]) for feat_t, d in feats.iteritems())
 
         # store feature types separately
-        for feat_t in feats_beginend.keys():
-            with open(join(tracklets_path, feat_t, videonames[i] + '.pkl'),'wb') as f:
-                cPickle.dump(data[:, feats_beginend[feat_t][0]:feats_beginend[feat_t][1]], f)  # TODO: : -> inliners
+        tracklet_store.save_tracklets(tracklets_path, videonames[i], feats)
 
         elapsed_time = time.time() - start_time
         if verbose:
@@ -149,10 +143,247 @@ def get_features_beginend(feats_dict, L):
                               feats_dict['obj']+(feats_dict['trj']*L)+feats_dict['hog']+feats_dict['hof']+feats_dict['mbh'])}
     return feats_beginend
 
+def read_tracklets_file(filepath, num_cols=None):
+    """
+    Read the DenseTrackStab output stored in a text file to a float32 matrix.
+    :param filepath: the tab-separated file, one tracklet per line.
+    :param num_cols: number of values per line (inferred from the first line if None).
+    :return: a num_tracklets x num_cols matrix.
+    """
+    with open(filepath, 'rb') as f:
+        expected_rows = getsize(filepath) // INTERNAL_PARAMETERS['parser_bytes_per_row']
+        data = parse_tracklets(f, num_cols=num_cols, expected_rows=expected_rows)
+
+    return data
+
+
+def read_split_tracklets_file(filepath, feats_beginend):
+    """
+    Read the DenseTrackStab output stored in a text file, separating the different feature types.
+    :param filepath: the tab-separated file, one tracklet per line.
+    :param feats_beginend: the columns' begin-end of each feature type (see get_features_beginend).
+    :return: a dictionary with a num_tracklets x num_feats matrix per feature type.
+    """
+    with open(filepath, 'rb') as f:
+        expected_rows = getsize(filepath) // INTERNAL_PARAMETERS['parser_bytes_per_row']
+        feats = split_tracklets(iter_tracklet_chunks(f), feats_beginend, expected_rows=expected_rows)
+
+    return feats
+
+
+def parse_tracklets(f, num_cols=None, expected_rows=0):
+    """
+    Parse the tab-separated text output of DenseTrackStab into a float32 matrix.
+    Each block of lines is decoded at once and copied into a preallocated buffer, which grows geometrically
+    when needed. This avoids building one array per line and stacking them afterwards.
+    :param f: a file-like object (a file or a pipe) with one tracklet per line.
+    :param num_cols: number of values per line (inferred from the first line if None).
+    :param expected_rows: initial capacity (in rows) of the output buffer.
+    :return: a num_tracklets x num_cols matrix.
+    """
+    data, ptr = None, 0
+    for chunk in iter_tracklet_chunks(f, num_cols=num_cols):
+        data, ptr = _append_rows(data, ptr, chunk, expected_rows=expected_rows)
+
+    if data is None:
+        return np.zeros((0, num_cols if num_cols is not None else 0), dtype=np.float32)
+
+    data.resize((ptr, data.shape[1]), refcheck=False)  # release the reserved space
+    return data
+
+
+def split_tracklets(chunks, feats_beginend, expected_rows=0):
+    """
+    Separate the different feature types from blocks of parsed tracklets, as they are produced.
+    :param chunks: an iterable of num_block_tracklets x num_cols matrices (see iter_tracklet_chunks).
+    :param feats_beginend: the columns' begin-end of each feature type (see get_features_beginend).
+    :param expected_rows: initial capacity (in rows) of the output buffers.
+    :return: a dictionary with a (contiguous) num_tracklets x num_feats matrix per feature type.
+    """
+    feats = dict((feat_t, None) for feat_t in feats_beginend)
+    ptr = 0
+    for chunk in chunks:
+        for feat_t, (b, e) in feats_beginend.iteritems():
+            feats[feat_t], _ = _append_rows(feats[feat_t], ptr, chunk[:,b:e], expected_rows=expected_rows)
+        ptr += chunk.shape[0]
+
+    for feat_t, (b, e) in feats_beginend.iteritems():
+        if feats[feat_t] is None:
+            feats[feat_t] = np.zeros((0, e - b), dtype=np.float32)
+        else:
+            feats[feat_t].resize((ptr, e - b), refcheck=False)  # release the reserved space
+
+    return feats
+
+
+def _append_rows(data, ptr, rows, expected_rows=0):
+    """
+    Copy rows to data[ptr:], allocating or growing (geometrically, in-place realloc) the buffer if needed.
+    :return data, ptr: the buffer and the position after the copied rows.
+    """
+    if data is None:
+        data = np.empty((max(expected_rows, rows.shape[0], 1024), rows.shape[1]), dtype=np.float32)
+    elif ptr + rows.shape[0] > data.shape[0]:
+        data.resize((max(2 * data.shape[0], ptr + rows.shape[0]), data.shape[1]), refcheck=False)
+    data[ptr:ptr+rows.shape[0],:] = rows
+
+    return data, ptr + rows.shape[0]
+
+
+def iter_tracklet_chunks(f, num_cols=None, chunk_bytes=None, copy_to=None):
+    """
+    Iterate over blocks of parsed tracklets from the DenseTrackStab text output.
+    :param f: a file-like object (a file or a pipe) with one tracklet per line.
+    :param num_cols: number of values per line (inferred from the first line if None).
+    :param chunk_bytes: approximate number of bytes read per block.
+    :param copy_to: a file-like object where to copy the raw text read from f (None to not copy).
+    :return: a generator of num_block_tracklets x num_cols float32 matrices.
+    """
+    if chunk_bytes is None:
+        chunk_bytes = INTERNAL_PARAMETERS['parser_chunk_bytes']
+
+    tail = ''
+    while True:
+        buf = f.read(chunk_bytes)
+        if copy_to is not None:
+            copy_to.write(buf)
+        if not buf:
+            buf, tail = tail, ''  # flush a possible last line without line break
+            if not buf.strip():
+                break
+            buf += '\n'
+        else:
+            buf = tail + buf
+            cut = buf.rfind('\n') + 1  # keep incomplete lines for the next block
+            buf, tail = buf[:cut], buf[cut:]
+            if not buf:
+                continue
+
+        if num_cols is None:
+            num_cols = len(buf[:buf.find('\n')].split())
+
+        yield _decode_tracklets_block(buf, num_cols)
+
+
+def _decode_tracklets_block(buf, num_cols):
+    """
+    Decode a block of complete lines into a num_lines x num_cols float32 matrix.
+    DenseTrackStab prints the descriptors (the last columns) with a fixed format ("%.7f\t"), so these are decoded
+    directly from the bytes as fixed-width fields. The remaining columns, or the whole block if it does not follow
+    the format, are parsed as generic floats.
+    """
+    num_rows = buf.count('\n')
+
+    num_fixed_cols, width, decimals = _get_fixed_width_format(buf[:buf.find('\n')])
+    if 0 < num_fixed_cols <= num_cols:
+        data = _decode_fixed_width_block(buf, num_rows, num_cols, num_fixed_cols, width, decimals)
+        if data is not None:
+            return data
+
+    values = np.fromstring(buf, dtype=np.float32, sep=' ')  # any whitespace (tabs, line breaks) separates
+    if values.shape[0] != num_rows * num_cols:
+        raise ValueError('Malformed tracklets block: %d values in %d lines of %d columns'
+                         % (values.shape[0], num_rows, num_cols))
+
+    return values.reshape((num_rows, num_cols))
+
+
+def _get_fixed_width_format(line):
+    """
+    Find the trailing tab-terminated fields of a line having all the same format (digits with a decimal point
+    at the same position), e.g. "0.1234567\t".
+    :return num_fields, width, decimals: (0,0,0) if there is no such a field.
+    """
+    fields = line.split('\t')
+    if len(fields) < 2 or fields[-1] != '':
+        return 0, 0, 0  # fields are not tab-terminated
+    fields = fields[:-1]
+
+    width, dot = len(fields[-1]), fields[-1].find('.')
+    if dot < 1 or width > 19:  # (the digits must fit in a int64)
+        return 0, 0, 0
+
+    num_fields = 0
+    for field in reversed(fields):
+        if len(field) != width or field.find('.') != dot or not field.replace('.', '', 1).isdigit():
+            break
+        num_fields += 1
+
+    return num_fields, width, width - dot - 1
+
+
+def _decode_fixed_width_block(buf, num_rows, num_cols, num_fixed_cols, width, decimals):
+    b = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(b == ord('\n'))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    cuts = ends - num_fixed_cols * (width + 1)  # where the fixed-width fields of each line begin
+    if len(ends) != num_rows or np.any(cuts < starts) or np.any(b[cuts[cuts > starts] - 1] != ord('\t')):
+        return None
+
+    # separate the fixed-width fields from the rest of the line
+    starts, cuts, ends = starts.tolist(), cuts.tolist(), ends.tolist()
+    head = '\n'.join([buf[s:c] for s, c in zip(starts, cuts)])
+    fixed = ''.join([buf[c:e] for c, e in zip(cuts, ends)])
+
+    # check the format of all the fields, i.e. "ddd.dddd\t"
+    D = np.frombuffer(fixed, dtype=np.uint8).reshape((-1, width + 1)) - np.uint8(ord('0'))
+    dot = width - decimals - 1
+    if np.any(D[:,width] != np.uint8(ord('\t') - ord('0'))) or np.any(D[:,dot] != np.uint8(ord('.') - ord('0'))):
+        return None
+    D[:,dot] = D[:,width] = 0
+    if D.max() > 9:
+        return None
+
+    # the digits form the integer mantissa (exact), its division by a power of ten is correctly rounded,
+    # as parsing the decimal number as a float would be
+    mantissas = np.zeros((D.shape[0],), dtype=np.int64)
+    for k in [k for k in xrange(width) if k != dot]:
+        mantissas *= 10
+        mantissas += D[:,k]
+
+    data = np.empty((num_rows, num_cols), dtype=np.float32)
+    data[:,num_cols-num_fixed_cols:] = (mantissas / (10.0 ** decimals)).reshape((num_rows, num_fixed_cols))
+    if num_fixed_cols < num_cols:
+        values = np.fromstring(head, dtype=np.float32, sep=' ')
+        if values.shape[0] != num_rows * (num_cols - num_fixed_cols):
+            return None
+        data[:,:num_cols-num_fixed_cols] = values.reshape((num_rows, num_cols - num_fixed_cols))
+
+    return data
+
+
+def stream_wang_features(videofile_path, traj_length, feats_beginend, raw_output_path=None):
+    '''
+    Use external program (DenseTrack) to extract the features, parsing its output as it is produced.
+    :param feats_beginend: the columns' begin-end of each feature type (see get_features_beginend).
+    :param raw_output_path: if not None, the raw output is also kept in this file.
+    :return: a dictionary with a num_tracklets x num_feats matrix per feature type.
+    '''
+    argsArray = [FEATURE_EXTRACTOR_EXEC, videofile_path, '-L', str(traj_length)]
+
+    proc = subprocess.Popen(argsArray, cwd=FEATURE_EXTRACTOR_RELPATH, stdout=subprocess.PIPE)
+    try:
+        if raw_output_path is None:
+            feats = split_tracklets(iter_tracklet_chunks(proc.stdout), feats_beginend)
+        else:
+            with open(raw_output_path + '.part', 'wb') as f:
+                feats = split_tracklets(iter_tracklet_chunks(proc.stdout, copy_to=f), feats_beginend)
+    finally:
+        proc.stdout.close()  # (if parsing failed, do not let the extractor block on a full pipe)
+        returncode = proc.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, ' '.join(argsArray))
+    if raw_output_path is not None:
+        rename(raw_output_path + '.part', raw_output_path)  # only complete outputs are kept
+
+    return feats
+
+
 # Version using precomputed optical flow (stored in .flo files)
 def extract_wang_features(videofile_path, traj_length, output_features_path):
     ''' Use external program (DenseTrack) to extract the features '''
-    argsArray = ['./DenseTrackStab', videofile_path, \
+    argsArray = [FEATURE_EXTRACTOR_EXEC, videofile_path, \
                  '-L', str(traj_length)]  # DenseTrackStab is not accepting parameters, hardcoded the L in there
 
     try:
@@ -167,33 +398,37 @@ def extract_wang_features(videofile_path, traj_length, output_features_path):
 def filter_low_density(data, k=30, r=5):
     """
     Filter out low density tracklets from the sequence.
+    The tracklets ending in the same frame share the same +-r frames' window, so one KD-tree is built per frame
+    and all the tracklets of that frame are queried at once.
     :param data: the tracklets, a T x num_features matrix.
-    :return:
+    :param k: number of neighbors whose distances measure the (local) sparsity.
+    :param r: half-size of the temporal window (in frames) where the neighbors are searched.
+    :return: the indices of the inlier tracklets.
     """
 
     # each tracklet's mean x and y position
-    P = data[:,[INTERNAL_PARAMETERS['indices']['meanx'],INTERNAL_PARAMETERS['indices']['meany']]]  # (these are index 1 and 2 of data)
-
-    all_sparsities = np.zeros((P.shape[0],k), dtype=np.float32)
-    subset_indices = []  # optimization. see (*) below
-    for i in range(0, P.shape[0]):
-        new_subset_indices = np.where((data[:,0] >= data[i,0] - r) & (data[:,0] <= data[i,0] + r))[0]
-        if len(new_subset_indices) == 1:
-            all_sparsities[i,:] = np.nan
-        else:
-            # (*) a new KDTree is constructed only if the subset of data changes
-            if not np.array_equal(new_subset_indices, subset_indices):
-                subset_indices = new_subset_indices
-                tree = KDTree(P[subset_indices,:], leaf_size=1e3)
-
-            p = P[i,:].reshape(1,-1)  # query instance
-            if k+1 <= len(subset_indices):
-                dists, inds = tree.query(p, k=k+1)
-                dists = dists[0,1:]  # asked the neighbors of only 1 instance, returned in dists as 0-th element
-            else:  #len(subset_indices) > 1:
-                dists, inds = tree.query(p, k=len(subset_indices))
-                dists = np.concatenate([dists[0,1:], [np.nan]*(k-len(dists[0,1:]))])
-            all_sparsities[i,:] = dists
+    P = np.asarray(data[:,[INTERNAL_PARAMETERS['indices']['meanx'],INTERNAL_PARAMETERS['indices']['meany']]])  # (these are index 1 and 2 of data)
+
+    frames = np.asarray(data[:,0])
+    order = np.argsort(frames, kind='mergesort')
+    sorted_frames = frames[order]
+    # the window of the tracklets of the same frame: [st, en) in the tracklets sorted by frame
+    uframes, ufirst = np.unique(sorted_frames, return_index=True)
+    wnd_st = np.searchsorted(sorted_frames, uframes - r, side='left')
+    wnd_en = np.searchsorted(sorted_frames, uframes + r, side='right')
+    uend = np.append(ufirst[1:], len(order))
+
+    all_sparsities = np.empty((P.shape[0],k), dtype=np.float32)
+    all_sparsities.fill(np.nan)
+    for j in xrange(len(uframes)):
+        n = wnd_en[j] - wnd_st[j]
+        if n == 1:
+            continue  # (no neighbors)
+
+        tree = cKDTree(P[order[wnd_st[j]:wnd_en[j]],:])
+        query_inds = order[ufirst[j]:uend[j]]
+        dists, _ = tree.query(P[query_inds,:], k=min(k+1, n))
+        all_sparsities[query_inds,:n-1] = dists[:,1:]  # the first neighbor is the query itself
 
     local_sparsities = np.nanmean(all_sparsities, axis=1)
     mean_sparsity = np.nanmean(all_sparsities)
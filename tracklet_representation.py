@@ -10,11 +10,12 @@ from sklearn.decomposition import PCA, IncrementalPCA
 from yael import ynumpy
 import time
 import sys
-from joblib import delayed, Parallel
+from joblib import delayed
+from parallelism import run_parallel
 import videodarwin
-
-
-from Queue import PriorityQueue
+import tracklet_store
+import fisher_stats
+from cluster_tree import ClusterTree
 
 
 INTERNAL_PARAMETERS = dict(
@@ -26,7 +27,9 @@ INTERNAL_PARAMETERS = dict(
     bovw_lnorm = 1,
     # building GMMs
     fv_gmm_k = 256,  # number of gaussian components
-    fv_repr_feats = ['mu','sigma']
+    fv_repr_feats = ['mu','sigma'],
+    fv_additive_stats = False,  # FVs of the tree nodes summing the sufficient statistics of their leafs (see fisher_stats)
+    vd_additive_stats = False  # per-frame FVs of the tree nodes (VD) summing the statistics of their children (see fisher_stats)
 )
 
 
@@ -66,25 +69,31 @@ def compute_vd_descriptors_multiprocess(tracklets_path, intermediates_path, vide
 
 
 def compute_bovw_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, feat_types, feats_path, \
-                                         nt=4, pca_reduction=False, treelike=True, clusters_path=None, verbose=False):
-    Parallel(n_jobs=nt, backend='threading')(delayed(_compute_bovw_descriptors)(tracklets_path, intermediates_path, videonames, traintest_parts, \
-                                                                                [i], feat_types, feats_path, \
-                                                                                pca_reduction=pca_reduction, treelike=treelike, clusters_path=clusters_path, verbose=verbose)
-                                                           for i in xrange(len(videonames)))
+                                         nt=4, backend='threading', pca_reduction=False, treelike=True, clusters_path=None, verbose=False):
+    run_parallel([delayed(_compute_bovw_descriptors)(tracklets_path, intermediates_path, videonames, traintest_parts, \
+                                                     [i], feat_types, feats_path, \
+                                                     pca_reduction=pca_reduction, treelike=treelike, clusters_path=clusters_path, verbose=verbose)
+                  for i in xrange(len(videonames))], nt=nt, backend=backend,
+                 costs=[tracklet_store.get_num_tracklets(tracklets_path, videonames[i]) for i in xrange(len(videonames))],
+                 name='compute_bovw_descriptors', verbose=verbose)
 
 def compute_fv_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, feat_types, feats_path, \
-                                       nt=4, pca_reduction=False, treelike=True, clusters_path=None, verbose=False):
-    Parallel(n_jobs=nt, backend='threading')(delayed(_compute_fv_descriptors)(tracklets_path, intermediates_path, videonames, traintest_parts, \
-                                                                              [i], feat_types, feats_path, \
-                                                                              pca_reduction=pca_reduction, treelike=treelike, clusters_path=clusters_path, verbose=verbose)
-                                                           for i in xrange(len(videonames)))
+                                       nt=4, backend='threading', pca_reduction=False, treelike=True, clusters_path=None, verbose=False):
+    run_parallel([delayed(_compute_fv_descriptors)(tracklets_path, intermediates_path, videonames, traintest_parts, \
+                                                   [i], feat_types, feats_path, \
+                                                   pca_reduction=pca_reduction, treelike=treelike, clusters_path=clusters_path, verbose=verbose)
+                  for i in xrange(len(videonames))], nt=nt, backend=backend,
+                 costs=[tracklet_store.get_num_tracklets(tracklets_path, videonames[i]) for i in xrange(len(videonames))],
+                 name='compute_fv_descriptors', verbose=verbose)
 
 def compute_vd_descriptors_multithread(tracklets_path, intermediates_path, videonames, traintest_parts, feat_types, feats_path, \
-                                       nt=4, pca_reduction=False, treelike=True, clusters_path=None, verbose=False):
-    Parallel(n_jobs=nt, backend='threading')(delayed(_compute_vd_descriptors)(tracklets_path, intermediates_path, videonames, traintest_parts, \
-                                                                              [i], feat_types, feats_path, \
-                                                                              pca_reduction=pca_reduction, treelike=treelike, clusters_path=clusters_path, verbose=verbose)
-                                                           for i in xrange(len(videonames)))
+                                       nt=4, backend='threading', pca_reduction=False, treelike=True, clusters_path=None, verbose=False):
+    run_parallel([delayed(_compute_vd_descriptors)(tracklets_path, intermediates_path, videonames, traintest_parts, \
+                                                   [i], feat_types, feats_path, \
+                                                   pca_reduction=pca_reduction, treelike=treelike, clusters_path=clusters_path, verbose=verbose)
+                  for i in xrange(len(videonames))], nt=nt, backend=backend,
+                 costs=[tracklet_store.get_num_tracklets(tracklets_path, videonames[i]) for i in xrange(len(videonames))],
+                 name='compute_vd_descriptors', verbose=verbose)
 
 
 # ==============================================================================
@@ -129,13 +138,11 @@ def _compute_bovw_descriptors(tracklets_path, intermediates_path, videonames, tr
             start_time = time.time()
 
             # object features used for the per-frame FV representation computation (cach'd)
-            with open(join(tracklets_path, 'obj', videonames[i] + '.pkl'), 'rb') as f:
-                obj = cPickle.load(f)
+            obj = tracklet_store.load_tracklets(tracklets_path, 'obj', videonames[i])
 
             for j, feat_t in enumerate(feat_types):
                 # load video tracklets' feature
-                with open(join(tracklets_path, feat_t, videonames[i] + '.pkl'), 'rb') as f:
-                    d = cPickle.load(f)
+                d = tracklet_store.load_tracklets(tracklets_path, feat_t, videonames[i])
 
                 if feat_t == 'trj': # (special case)
                     d = convert_positions_to_displacements(d)
@@ -167,11 +174,12 @@ def _compute_bovw_descriptors(tracklets_path, intermediates_path, videonames, tr
                     if len(clusters['tree']) == 1:
                         bovwtree[1] = bovw(cache[feat_t]['codebook'], d)
                     else:
-                        T = reconstruct_tree_from_leafs(np.unique(clusters['int_paths']))
-                        for parent_idx, children_inds in T.iteritems():
-                            # (in a global representation)
-                            node_inds = np.where(np.any([clusters['int_paths'] == idx for idx in children_inds], axis=0))[0]
-                            bovwtree[parent_idx] = bovw(cache[feat_t]['codebook'], d[node_inds,:])  # bovw vec
+                        # (in a global representation) assign the codewords once, and sum the leafs' bovws up
+                        T = ClusterTree(np.unique(clusters['int_paths']))
+                        H = T.sum_over_subtrees(bovw_per_leaf(cache[feat_t]['codebook'], d,
+                                                              T.get_leaf_positions(clusters['int_paths']), len(T.leafs)))
+                        for parent_idx, h in zip(T.keys(), H):
+                            bovwtree[parent_idx] = h  # bovw vec
 
                     with open(output_filepath, 'wb') as f:
                         cPickle.dump(dict(tree=bovwtree), f)
@@ -217,8 +225,7 @@ def _compute_fv_descriptors(tracklets_path, intermediates_path, videonames, trai
             start_time = time.time()
 
             # object features used for the per-frame FV representation computation (cach'd)
-            with open(join(tracklets_path, 'obj', videonames[i] + '.pkl'), 'rb') as f:
-                obj = cPickle.load(f)
+            obj = tracklet_store.load_tracklets(tracklets_path, 'obj', videonames[i])
             with open(join(clusters_path, videonames[i] + '.pkl'), 'rb') as f:
                 clusters = cPickle.load(f)
 
@@ -227,8 +234,7 @@ def _compute_fv_descriptors(tracklets_path, intermediates_path, videonames, trai
                     continue
 
                 # load video tracklets' feature
-                with open(join(tracklets_path, feat_t, videonames[i] + '.pkl'), 'rb') as f:
-                    d = cPickle.load(f)
+                d = tracklet_store.load_tracklets(tracklets_path, feat_t, videonames[i])
 
                 if feat_t == 'trj': # (special case)
                     d = convert_positions_to_displacements(d)
@@ -258,12 +264,22 @@ def _compute_fv_descriptors(tracklets_path, intermediates_path, videonames, trai
                     fvtree = dict()
                     if len(clusters['tree']) == 1:
                         fvtree[1] = ynumpy.fisher(cache[feat_t]['gmm'], d, INTERNAL_PARAMETERS['fv_repr_feats'])  # fisher vec
+                    elif INTERNAL_PARAMETERS['fv_additive_stats']:
+                        # (in a global representation) the posteriors computed once, the leafs' statistics summed up
+                        T = ClusterTree(np.unique(clusters['int_paths']))
+                        S = fisher_stats.get_stats_per_leaf(cache[feat_t]['gmm'], d,
+                                                            T.get_leaf_positions(clusters['int_paths']), len(T.leafs))
+                        S = {s : T.sum_over_subtrees(v) for s, v in S.iteritems()}
+                        for node_idx, parent_idx in enumerate(T.keys()):
+                            fvtree[parent_idx] = fisher_stats.fisher_from_stats(cache[feat_t]['gmm'], {s : v[node_idx] for s, v in S.iteritems()},
+                                                                                INTERNAL_PARAMETERS['fv_repr_feats'])  # fisher vec
                     else:
-                        T = reconstruct_tree_from_leafs(np.unique(clusters['int_paths']))
-                        for parent_idx, children_inds in T.iteritems():
+                        T = ClusterTree(np.unique(clusters['int_paths']))
+                        order, ranges = T.get_node_ranges(clusters['int_paths'])
+                        d = d[order]  # (sorted by leaf: the tracklets of every node are contiguous)
+                        for parent_idx, (st, en) in zip(T.keys(), ranges):
                             # (in a global representation)
-                            node_inds = np.where(np.any([clusters['int_paths'] == idx for idx in children_inds], axis=0))[0]
-                            fvtree[parent_idx] = ynumpy.fisher(cache[feat_t]['gmm'], d[node_inds,:], INTERNAL_PARAMETERS['fv_repr_feats'])  # fisher vec
+                            fvtree[parent_idx] = ynumpy.fisher(cache[feat_t]['gmm'], d[st:en,:], INTERNAL_PARAMETERS['fv_repr_feats'])  # fisher vec
 
                     with open(output_filepath, 'wb') as f:
                         cPickle.dump(dict(tree=fvtree), f)
@@ -311,8 +327,7 @@ def _compute_vd_descriptors(tracklets_path, intermediates_path, videonames, trai
             start_time = time.time()
 
             # object features used for the per-frame FV representation computation (cach'd)
-            with open(join(tracklets_path, 'obj', videonames[i] + '.pkl'), 'rb') as f:
-                obj = cPickle.load(f)
+            obj = tracklet_store.load_tracklets(tracklets_path, 'obj', videonames[i])
             with open(join(clusters_path, videonames[i] + '.pkl'), 'rb') as f:
                 clusters = cPickle.load(f)
 
@@ -321,8 +336,7 @@ def _compute_vd_descriptors(tracklets_path, intermediates_path, videonames, trai
                     continue
 
                 # load video tracklets' feature
-                with open(join(tracklets_path, feat_t, videonames[i] + '.pkl'), 'rb') as f:
-                    d = cPickle.load(f)
+                d = tracklet_store.load_tracklets(tracklets_path, feat_t, videonames[i])
 
                 if feat_t == 'trj': # (special case)
                     d = convert_positions_to_displacements(d)
@@ -345,37 +359,31 @@ def _compute_vd_descriptors(tracklets_path, intermediates_path, videonames, trai
                 # compute FV of the video
                 if not treelike:
                     # (in a per-frame representation)
-                    fids = np.unique(obj[:,0])
-                    V = [] # row-wise fisher vectors (matrix)
-                    for f in fids:
-                        tmp = d[np.where(obj[:,0] == f)[0],:]  # hopefully this is contiguous if d already was
-                        fv = ynumpy.fisher(cache[feat_t]['gmm'], tmp, include=INTERNAL_PARAMETERS['fv_repr_feats'])  # f-th frame fisher vec
-                        V.append(fv)  # no normalization or nothing (it's done when computing darwin)
-
-                    vd = videodarwin.darwin(np.array(V))
+                    V = get_per_frame_fishers(cache[feat_t]['gmm'], d, obj[:,0])  # row-wise fisher vectors (matrix)
+                    vd = videodarwin.darwin(V)
 
                     with open(output_filepath, 'wb') as f:
                         cPickle.dump(dict(v=vd), f)
 
                 else:  # or separately the FVs of the tree nodes
+                    # (a darwin per node, not videodarwin.darwin_batch: batching would keep the per-frame FVs of all
+                    # the nodes in memory at once, for little gain at K*D's dimensions)
                     vdtree = dict()
                     if len(clusters['tree']) == 1:
-                        fids = np.unique(obj[:,0])
-                        V = [ynumpy.fisher(cache[feat_t]['gmm'], d[np.where(obj[:,0] == f)[0],:], INTERNAL_PARAMETERS['fv_repr_feats'])
-                             for f in fids]
-                        vdtree[1] = videodarwin.darwin(np.array(V))
+                        vdtree[1] = videodarwin.darwin(get_per_frame_fishers(cache[feat_t]['gmm'], d, obj[:,0]))
+                    elif INTERNAL_PARAMETERS['vd_additive_stats']:
+                        # (in a per-frame representation) the per-frame statistics of the children summed per node
+                        T = ClusterTree(np.unique(clusters['int_paths']))
+                        for parent_idx, _, V in fisher_stats.iter_node_frame_fishers(cache[feat_t]['gmm'], d, obj[:,0], T, clusters['int_paths'],
+                                                                                      INTERNAL_PARAMETERS['fv_repr_feats']):
+                            vdtree[parent_idx] = videodarwin.darwin(V)
                     else:
-                        T = reconstruct_tree_from_leafs(np.unique(clusters['int_paths']))
-                        for parent_idx, children_inds in T.iteritems():
+                        T = ClusterTree(np.unique(clusters['int_paths']))
+                        order, ranges = T.get_node_ranges(clusters['int_paths'])
+                        d, frames = d[order], obj[order,0]  # (sorted by leaf: the tracklets of every node are contiguous)
+                        for parent_idx, (st, en) in zip(T.keys(), ranges):
                             # (in a per-frame representation)
-                            node_inds = np.where(np.any([clusters['int_paths'] == idx for idx in children_inds], axis=0))[0]
-                            fids = np.unique(obj[node_inds,0])
-                            V = []
-                            for f in fids:
-                                tmp = d[np.where(obj[node_inds,0] == f)[0],:]
-                                fv = ynumpy.fisher(cache[feat_t]['gmm'], tmp, INTERNAL_PARAMETERS['fv_repr_feats'])
-                                V.append(fv)  # no normalization or nothing (it's done when computing darwin)
-                            vdtree[parent_idx] = videodarwin.darwin(np.array(V))
+                            vdtree[parent_idx] = videodarwin.darwin(get_per_frame_fishers(cache[feat_t]['gmm'], d[st:en,:], frames[st:en]))
 
                     with open(output_filepath, 'wb') as f:
                         cPickle.dump(dict(tree=vdtree), f)
@@ -507,17 +515,15 @@ def load_tracklets_sample(tracklets_path, videonames, data_inds, feat_t, num_sam
     for j in range(0, len(data_inds)):
         idx = data_inds[j]
 
-        filepath = join(tracklets_path, feat_t, videonames[idx] + '.pkl')
-        if not isfile(filepath):
+        if not tracklet_store.has_tracklets(tracklets_path, [feat_t], videonames[idx]):
             sys.stderr.write('# ERROR: missing training instance'
-                             ' {}\n'.format(filepath))
+                             ' {}\n'.format(join(tracklets_path, feat_t, videonames[idx])))
             sys.stderr.flush()
             quit()
 
-        with open(filepath, 'rb') as f:
-            d = cPickle.load(f)
-            if verbose:
-                print('[load_tracklets_sample] %s (num feats: %d)' % (filepath, d.shape[1]))
+        d = tracklet_store.load_tracklets(tracklets_path, feat_t, videonames[idx])  # (memory-mapped)
+        if verbose:
+            print('[load_tracklets_sample] %s (num feats: %d)' % (join(tracklets_path, feat_t, videonames[idx]), d.shape[1]))
 
         # init sample
         if D is None:
@@ -526,6 +532,7 @@ def load_tracklets_sample(tracklets_path, videonames, data_inds, feat_t, num_sam
         randp = np.random.permutation(d.shape[0])
         if d.shape[0] > num_samples_per_vid:
             randp = randp[:num_samples_per_vid]
+        randp.sort()  # read the (memory-mapped) rows sequentially
         D[ptr:ptr+len(randp),:] = d[randp,:]
         ptr += len(randp)
 
@@ -560,56 +567,50 @@ def convert_positions_to_displacements(P):
 
     return D
 
-def reconstruct_tree_from_leafs(leafs):
-    """
-    Given a list of leaf, recover all the nodes.
-
-    Parameters
-    ----------
-    leafs:  Leafs are integers, each representing a path in the binary tree.
-            For instance, a leaf value of 5 indicates the leaf is the one
-            reached going throught the folliwing path: root-left-right.
-
-    Returns
-    -------
-    A dictionary indicating for each node a list of all its descendents.
-    Exemple:
-        { 1 : [2,3,4,5,6,7,12,13,26,27],
-          2 : [4,5],
-          3 : [6,7,12,13,26,27],
-          ...
-        }
-    """
-    h = dict()
-    q = PriorityQueue()
-
-    # recover first intermediate nodes (direct parents from leafs)
-    for path in leafs:
-        parent_path = int(path/2)
-        if not parent_path in h and parent_path > 1:
-            q.put(-parent_path)  # deeper nodes go first (queue reversed by "-")
-        h.setdefault(parent_path, []).append(path)
+def bovw(codebook, X, nt=1):
+    return np.bincount(get_codewords(codebook, X, nt=nt), minlength=INTERNAL_PARAMETERS['bovw_codebook_k'])
 
-    # recover other intermediates notes recursevily
-    while not q.empty():
-        path = -q.get()
-        parent_path = int(path/2)
-        if not parent_path in h and parent_path > 1:  # list parent also for further processing
-            q.put(-parent_path)
 
-        h.setdefault(parent_path, [])
-        h[parent_path] += ([path] + h[path])  # append children from current node to their parent
+def bovw_per_leaf(codebook, X, leaf_pos, n_leafs, nt=1):
+    """
+    Compute the bovws of the leafs of a tree, assigning the codewords once.
+    :param codebook:
+    :param X: the tracklets' features.
+    :param leaf_pos: the leaf of every tracklet (negative if none, see ClusterTree.get_leaf_positions).
+    :param n_leafs:
+    :return: a n_leafs-by-K matrix (sum its rows for the bovw of any set of leafs, see ClusterTree.sum_over_subtrees).
+    """
+    K = INTERNAL_PARAMETERS['bovw_codebook_k']
+    words = get_codewords(codebook, X, nt=nt)
+    mask = leaf_pos >= 0
+    # (a segmented bincount: a bin per leaf and codeword)
+    bins = np.bincount(leaf_pos[mask] * K + words[mask], minlength=n_leafs * K)
 
-    # update with leafs
-    h.update(dict((i,[i]) for i in leafs))
+    return bins.reshape((n_leafs, K))
 
-    return h
 
-def bovw(codebook, X, nt=1):
+def get_codewords(codebook, X, nt=1):
     inds, dists = ynumpy.knn(X, codebook, nnn=1, distance_type=2, nt=1)
-    bins, _ = np.histogram(inds[:,0], bins=INTERNAL_PARAMETERS['bovw_codebook_k'])
+    return inds[:,0].astype(np.int64)
 
-    return bins
+
+def get_per_frame_fishers(gmm, X, frames):
+    """
+    Compute the FVs of the tracklets of every frame.
+    :param gmm:
+    :param X: the tracklets' features.
+    :param frames: the frame of every tracklet.
+    :return: a matrix with the FV of the f-th frame (in increasing order) in its f-th row. No normalization or
+    nothing (it's done when computing darwin).
+    """
+    # group the tracklets by frame at once (stable: in their original order within a frame)
+    order = np.argsort(frames, kind='mergesort')
+    fids, starts = np.unique(frames[order], return_index=True)
+    X = X[order]
+    bounds = np.append(starts, len(order))
+
+    return np.array([ynumpy.fisher(gmm, X[bounds[f]:bounds[f+1],:], INTERNAL_PARAMETERS['fv_repr_feats'])
+                     for f in xrange(len(fids))])
 
 
 def rootSIFT(X, p=0.5):
@@ -0,0 +1,172 @@
+__author__ = 'aclapes'
+
+'''Storage of the extracted tracklets.
+
+Every feature type of a video is stored in its own raw .npy block ("tracklets/<feat_t>/<videoname>.npy"), so
+that it can be memory-mapped: sampling some rows or slicing the tracklets of a tree node only reads the pages it
+touches, instead of unpickling the whole matrix. The former layout (".pkl" files, one pickled matrix per feature
+type) is still readable and can be converted running this module:
+
+    python tracklet_store.py <tracklets_path> [--remove-pickles]
+
+'''
+
+import argparse
+import cPickle
+import sys
+import time
+from os import listdir, makedirs, remove, rename
+from os.path import isdir, isfile, join, splitext
+
+import numpy as np
+
+
+FEAT_TYPES = ['obj', 'trj', 'hog', 'hof', 'mbh']
+
+
+# ==============================================================================
+# Main functions
+# ==============================================================================
+
+def get_tracklets_filepath(tracklets_path, feat_t, videoname):
+    return join(tracklets_path, feat_t, videoname + '.npy')
+
+
+def has_tracklets(tracklets_path, feat_types, videoname):
+    """
+    Check the tracklets of all the feature types are stored, in either the current or the former (pickle) layout.
+    """
+    return np.all([isfile(get_tracklets_filepath(tracklets_path, feat_t, videoname))
+                   or isfile(join(tracklets_path, feat_t, videoname + '.pkl'))
+                   for feat_t in feat_types])
+
+
+def save_tracklets(tracklets_path, videoname, feats):
+    """
+    Store the tracklets of a video.
+    :param tracklets_path: the root of the store.
+    :param videoname:
+    :param feats: a dictionary with a num_tracklets x num_feats matrix per feature type.
+    :return:
+    """
+    for feat_t, d in feats.iteritems():
+        try:
+            makedirs(join(tracklets_path, feat_t))
+        except OSError:
+            pass
+        _save_array_atomically(get_tracklets_filepath(tracklets_path, feat_t, videoname),
+                               np.ascontiguousarray(d, dtype=np.float32))
+
+
+def load_tracklets(tracklets_path, feat_t, videoname, mmap_mode='r'):
+    """
+    Load the tracklets' features of a video.
+    :param tracklets_path: the root of the store.
+    :param feat_t: the feature type ('obj', 'trj', 'hog', 'hof', or 'mbh').
+    :param videoname:
+    :param mmap_mode: see numpy.load. By default, a read-only memory-map (copy what is going to be modified).
+    :return: a num_tracklets x num_feats matrix.
+    """
+    filepath = get_tracklets_filepath(tracklets_path, feat_t, videoname)
+    if isfile(filepath):
+        return np.load(filepath, mmap_mode=mmap_mode)
+
+    # fall back to the former layout
+    with open(join(tracklets_path, feat_t, videoname + '.pkl'), 'rb') as f:
+        return cPickle.load(f)
+
+
+def get_videonames(tracklets_path, feat_t='obj'):
+    """
+    Get the names of the videos with stored tracklets (of a feature type), in either layout.
+    """
+    if not isdir(join(tracklets_path, feat_t)):
+        return []
+    return sorted(set([splitext(filename)[0] for filename in listdir(join(tracklets_path, feat_t))
+                       if splitext(filename)[1] in ['.npy', '.pkl']]))
+
+
+def get_num_tracklets(tracklets_path, videoname):
+    """
+    Get the number of stored tracklets of a video (0 if not stored), e.g. to estimate the cost of processing it.
+    """
+    try:
+        return load_tracklets(tracklets_path, 'obj', videoname).shape[0]  # (only reads the header of a .npy)
+    except IOError:
+        return 0
+
+
+def migrate_pickle_store(tracklets_path, feat_types=None, remove_pickles=False, verbose=False):
+    """
+    Convert the tracklets stored as pickles to .npy blocks. Already converted videos are skipped, so the
+    conversion can be interrupted and resumed.
+    :param tracklets_path: the root of the store.
+    :param feat_types: the feature types to convert (all by default).
+    :param remove_pickles: remove every pickle once converted.
+    :return: the number of converted files.
+    """
+    if feat_types is None:
+        feat_types = FEAT_TYPES
+
+    count = 0
+    for feat_t in feat_types:
+        if not isdir(join(tracklets_path, feat_t)):
+            continue
+
+        start_time = time.time()
+        for filename in sorted(listdir(join(tracklets_path, feat_t))):
+            videoname, ext = splitext(filename)
+            if ext != '.pkl':
+                continue
+
+            pkl_filepath = join(tracklets_path, feat_t, filename)
+            if not isfile(get_tracklets_filepath(tracklets_path, feat_t, videoname)):
+                try:
+                    with open(pkl_filepath, 'rb') as f:
+                        d = cPickle.load(f)
+                except (IOError, EOFError, cPickle.UnpicklingError):
+                    sys.stderr.write('[Error] Reading tracklets file: ' + pkl_filepath + '\n')
+                    sys.stderr.flush()
+                    continue
+                save_tracklets(tracklets_path, videoname, {feat_t : d})
+                count += 1
+
+            if remove_pickles:
+                remove(pkl_filepath)
+
+        elapsed_time = time.time() - start_time
+        if verbose:
+            print('[migrate_pickle_store] %s -> DONE (in %.2f secs)' % (join(tracklets_path, feat_t), elapsed_time))
+
+    return count
+
+
+# ==============================================================================
+# Helper functions
+# ==============================================================================
+
+def _save_array_atomically(filepath, data):
+    # write to a temporary file first, so that an interrupted write never leaves a truncated block behind
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        np.save(f, data)
+    rename(tmp_filepath, filepath)
+
+
+# ==============================================================================
+# Main
+# ==============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the tracklets stored as pickles to .npy blocks.')
+    parser.add_argument('tracklets_path', help='Root of the tracklets (containing the obj, trj, ... directories).')
+    parser.add_argument('--feat-types', dest='feat_types', nargs='+', default=FEAT_TYPES,
+                        help='Feature types to convert.')
+    parser.add_argument('--remove-pickles', dest='remove_pickles', action='store_true',
+                        help='Remove the pickles once converted.')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    count = migrate_pickle_store(args.tracklets_path, feat_types=args.feat_types,
+                                 remove_pickles=args.remove_pickles, verbose=args.verbose)
+    print('%d files converted.' % count)
@@ -17,8 +17,8 @@ def normalizeL1(X):
     :param X: each row of X is an instance
     :return: the normalized data
     """
-    X = np.matrix(X)
-    return X / np.sqrt(np.sum(np.abs(X), axis=1))
+    X = np.asarray(X)
+    return X / np.sqrt(np.sum(np.abs(X), axis=1))[:,np.newaxis]
 
 def normalizeL2(X):
     """
@@ -26,11 +26,13 @@ def normalizeL2(X):
     :param X: each row of X is an instance
     :return: the normalized data
     """
-    X = np.matrix(X)
-    return X / np.sqrt(np.sum(np.multiply(X,X), axis=1))
+    X = np.asarray(X)
+    return X / np.sqrt(np.sum(np.multiply(X,X), axis=1))[:,np.newaxis]
 
 def linearSVR(X, c_param, norm=2):
-    if norm == 1:
+    if norm is None:  # (already normalized)
+        XX = X
+    elif norm == 1:
         XX = normalizeL1(X)
     else:
         XX = normalizeL2(X)
@@ -42,26 +44,343 @@ def linearSVR(X, c_param, norm=2):
 
     return clf.coef_
 
-def darwin(X, c_svm_param=1):
-    w_fw, w_rv = _darwin(X, c_svm_param=c_svm_param)
+def ridgeGram(X, c_param, norm=2):
+    '''
+    Solves the regression of linearSVR with epsilon = 0, a ridge regression (of the time instants from the normalized
+    rows of X, with a regularized bias), in closed form in its dual: w = Z^T beta, with Z the rows plus the bias
+    feature and (G + I/2C) beta = y, G = Z Z^T being only T-by-T. An approximation of linearSVR, much faster when
+    T << N.
+    '''
+    Z = _normalize(X, norm)
+
+    T = Z.shape[0] # temporal length
+    G = np.dot(Z, Z.T).astype(np.float64) + 1  # (+1: the bias feature)
+    G[np.diag_indices(T)] += 1. / (2. * c_param)
+    beta = np.linalg.solve(G, np.linspace(1,T,T))
+
+    return np.dot(beta.astype(Z.dtype), Z)  # (without the bias, as linearSVR's coef_)
+
+def darwin(X, c_svm_param=1, solver='liblinear'):
+    w_fw, w_rv = _darwin(X, c_svm_param=c_svm_param, solver=solver)
 
     return np.concatenate([w_fw, w_rv])
 
-def _darwin(X, c_svm_param=1):
+def _darwin(X, c_svm_param=1, solver='liblinear'):
     '''
     Computes the videodarwin representation of a multi-variate temporal series.
     :param X: a N-by-T matrix, with N the number of features and T the time instants.
     :param c_svm_param: the C regularization parameter of the linear SVM.
+    :param solver: 'liblinear' (a LinearSVR) or 'ridge_gram' (the approximation with epsilon = 0, see ridgeGram).
     :return: the videodarwin representation
     '''
-    T = X.shape[0] # temporal length
-    one_to_T = np.linspace(1,T,T)
-    one_to_T = one_to_T[:,np.newaxis]
+    regress = linearSVR if solver == 'liblinear' else ridgeGram
+
+    V_fw, V_rv = get_pooled_sequences(X)
+    w_fw = regress(V_fw, c_svm_param, None) # videodarwin
+    w_rv = regress(V_rv, c_svm_param, None) # reverse videodarwin
+
+    return w_fw, w_rv
+
+def get_pooled_sequences(X, dtype=np.float32, block_size=256):
+    '''
+    Computes the inputs of the forward and reverse videodarwin regressions: the running means of the series (from
+    the beginning and from the end), rootSIFT'd and L2-normalized.
+
+    Only two T-by-N arrays are allocated (of dtype): the reverse running sums are derived from the forward ones and
+    the total sum (the sum of the last t rows is the total minus the sum of the first T-t), accumulated in float64
+    by blocks of columns, and the power and L2 normalizations are applied in place, by blocks of rows.
+    :param X: a T-by-N matrix.
+    :return: V_fw, V_rv (T-by-N).
+    '''
+    T, N = X.shape
+    one_to_T = np.linspace(1,T,T)[:,np.newaxis]
+
+    V_fw = np.empty((T, N), dtype=dtype)
+    V_rv = np.empty((T, N), dtype=dtype)
+    for st in xrange(0, N, block_size):
+        S = np.cumsum(X[:,st:st+block_size], axis=0, dtype=np.float64)
+        V_fw[:,st:st+block_size] = S / one_to_T
+        S_rv = np.empty_like(S)
+        np.subtract(S[-1], S[-2::-1], out=S_rv[:-1])
+        S_rv[-1] = S[-1]
+        V_rv[:,st:st+block_size] = S_rv / one_to_T
+
+    _normalize_pooled(V_fw, block_size)
+    _normalize_pooled(V_rv, block_size)
+
+    return V_fw, V_rv
+
+def darwin_batch(Xs, c_svm_param=1, solver='exact', max_elements=2**24):
+    '''
+    Computes the videodarwin representations of many multi-variate temporal series at once (see darwin).
+
+    The regressions are solved exactly (see linearSVR_batch), while the LinearSVR of darwin stops at tol=0.001: the
+    representations differ from darwin's by up to ~20% (relative, on random series), so they must not be mixed with
+    ones computed by darwin. The gain is modest: x1.2-1.7 faster than darwin with N=64 and N=4096 (series of 20-500
+    instants, 100 at a time), none with N=64 and 1000 series at a time; more for short series of many features
+    (solved in the dual).
+    :param Xs: a list of T_i-by-N matrices.
+    :param c_svm_param: the C regularization parameter of the linear SVM.
+    :param solver: 'exact' (the problem of linearSVR, solved exactly, see linearSVR_batch) or 'ridge_gram' (see
+    ridgeGram).
+    :param max_elements: the maximum size of the stacks of matrices solved at once (see linearSVR_batch).
+    :return: a list with the videodarwin representation of every series.
+    '''
+    return [np.concatenate([w_fw, w_rv]) for w_fw, w_rv in _darwin_batch(Xs, c_svm_param, solver, max_elements)]
+
+def _darwin_batch(Xs, c_svm_param=1, solver='exact', max_elements=2**24):
+    '''
+    Computes the forward and reverse videodarwin of many multi-variate temporal series (see _darwin), solving all
+    their regressions with linearSVR_batch instead of fitting two LinearSVR per series.
+    :return: a list of (w_fw, w_rv).
+    '''
+    Vs = []
+    for X in Xs:
+        Vs += get_pooled_sequences(np.asarray(X))  # (forward and reverse videodarwin)
+
+    if solver == 'exact':
+        W = linearSVR_batch(Vs, c_svm_param, None, max_elements=max_elements)
+    elif solver == 'ridge_gram':  # (with epsilon = 0, all the instants are active: a single step)
+        W = linearSVR_batch(Vs, c_svm_param, None, epsilon=0, max_iter=1, max_elements=max_elements)
+    else:
+        raise ValueError('Unknown solver: %s' % solver)
+
+    return [(W[2*i], W[2*i+1]) for i in xrange(len(Xs))]
+
+def darwin_tree(nodes, c_svm_param=1, solver='exact', chunk_size=64):
+    '''
+    Computes the forward and reverse videodarwin of the branches of a tree: for every node, of the series of the
+    representations from the node up to the root (as _darwin of them, but solving its problem exactly, see
+    linearSVR_batch).
+
+    The branches share their ancestors: the sums from the root are accumulated once per node, so the reverse series of
+    a node is the one of its parent plus a row (only its products with the rows of the ancestors are computed), and
+    the forward rows are differences of those sums. The regressions are solved in the dual (the series are as short
+    as the depth), level by level, all the branches of a level (of the same length) at once, starting from the
+    solutions of their parents.
+    :param nodes: a dictionary with the representation of every node, the root being 1 and the children of p, 2p
+    and 2p+1 (all the ancestors of a node must be there).
+    :param c_svm_param: the C regularization parameter of the linear SVM.
+    :param solver: 'exact' (the problem of linearSVR, solved exactly, see linearSVR_batch) or 'ridge_gram' (see
+    ridgeGram).
+    :param chunk_size: the maximum number of branches whose forward series are in memory at once.
+    :return: a dictionary with the (w_fw, w_rv) of the branch of every node.
+    '''
+    if solver not in ('exact', 'ridge_gram'):
+        raise ValueError('Unknown solver: %s' % solver)
+    epsilon, max_iter = (0.1, 100) if solver == 'exact' else (0, 1)
+
+    ids = sorted(nodes.keys())  # (the parents before their children)
+    index = dict((id, i) for i, id in enumerate(ids))
+    paths = dict()  # (the positions of the nodes from the root down to every node)
+    for id in ids:
+        paths[id] = (paths[id / 2] if id > 1 else []) + [index[id]]
+
+    # the sums of the representations from the root, and the reverse rows (rootSIFT'd and L2-normalized running means)
+    S = np.empty((len(ids), np.asarray(nodes[ids[0]]).size), dtype=np.float64)
+    for id in ids:
+        S[index[id]] = np.ravel(nodes[id]) + (S[index[id / 2]] if id > 1 else 0)
+    depths = np.array([len(paths[id]) for id in ids], dtype=np.float64)
+    R = (S / depths[:,np.newaxis]).astype(np.float32)
+    _normalize_pooled(R)
+    K = [np.dot(R[paths[id]], R[index[id]]) for id in ids]  # (with the rows of the ancestors)
+
+    one_to_T = np.arange(1, max(depths) + 1, dtype=np.float32)[:,np.newaxis]
+    darwins, betas = dict(), dict()
+    for depth in sorted(set([len(paths[id]) for id in ids])):
+        level = [id for id in ids if len(paths[id]) == depth]
+        for st in xrange(0, len(level), chunk_size):
+            chunk = level[st:st+chunk_size]
+            grams, Fs = [], []
+            for id in chunk:
+                path = paths[id]
+                G_rv = np.empty((depth, depth), dtype=np.float64)
+                for t, i in enumerate(path):
+                    G_rv[t,:t+1] = G_rv[:t+1,t] = K[i]
+                # forward: the t-th row is the mean of the node and its t first ancestors
+                F = np.empty((depth, S.shape[1]), dtype=np.float32)
+                for t, i in enumerate(path[-2::-1]):
+                    np.subtract(S[index[id]], S[i], out=F[t], casting='unsafe')
+                F[-1] = S[index[id]]
+                F /= one_to_T[:depth]
+                _normalize_pooled(F)
+                Fs.append(F)
+                grams += [np.dot(F, F.T).astype(np.float64), G_rv]
+
+            # (warm start from the parents' solutions)
+            betas0 = [beta for id in chunk for beta in (betas[id / 2] if id > 1 else (np.zeros((1,)),) * 2)]
+            B = _solve_svr_stack(None, c_svm_param, epsilon, max_iter, grams=grams, betas0=betas0)
+            for i, id in enumerate(chunk):
+                beta_fw, beta_rv = B[2*i], B[2*i+1]
+                betas[id] = (beta_fw, beta_rv)
+                darwins[id] = (np.dot(beta_fw.astype(np.float32), Fs[i]),
+                               np.dot(beta_rv.astype(np.float32), R[paths[id]]))
+
+    return darwins
+
+def linearSVR_batch(Xs, c_param, norm=2, epsilon=0.1, max_iter=100, max_elements=2**24):
+    '''
+    Solves many times the regression of linearSVR (the time instants from the normalized rows of X), the same
+    problem liblinear solves (L2-regularized, squared epsilon-insensitive loss, and a regularized bias), but exactly
+    and without a LinearSVR per series.
+
+    For the instants whose residuals are out of the epsilon tube (the active set A), the optimality conditions are
+    linear: with Z the rows of X plus the bias feature, (I + 2C Z_A^T Z_A) w = 2C Z_A^T (y_A - epsilon sign(r_A)).
+    The active sets are updated with these (generalized) Newton steps, with a backtracking line search, until they
+    do not change. When there are fewer instants than features, the same steps are taken in the T dimensions of
+    beta, w = Z^T beta, with the gram matrix G = Z Z^T: (I/2C + G_AA) beta_A = y_A - epsilon sign(r_A), and beta is 0
+    elsewhere. The series of similar lengths are solved at once, padding their stacks of matrices: n T-by-T gram
+    matrices in the dual, and the n T-by-(N+1) series (and N+1-by-N+1 matrices) in the primal, so stacks are bounded
+    by n T min(T, N+1) elements.
+    :param Xs: a list of T_i-by-N matrices.
+    :param c_param: the C regularization parameter.
+    :param norm: the normalization of the rows (see linearSVR), None if already normalized.
+    :param epsilon: the width of the insensitive tube ("-p" in C's liblinear).
+    :param max_iter: the maximum number of Newton steps.
+    :param max_elements: the maximum size (in float64 elements) of the stacks of matrices solved at once (unless a
+    single series is bigger).
+    :return: a list with the coefficients of every regression (as LinearSVR's coef_).
+    '''
+    Zs = [_normalize(X, norm) for X in Xs]
+
+    W = [None] * len(Xs)
+    # solve the series of similar lengths together (little padding), in stacks of bounded size
+    lengths = np.array([len(Z) for Z in Zs])
+    order = np.argsort(lengths, kind='mergesort')
+    st = 0
+    while st < len(order):
+        en = st + 1
+        while en < len(order) and lengths[order[en]] <= 1.5 * lengths[order[st]] \
+                and (en - st + 1) * lengths[order[en]] * min(lengths[order[en]], Zs[order[en]].shape[1] + 1) <= max_elements:
+            en += 1
+        inds = order[st:en]
+        W_stack = _solve_svr_stack([Zs[i] for i in inds], c_param, epsilon, max_iter)
+        for i, w in zip(inds, W_stack):
+            W[i] = w
+        st = en
+
+    return W
+
+def _solve_svr_stack(Zs, c_param, epsilon, max_iter, grams=None, betas0=None):
+    '''
+    Solves the problems of linearSVR_batch of a stack of series, padded to the same number of instants (and
+    features), in the space of the coefficients or of the betas, whichever is smaller.
+    :param grams: instead of the series (Zs=None), their gram matrices, to solve in the space of the betas.
+    :param betas0: the betas to start from (if grams), e.g. the ones of similar problems (shorter ones are padded).
+    :return: the list of coefficients (without the bias, as in linearSVR), or of betas (if grams).
+    '''
+    if grams is not None:
+        n, T_max, D_max = len(grams), max([len(gram) for gram in grams]), None
+        dual = True
+    else:
+        n, T_max, D_max = len(Zs), max([len(Z) for Z in Zs]), max([Z.shape[1] for Z in Zs]) + 1  # (+1: the bias feature)
+        dual = T_max < D_max
+
+    y = np.zeros((n, T_max), dtype=np.float64)
+    valid = np.zeros((n, T_max), dtype=bool)
+    G = np.zeros((n, T_max, T_max), dtype=np.float64) if dual else None
+    Z = np.zeros((n, T_max, D_max), dtype=np.float64) if not dual else None
+    for b in xrange(n):
+        T = len(grams[b]) if grams is not None else len(Zs[b])
+        y[b,:T] = np.linspace(1,T,T)
+        valid[b,:T] = True
+        if grams is not None:
+            G[b,:T,:T] = grams[b] + 1
+        elif dual:
+            G[b,:T,:T] = np.dot(Zs[b], Zs[b].T) + 1
+        else:
+            D = Zs[b].shape[1]
+            Z[b,:T,:D] = Zs[b]
+            Z[b,:T,D] = 1
+
+    if dual:
+        predict = lambda theta, inds: np.matmul(G[inds], theta[:,:,np.newaxis])[:,:,0]
+        sq_norm = lambda theta, inds: np.sum(theta * predict(theta, inds), axis=1)
+        eye = np.eye(T_max)[np.newaxis,:,:] / (2. * c_param)
+    else:
+        H = np.matmul(Z.transpose((0,2,1)), Z)
+        predict = lambda theta, inds: np.matmul(Z[inds], theta[:,:,np.newaxis])[:,:,0]
+        sq_norm = lambda theta, inds: np.sum(theta**2, axis=1)
+        eye = np.eye(D_max)[np.newaxis,:,:]
+
+    def objective(theta, inds):
+        loss = np.maximum(np.abs(y[inds] - predict(theta, inds)) - epsilon, 0) * valid[inds]
+        return 0.5 * sq_norm(theta, inds) + c_param * np.sum(loss**2, axis=1)
+
+    theta = np.zeros((n, T_max if dual else D_max), dtype=np.float64)  # (the betas or the coefficients)
+    if betas0 is not None:
+        for b, beta0 in enumerate(betas0):
+            theta[b,:len(beta0)] = beta0[:T_max]
+    f = objective(theta, np.arange(n))
+    pattern = np.zeros((n, T_max), dtype=np.int8)
+    full_step = np.zeros((n,), dtype=bool)  # (whether theta is the solution of the system of its pattern)
+    todo = np.arange(n)  # (the ones not converged yet)
+    for it in xrange(max_iter):
+        r = y[todo] - predict(theta[todo], todo)
+        new_pattern = (np.sign(r) * (np.abs(r) > epsilon) * valid[todo]).astype(np.int8)  # (active set and signs)
+        if it > 0:
+            # converged: the solution of the optimality conditions of its own active set (only after a full step,
+            # a damped one is not the solution of the system of the pattern, even if the pattern does not change)
+            not_converged = np.any(new_pattern != pattern[todo], axis=1) | ~full_step[todo]
+            todo, new_pattern = todo[not_converged], new_pattern[not_converged]
+            if len(todo) == 0:
+                break
+        pattern[todo] = new_pattern
+
+        a = (new_pattern != 0).astype(np.float64)
+        if dual:
+            M = eye + a[:,:,np.newaxis] * G[todo] * a[:,np.newaxis,:]
+            rhs = a * (y[todo] - epsilon * new_pattern)
+        else:
+            # Z_A^T Z_A = Z^T Z - Z_I^T Z_I, with few instants in the tube (I) but the padding
+            inactive = (1 - a) * valid[todo]
+            n_inactive = int(np.max(np.sum(inactive, axis=1)))
+            inds = np.argsort(-inactive, axis=1, kind='mergesort')[:,:n_inactive]
+            Z_i = Z[todo[:,np.newaxis], inds] * np.take_along_axis(inactive, inds, axis=1)[:,:,np.newaxis]
+            M = eye + 2. * c_param * (H[todo] - np.matmul(Z_i.transpose((0,2,1)), Z_i))
+            rhs = 2. * c_param * np.matmul(Z[todo].transpose((0,2,1)), (a * (y[todo] - epsilon * new_pattern))[:,:,np.newaxis])[:,:,0]
+        theta_new = np.linalg.solve(M, rhs[:,:,np.newaxis])[:,:,0]
+
+        # backtracking line search (rarely needed)
+        theta_old, f_old = theta[todo], f[todo]
+        d = theta_new - theta_old  # (the full step)
+        step = np.ones((len(todo),), dtype=np.float64)
+        f_new = objective(theta_new, todo)
+        for _ in xrange(30):
+            worse = f_new > f_old + 1e-12 * np.abs(f_old)
+            if not np.any(worse):
+                break
+            step[worse] *= 0.5
+            theta_new[worse] = theta_old[worse] + step[worse,np.newaxis] * d[worse]
+            f_new = objective(theta_new, todo)
+        # (no decrease along the step: at the optimum up to rounding errors, keep theta)
+        worse = f_new > f_old + 1e-12 * np.abs(f_old)
+        theta_new[worse], f_new[worse], step[worse] = theta_old[worse], f_old[worse], 1.
+        theta[todo], f[todo] = theta_new, f_new
+        full_step[todo] = step == 1.
+
+    if grams is not None:
+        return [theta[b,:len(gram)] for b, gram in enumerate(grams)]
+    elif dual:
+        return [np.dot(theta[b,:len(Z_b)].astype(Z_b.dtype), Z_b) for b, Z_b in enumerate(Zs)]
+    return [theta[b,:Z_b.shape[1]] for b, Z_b in enumerate(Zs)]
+
 
-    V = np.cumsum(X,axis=0) / one_to_T
-    w_fw = linearSVR(rootSIFT(V), c_svm_param, 2) # videodarwin
+# ==============================================================================
+# Helper functions
+# ==============================================================================
 
-    V = np.cumsum(np.flipud(X),axis=0) / one_to_T # reverse videodarwin
-    w_rv = linearSVR(rootSIFT(V), c_svm_param, 2)
+def _normalize(X, norm):
+    if norm is None:  # (already normalized)
+        return np.asarray(X)
+    return normalizeL1(X) if norm == 1 else normalizeL2(X)
 
-    return w_fw, w_rv
\ No newline at end of file
+def _normalize_pooled(V, block_size=256):
+    # rootSIFT and L2-normalize the rows of the running means in place, by blocks of rows
+    for st in xrange(0, V.shape[0], block_size):
+        block = V[st:st+block_size]
+        abs_block = np.abs(block)
+        sq_norms = np.sum(abs_block, axis=1)  # (the squared L2-norms of the rootSIFT'd rows)
+        np.sqrt(abs_block, out=abs_block)
+        np.copysign(abs_block, block, out=block)  # rootSIFT
+        block /= np.sqrt(sq_norms)[:,np.newaxis]  # L2